@@ -23,6 +23,7 @@ setuptools.setup(
     packages = ["thonnycontrib.codelive"],
     package_data={
         "thonnycontrib.codelive": ["res/*", 
+                                   "bench/*.py",
                                    "views/*.py",
                                    "views/session_status/*.py",
                                    "views/session_status/res/*"],
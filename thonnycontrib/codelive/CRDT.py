@@ -1,16 +1,47 @@
 from random import randint
+from array import array
+from bisect import bisect_left
+from itertools import chain, compress, count, groupby, islice, repeat
+from operator import add, and_, attrgetter, eq, getitem, neg, rshift
 import math
 from sortedcontainers import SortedList, SortedDict
 
 
 class Character:
+    """
+    A single character in a CRDT_DOC.
+
+    The position and the author are kept together in one immutable tuple, _key, which
+    is also the sort key of the document (the author's id serves as the tie breaker).
+    It is built once, so comparing and hashing characters never allocates. The
+    Characters a CRDT_DOC stores have the node of a deep key instead (see
+    CRDT_DOC._node), the ones it hands out always have the flat tuple.
+    """
+
+    __slots__ = ("_val", "_key")
+
     def __init__(self, val, pos, author):
         self._val = val
-        self._pos = pos
-        self._author = author
+        self._key = tuple(pos) + (author,)
+
+    @classmethod
+    def _from_key(cls, val, key):
+        # skips copying the position when the key is already built
+        char = cls.__new__(cls)
+        char._val = val
+        char._key = key
+        return char
+
+    @property
+    def _pos(self):
+        return self._key[:-1]
+
+    @property
+    def _author(self):
+        return self._key[-1]
 
     def author(self):
-        return self._pos[-1]
+        return self._key[-1]
 
     def __str__(self):
         # return (str(self._val) + "; " + str(self._pos)) # good for testing
@@ -18,28 +49,424 @@ class Character:
 
     # comparison to aid SortedList()
     def __lt__(self, other):
-        if self._pos == None or other._pos == None:
-            raise Exception("Can not compare uninitialized variables:", self, other)
-        # author Id serves as tie breaker
-        return (self._pos + [self._author]) < (other._pos + [other._author])
+        return self._key < other._key
+
+    def __eq__(self, other):
+        return isinstance(other, Character) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+
+# the documents are sorted on the precomputed keys, so SortedList compares plain tuples
+_sort_key = attrgetter("_key")
+
+# sites are numbered from 1. An author of 0 could make a key equal to the key before it
+# followed by a 0, and nothing fits between those two
+SENTINEL_AUTHOR = 0
+
+# CRDT_DOC stores an identifier of more than KEY_HEAD digits as its first KEY_HEAD
+# digits and the rest in groups of KEY_CHUNK chunks of KEY_CHUNK digits. Typing and
+# pasting make identifiers of a few dozen digits at most, which stay flat tuples
+KEY_HEAD = 32
+KEY_CHUNK = 8
+
+
+class FenwickTree:
+    """
+    Prefix sums over a list of non-negative numbers, with O(log n) updates and
+    lookups of the position holding a given running total.
+    """
+
+    def __init__(self, values=()):
+        self._tree = [0]
+        self._tree.extend(values)
+        size = len(self._tree)
+        for i in range(1, size):
+            parent = i + (i & -i)
+            if parent < size:
+                self._tree[parent] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def add(self, i, delta):
+        i += 1
+        size = len(self._tree)
+        while i < size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """
+        Returns the sum of the first i values
+        """
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, total):
+        """
+        Returns (i, rest) where value i is the one that covers the running total,
+        and rest is how far into value i the total falls. i == len(self) if the
+        total is past the end.
+        """
+        tree = self._tree
+        size = len(tree)
+        i = 0
+        step = 1 << (size.bit_length() - 1)
+        while step:
+            if i + step < size and tree[i + step] <= total:
+                i += step
+                total -= tree[i]
+            step >>= 1
+        return i, total
+
+
+# sizes per bucket of a SizeIndex, a bucket is split in two when it gets twice as long
+SIZE_BUCKET = 256
+
+
+class SizeIndex:
+    """
+    Prefix sums over a list of sizes, like a FenwickTree, that sizes can also be
+    inserted into and removed from. The sizes are kept in buckets of up to
+    2 * SIZE_BUCKET, with FenwickTrees of how many sizes and how much each bucket
+    holds, so every operation costs O(log n) plus the size of a bucket. The trees are
+    rebuilt only when a bucket is split or emptied.
+    """
+
+    def __init__(self, values=()):
+        values = list(values)
+        self._load(
+            [values[i : i + SIZE_BUCKET] for i in range(0, len(values), SIZE_BUCKET)]
+        )
+
+    def _load(self, buckets):
+        self._buckets = buckets or [[]]
+        self._counts = FenwickTree(map(len, self._buckets))
+        self._totals = FenwickTree(map(sum, self._buckets))
+
+    def __len__(self):
+        return self._counts.prefix_sum(len(self._buckets))
+
+    def _locate(self, i):
+        # (bucket, place in it) of size i, or of the end for i == len(self)
+        b, j = self._counts.find(i)
+        if b == len(self._buckets):
+            b -= 1
+            j = len(self._buckets[b])
+        return b, j
+
+    def add(self, i, delta):
+        b, j = self._locate(i)
+        self._buckets[b][j] += delta
+        self._totals.add(b, delta)
+
+    def insert(self, i, size):
+        b, j = self._locate(i)
+        bucket = self._buckets[b]
+        bucket.insert(j, size)
+        if len(bucket) <= 2 * SIZE_BUCKET:
+            self._counts.add(b, 1)
+            self._totals.add(b, size)
+        else:
+            self._buckets[b : b + 1] = [bucket[:SIZE_BUCKET], bucket[SIZE_BUCKET:]]
+            self._load(self._buckets)
+
+    def remove(self, i):
+        b, j = self._locate(i)
+        bucket = self._buckets[b]
+        size = bucket.pop(j)
+        if bucket or len(self._buckets) == 1:
+            self._counts.add(b, -1)
+            self._totals.add(b, -size)
+        else:
+            del self._buckets[b]
+            self._load(self._buckets)
+
+    def prefix_sum(self, i):
+        """
+        Returns the sum of the first i sizes
+        """
+        b, j = self._locate(i)
+        return self._totals.prefix_sum(b) + sum(self._buckets[b][:j])
+
+    def find(self, total):
+        """
+        Returns (i, rest) like FenwickTree.find
+        """
+        b, rest = self._totals.find(total)
+        if b == len(self._buckets):
+            return len(self), rest
+        i = self._counts.prefix_sum(b)
+        for size in self._buckets[b]:
+            if rest < size:
+                break
+            rest -= size
+            i += 1
+        return i, rest
+
+
+TEXT_CHUNK = 512
+
+
+class TextBuffer:
+    """
+    The text of a document kept up to date with its characters, as chunks of up to
+    2 * TEXT_CHUNK characters with a FenwickTree of their lengths. An edit or a slice
+    costs O(log n) plus the size of a chunk instead of a pass over the whole text.
+    """
+
+    def __init__(self, text=""):
+        self._load(text)
+
+    def _load(self, text):
+        self._chunks = [text[i : i + TEXT_CHUNK] for i in range(0, len(text), TEXT_CHUNK)]
+        self._sizes = FenwickTree(map(len, self._chunks))
+        self._length = len(text)
+        # the whole text, until the next edit
+        self._joined = text
+
+    def __len__(self):
+        return self._length
+
+    def _locate(self, offset):
+        if offset >= self._length:
+            last = len(self._chunks) - 1
+            return last, len(self._chunks[last]) if last >= 0 else 0
+        return self._sizes.find(offset)
+
+    def _rebuild(self):
+        self._chunks = [chunk for chunk in self._chunks if chunk]
+        self._sizes = FenwickTree(map(len, self._chunks))
+
+    def insert(self, offset, chars):
+        self._joined = None
+        if not self._chunks:
+            self._chunks.append("")
+            self._sizes = FenwickTree([0])
+
+        i, rest = self._locate(offset)
+        self._length += len(chars)
+        chunk = self._chunks[i]
+        chunk = chunk[:rest] + chars + chunk[rest:]
+        if len(chunk) <= 2 * TEXT_CHUNK:
+            self._chunks[i] = chunk
+            self._sizes.add(i, len(chars))
+        else:
+            self._chunks[i : i + 1] = [
+                chunk[j : j + TEXT_CHUNK] for j in range(0, len(chunk), TEXT_CHUNK)
+            ]
+            self._rebuild()
+
+    def delete(self, start, end):
+        end = min(end, self._length)
+        if start >= end:
+            return
+        self._joined = None
+        i, rest = self._locate(start)
+        self._length -= end - start
+
+        remaining = end - start
+        emptied = False
+        while remaining > 0:
+            chunk = self._chunks[i]
+            count = min(len(chunk) - rest, remaining)
+            self._chunks[i] = chunk[:rest] + chunk[rest + count :]
+            self._sizes.add(i, -count)
+            emptied = emptied or not self._chunks[i]
+            remaining -= count
+            i += 1
+            rest = 0
+
+        if emptied:
+            self._rebuild()
+
+    def insert_runs(self, runs):
+        """
+        Inserts the (offset, text) runs, in order of offset. The offsets are where the
+        runs end up, like when inserting them one after the other. With more runs than
+        chunks, the text is put back together in one pass instead.
+        """
+        if len(runs) <= len(self._chunks):
+            for offset, chars in runs:
+                self.insert(offset, chars)
+            return
+
+        old = self.text()
+        parts = []
+        at = shift = 0
+        for offset, chars in runs:
+            parts.append(old[at : offset - shift])
+            parts.append(chars)
+            at = offset - shift
+            shift += len(chars)
+        parts.append(old[at:])
+        self._load("".join(parts))
+
+    def delete_runs(self, runs):
+        """
+        Deletes the (offset, text) runs, in order of offset. The offsets are where the
+        runs start before any of them is deleted.
+        """
+        if len(runs) <= len(self._chunks):
+            for offset, chars in reversed(runs):
+                self.delete(offset, offset + len(chars))
+            return
+
+        old = self.text()
+        parts = []
+        at = 0
+        for offset, chars in runs:
+            parts.append(old[at:offset])
+            at = offset + len(chars)
+        parts.append(old[at:])
+        self._load("".join(parts))
+
+    def slice(self, start, end):
+        end = min(end, self._length)
+        if start >= end:
+            return ""
+        if self._joined != None:
+            return self._joined[start:end]
+
+        i, rest = self._locate(start)
+        parts = []
+        remaining = end - start
+        while remaining > 0:
+            part = self._chunks[i][rest : rest + remaining]
+            parts.append(part)
+            remaining -= len(part)
+            i += 1
+            rest = 0
+        return "".join(parts)
+
+    def text(self):
+        if self._joined == None:
+            self._joined = "".join(self._chunks)
+        return self._joined
+
+
+class Allocator:
+    """
+    Allocates positions between two identifiers, as in LSEQ: the base of level
+    depth is 2 ** (base_range + depth), so every level doubles the room of the one
+    above it, and a new digit lands at most boundary away from one end of the free
+    interval. Subclasses pick that end for every level with strategy().
+
+    Positions are compared together with the author that ends their key, so the
+    author of p is walked like any other digit. Generated positions never end in 0
+    and are never a prefix of q, so there is always room before and after them.
+    """
+
+    def __init__(self, base_range=4, boundary=10):
+        self._base_range = base_range
+        self._boundary = boundary
+
+    def base(self, depth):
+        return 2 ** (self._base_range + depth)
+
+    def strategy(self, depth):
+        """
+        Returns "+" to allocate close to the left neighbour, "-" for the right one
+        """
+        raise NotImplementedError()
+
+    def between(self, p, q):
+        """
+        Returns a new position that sorts strictly between the keys p and q, p < q
+        """
+        pos = []
+        on_p = on_q = True  # whether pos is still a prefix of p / q
+        depth = 0
+
+        while True:
+            low = p[depth] if on_p and depth < len(p) else 0
+            high = q[depth] if on_q and depth < len(q) else self.base(depth)
+
+            interval = high - low - 1
+            if interval > 0:
+                step = min(self._boundary, interval)
+                if self.strategy(depth) == "+":
+                    pos.append(low + randint(1, step))
+                else:
+                    pos.append(high - randint(1, step))
+                return pos
+
+            # no room at this level: follow p down to the next one
+            on_p = on_p and depth < len(p)
+            on_q = on_q and depth < len(q) and q[depth] == low
+            pos.append(low)
+            depth += 1
+
+
+class LSEQAllocator(Allocator):
+    """
+    Picks boundary+ or boundary- at random the first time a level is used, and
+    keeps that choice for the level from then on
+    """
+
+    def __init__(self, base_range=4, boundary=10):
+        Allocator.__init__(self, base_range, boundary)
+        self._strategies = {}
+
+    def strategy(self, depth):
+        if depth not in self._strategies:
+            self._strategies[depth] = "+" if randint(0, 1) == 0 else "-"
+        return self._strategies[depth]
+
+
+class BoundaryAllocator(Allocator):
+    """
+    Uses the same strategy on every level: "+" suits appending, "-" prepending
+    """
+
+    def __init__(self, base_range=4, boundary=10, strategy="+"):
+        Allocator.__init__(self, base_range, boundary)
+        self._strategy = strategy
+
+    def strategy(self, depth):
+        return self._strategy
 
 
 class CRDT_DOC:
-    def __init__(self, file_path=None, siteID=0, id_bound=10, base_range=4):
+    def __init__(
+        self, file_path=None, siteID=1, id_bound=10, base_range=4, allocator=None
+    ):
+        if siteID == SENTINEL_AUTHOR:
+            raise ValueError("siteID %d is reserved for the sentinels" % siteID)
         self.siteID = siteID
-        self._id_strategy = {}
-        self._id_boundary = 10
-        self._base_range = base_range
-        self.empty_start = Character("", [0], self.siteID)
-        self.empty_end = Character("", [2 ** self._base_range - 1], self.siteID)
+        self._allocator = allocator or LSEQAllocator(base_range, id_bound)
+
+        # the sentinels have to be the same on every replica, so their author is fixed
+        self.empty_start = Character("", [0], SENTINEL_AUTHOR)
+        self.empty_end = Character("", [self._base(0) - 1], SENTINEL_AUTHOR)
 
+        # node (see _node) -> Character, the sentinels are left out so they
+        # can never be deleted
+        self._index = {}
+        # every "\n" of the document, in document order. The rank of a newline in here
+        # is the line it ends, which turns Tk "line.col" indices into offsets
+        self._newlines = SortedList(key=_sort_key)
+        # identifiers that were deleted, so an insert that arrives late or twice can't
+        # bring them back
+        self._deleted = set()
+        # digit -> the int object every identifier of the document uses for it
+        self._digits = {}
+        # full chunk or group of a node -> the tuple every node of the document uses
+        # for it
+        self._nodes = {}
+        self._text = TextBuffer()
         self._chars = self._from_file(file_path) if file_path else self.from_scratch()
 
     def __str__(self):
         return str([str(c) for c in self._chars])
 
     def from_scratch(self):
-        doc = SortedList()
+        doc = SortedList(key=_sort_key)
         doc.add(self.empty_start)
         doc.add(self.empty_end)
         return doc
@@ -47,121 +474,1333 @@ class CRDT_DOC:
     def get_size(self):
         return len(self._chars)
 
+    def text_length(self):
+        return len(self._chars) - 2
+
+    def char_at(self, offset):
+        """
+        Returns the Character at offset in the text, or None if offset is past the end
+        """
+        if 0 <= offset < len(self._chars) - 2:
+            return self._public(self._chars[offset + 1])
+        return None
+
+    def _key_at(self, offset):
+        # the end sentinel stands in for the end of the text
+        return self._flat(self._chars[offset + 1]._key)
+
+    def _node_at(self, offset):
+        return self._chars[offset + 1]._key
+
+    def offset_of(self, id):
+        """
+        Returns the offset in the text of the identifier id. If id is not in the
+        document, the offset it would be inserted at is returned.
+        """
+        return self._node_offset(self._find(id))
+
+    def _node_offset(self, node):
+        return self._chars.bisect_key_left(node) - 1
+
+    def index_to_offset(self, index):
+        """
+        Converts a Tk "line.col" index into an offset in the text. Like Tk, columns
+        past the end of a line are clamped to the end of that line.
+        """
+        line, col = (int(i) for i in index.split("."))
+        size = self.text_length()
+
+        if line <= 1:
+            line_start = 0
+        elif line - 2 < len(self._newlines):
+            line_start = self._node_offset(self._newlines[line - 2]._key) + 1
+        else:
+            return size
+
+        if line - 1 < len(self._newlines):
+            line_end = self._node_offset(self._newlines[line - 1]._key)
+        else:
+            line_end = size
+
+        return min(line_start + max(col, 0), line_end)
+
+    def offset_to_index(self, offset):
+        """
+        Converts an offset in the text into a Tk "line.col" index
+        """
+        offset = min(max(offset, 0), self.text_length())
+        line = self._newlines.bisect_key_left(self._node_at(offset))
+
+        if line == 0:
+            line_start = 0
+        else:
+            line_start = self._node_offset(self._newlines[line - 1]._key) + 1
+
+        return "%d.%d" % (line + 1, offset - line_start)
+
+    def char_at_index(self, index):
+        """
+        Returns the Character at the Tk index, or None at the end of the document
+        """
+        return self.char_at(self.index_to_offset(index))
+
+    def index_of(self, id):
+        """
+        Returns the Tk "line.col" index of the identifier id
+        """
+        return self.offset_to_index(self.offset_of(id))
+
+    def _link(self, char):
+        self._index[char._key] = char
+        if char._val == "\n":
+            self._newlines.add(char)
+
+    def _unlink(self, char):
+        del self._index[char._key]
+        self._deleted.add(self._flat(char._key))
+        if char._val == "\n":
+            self._newlines.remove(char)
+
+    @classmethod
+    def from_text(cls, text, siteID=1, **kwargs):
+        """
+        Builds a document holding text with the identifiers laid out by _balanced_keys
+        """
+        doc = cls(siteID=siteID, **kwargs)
+        doc._chars = doc._from_text(text)
+        return doc
+
     # generate doc fom file
     def _from_file(self, file_path):
-        doc = SortedList()
-        with open(file_path) as file:
-            whole_file = file.read()
-            doc.add(self.empty_start)
-            doc.add(self.empty_end)
-            for char in whole_file:
-                self.insert(
-                    char,
-                    empty_start._pos,
-                )
+        with open(file_path, encoding="UTF-8") as file:
+            return self._from_text(file.read())
+
+    def _from_text(self, text):
+        return self._from_keys(text, self._balanced_keys(len(text), self.siteID))
+
+    @classmethod
+    def from_state(cls, state, siteID=1, **kwargs):
+        """
+        Rebuilds a document from the output of get_state, with the same identifiers
+        as the document it was taken from
+        """
+        doc = cls(siteID=siteID, **kwargs)
+        doc._chars = doc._from_keys(state["text"], map(doc._intern, state["keys"]))
         return doc
 
+    def get_state(self):
+        """
+        Returns the text and the identifiers of its characters as a JSON serializable dict
+        """
+        return {"text": self.text(), "keys": [list(key) for key in self._keys()]}
+
+    def _keys(self):
+        # the identifiers of the text in document order, without the sentinels
+        nodes = map(_sort_key, self._chars.islice(1, len(self._chars) - 1))
+        return map(self._flat, nodes)
+
+    def _copy_keys(self):
+        # the identifiers as they are now, for reading while the document changes
+        return list(self._keys())
+
+    def text(self):
+        return self._text.text()
+
+    def slice(self, start, end):
+        """
+        Returns the text from offset start to end (exclusive)
+        """
+        return self._text.slice(start, end)
+
+    def line(self, line):
+        """
+        Returns the text of the line numbered line (from 1, like Tk), without its "\n"
+        """
+        start = self.index_to_offset("%d.0" % line)
+        if line - 1 < len(self._newlines) and line >= 1:
+            end = self._node_offset(self._newlines[line - 1]._key)
+        else:
+            end = self.text_length()
+        return self.slice(start, end)
+
+    def _from_keys(self, text, keys):
+        self._text = TextBuffer(text)
+        chars = list(map(Character._from_key, text, map(self._node, keys)))
+
+        self._index = {char._key: char for char in chars}
+        self._newlines = SortedList(
+            (char for char in chars if char._val == "\n"), key=_sort_key
+        )
+
+        chars.insert(0, self.empty_start)
+        chars.append(self.empty_end)
+        # chars are already sorted, so this is a single linear pass
+        return SortedList(chars, key=_sort_key)
+
+    def _base(self, depth):
+        return self._allocator.base(depth)
+
+    def _balanced_keys(self, n, author):
+        """
+        Generates the keys of n evenly spaced positions between the sentinels.
+
+        All the positions have the smallest depth that fits n of them, and none of
+        them ends in a 0 digit, so there is always room to insert before any of them.
+        """
+        return list(zip(*self._balanced_digits(n), repeat(author)))
+
+    def _balanced_digits(self, n):
+        """
+        Returns the digits of the positions of _balanced_keys, as one list per level.
+        They are computed a level at a time so the loops stay in C.
+        """
+        depth = 0
+        while True:
+            # (smallest digit, number of digits) of each level. The first level has
+            # to stay clear of the sentinels, the last one must not end in a 0
+            levels = [(0, self._base(d)) for d in range(depth + 1)]
+            levels[-1] = (1, levels[-1][1] - 1)
+            levels[0] = (1, self._base(0) - 2)
+
+            capacity = 1
+            for _, size in levels:
+                capacity *= size
+            if capacity >= n:
+                break
+            depth += 1
+
+        slots = [(2 * i + 1) * capacity // (2 * n) for i in range(n)]
+        digits = []
+        for low, size in reversed(levels):
+            digits.append([slot % size + low for slot in slots])
+            slots = [slot // size for slot in slots]
+        digits.reverse()
+        return digits
+
     # placeholder for inserting in thonny
     def insert_local(self, val, prev_char, succ_char):
         pass
 
+    def _intern(self, id):
+        """
+        Returns id as a tuple whose digits are the document's own int objects.
+
+        Identifiers that come from other replicas are decoded with new ints for every
+        digit, while neighbouring identifiers mostly share all but their last few.
+        Interned, the digits of a shared prefix are the same objects in every key,
+        instead of an int per digit per character, and equal digits compare by
+        identity.
+        """
+        return tuple(map(self._digits.setdefault, id, id))
+
+    def _node(self, id):
+        """
+        Returns the node of the identifier id, the key the document stores and sorts
+        its Character on.
+
+        Up to KEY_HEAD digits the node is id itself, interned. A deeper id, which
+        comes of inserting in the same place over and over, is its first KEY_HEAD
+        digits followed by the rest in groups of KEY_CHUNK chunks of KEY_CHUNK digits.
+        Full chunks and groups are interned like digits, so identifiers with a common
+        prefix share all of it but their last group and chunk, and a node takes about
+        as much memory at any depth instead of 8 bytes a digit.
+
+        Nodes sort like their identifiers, comparing as plain tuples: every chunk and
+        group but the last is full, so two nodes are compared digit by digit the way
+        flat keys are, and a node that runs out first sorts first like a shorter key.
+        A shallow identifier ends before the groups of a deep one start.
+        """
+        id = self._intern(id)
+        if len(id) <= KEY_HEAD:
+            return id
+
+        # the last chunk and group are left alone unless they are full, they are
+        # seldom the same in two identifiers
+        shared = self._nodes.setdefault
+        rest = id[KEY_HEAD:]
+        chunks = [rest[i : i + KEY_CHUNK] for i in range(0, len(rest), KEY_CHUNK)]
+        last = chunks.pop()
+        chunks = [shared(chunk, chunk) for chunk in chunks]
+        chunks.append(shared(last, last) if len(last) == KEY_CHUNK else last)
+
+        groups = [
+            tuple(chunks[i : i + KEY_CHUNK]) for i in range(0, len(chunks), KEY_CHUNK)
+        ]
+        last = groups.pop()
+        groups = [shared(group, group) for group in groups]
+        if len(last) == KEY_CHUNK and len(last[-1]) == KEY_CHUNK:
+            last = shared(last, last)
+        groups.append(last)
+        return id[:KEY_HEAD] + tuple(groups)
+
+    def _find(self, id):
+        # the node of id to look it up with, which needs no interned digits
+        if len(id) <= KEY_HEAD:
+            return tuple(id)
+        return self._node(id)
+
+    def _flat(self, node):
+        # the identifier of a node
+        if len(node) <= KEY_HEAD:
+            return node
+        rest = chain.from_iterable(chain.from_iterable(node[KEY_HEAD:]))
+        return node[:KEY_HEAD] + tuple(rest)
+
+    def _public(self, char):
+        # a stored Character as it is handed out, with its identifier
+        if len(char._key) <= KEY_HEAD:
+            return char
+        return Character._from_key(char._val, self._flat(char._key))
+
+    def has_id(self, id):
+        return self._find(id) in self._index
+
+    def insert_by_id(self, val, id):
+        """
+        Adds the character val with the identifier id, which was generated by another
+        replica. Applying the same insert twice does nothing.
+
+        Returns the new Character, or None if id is already in the document or was
+        deleted from it.
+        """
+        node = self._node(id)
+        if node in self._index or tuple(id) in self._deleted:
+            return None
+
+        new_char = Character._from_key(val, node)
+        self._chars.add(new_char)
+        self._link(new_char)
+        self._text.insert(self._node_offset(node), val)
+        return self._public(new_char)
+
     def delete_by_id(self, id):
-        self._chars = [x for x in self._chars if x._pos != id]
+        """
+        Deletes the character with the identifier id (its _key) in O(log n).
 
-    def insert(self, val, prev_char=None, succ_char=None):
-        new_char = None
+        Returns the deleted Character, or None if there was nothing to delete. An id
+        that isn't in the document yet is remembered, so it is never inserted.
+        """
+        node = self._find(id)
+        char = self._index.get(node)
+        if char == None:
+            self._deleted.add(self._intern(id))
+            return None
+
+        offset = self._node_offset(node)
+        self._chars.remove(char)
+        self._unlink(char)
+        self._text.delete(offset, offset + 1)
+        return self._public(char)
+
+    def delete_range(self, start_id, end_id):
+        """
+        Deletes every character from start_id to end_id (both inclusive). The
+        identifiers don't have to exist in the document anymore.
+
+        Returns the list of deleted characters in document order.
+        """
+        start = max(self._chars.bisect_key_left(self._find(start_id)), 1)
+        end = self._chars.bisect_key_right(self._find(end_id))
+        end = min(end, len(self._chars) - 1)
+        if start >= end:
+            return []
 
-        # if val is only character in doc
-        if prev_char == None and succ_char == None:
-            new_id = self.generatePosBetween(self.empty_start._pos, self.empty_end._pos)
-            new_char = Character(val, new_id, self.siteID)
+        removed = self._chars[start:end]
+        del self._chars[start:end]
+        for char in removed:
+            self._unlink(char)
+        # the start sentinel is at 0, so ranks are one past offsets
+        self._text.delete(start - 1, end - 1)
+        return list(map(self._public, removed))
 
-        # if val is first character in doc
-        elif prev_char == None:
-            new_id = self.generatePosBetween(self.empty_start._pos, succ_char._pos)
-            new_char = Character(val, new_id, self.siteID)
+    def insert_batch(self, vals, ids):
+        """
+        Adds the characters vals with the identifiers ids from other replicas, like
+        insert_by_id for each of them, but merged into the document together and with
+        the text and the line index updated once. Identifiers that are in the document
+        already or were deleted from it are left out.
 
-        # if val is last character in doc
-        elif succ_char == None:
-            new_id = self.generatePosBetween(prev_char._pos, self.empty_end._pos)
-            new_char = Character(val, new_id, self.siteID)
+        Returns the text that was added as (offset, text) runs in document order.
+        """
+        new = dict()
+        for val, id in zip(vals, ids):
+            id = self._intern(id)
+            if id not in self._deleted:
+                new[id] = val
+        keys = [key for key in sorted(new) if not self.has_id(key)]
+        if not keys:
+            return []
 
+        return self._add_batch([new[key] for key in keys], keys)
+
+    def delete_batch(self, ids):
+        """
+        Deletes the characters with the identifiers ids together, like delete_by_id
+        for each of them. Identifiers that aren't in the document are remembered.
+
+        Returns the text that was removed as (offset, text) runs in document order,
+        with the offsets from before the delete.
+        """
+        keys = []
+        for key in sorted(set(map(tuple, ids))):
+            if self.has_id(key):
+                keys.append(key)
+            else:
+                self._deleted.add(self._intern(key))
+        if not keys:
+            return []
+
+        offsets = list(map(self.offset_of, keys))
+        vals = [self.slice(offset, offset + 1) for offset in offsets]
+        runs = self._runs(vals, offsets)
+        self._remove_batch(keys, runs)
+
+        for key, val in zip(keys, vals):
+            self._deleted.add(self._intern(key))
+            if val == "\n":
+                self._newlines.remove(Character._from_key(val, self._find(key)))
+        return runs
+
+    def deleted_ids(self):
+        """
+        Returns the identifiers that are remembered as deleted
+        """
+        return list(self._deleted)
+
+    def forget_deleted(self, ids):
+        """
+        Stops remembering that the identifiers ids were deleted, once no replica can
+        still send them. An insert of one of them would be taken after this.
+        """
+        self._deleted.difference_update(map(tuple, ids))
+
+    def _runs(self, vals, offsets):
+        # (offset, text) of the runs of adjacent characters, offsets are sorted
+        runs = []
+        for val, offset in zip(vals, offsets):
+            if runs and runs[-1][0] + len(runs[-1][1]) == offset:
+                runs[-1][1] += val
+            else:
+                runs.append([offset, val])
+        return [tuple(run) for run in runs]
+
+    def _add_batch(self, vals, keys):
+        """
+        Adds the characters vals with the sorted identifiers keys, that aren't in the
+        document yet, then the runs of text they make. Returns the runs.
+        """
+        nodes = list(map(self._node, keys))
+        chars = list(map(Character._from_key, vals, nodes))
+        # SortedList merges a batch that is large next to the list in one sort
+        self._chars.update(chars)
+        self._index.update(zip(nodes, chars))
+        self._newlines.update(char for char in chars if char._val == "\n")
+
+        runs = self._runs(vals, map(self._node_offset, nodes))
+        self._text.insert_runs(runs)
+        return runs
+
+    def _remove_batch(self, keys, runs):
+        # removes the characters keys, which make the runs of text
+        nodes = list(map(self._node, keys))
+        chars = list(map(self._index.pop, nodes))
+        if len(chars) * 4 < len(self._chars):
+            for char in chars:
+                self._chars.remove(char)
         else:
-            new_id = self.generatePosBetween(prev_char._pos, succ_char._pos)
-            new_char = Character(val, new_id, self.siteID)
+            gone = set(nodes)
+            self._chars = SortedList(
+                (char for char in self._chars if char._key not in gone), key=_sort_key
+            )
+        self._text.delete_runs(runs)
 
+    def insert(self, val, prev_char=None, succ_char=None):
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+
+        node = self._node(self._new_key(prev_key, succ_key))
+        new_char = Character._from_key(val, node)
         self._chars.add(new_char)
-        return new_char
+        self._link(new_char)
+        self._text.insert(self._node_offset(node), val)
+        return self._public(new_char)
+
+    def insert_text(self, text, prev_char=None, succ_char=None):
+        """
+        Inserts text between prev_char and succ_char in one go, for paste and the like.
+
+        Only the first character gets a position from the allocator. The others get
+        first + (i, siteID), a dense run that sorts right after it and can't collide with
+        anything, since first is a fresh identifier.
+
+        Returns the list of new Characters.
+        """
+        if not text:
+            return []
+
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+        first = self._new_key(prev_key, succ_key)
+
+        keys = [first]
+        keys.extend(first + (i, self.siteID) for i in range(1, len(text)))
+        # the run shares the digits of first, only deep keys need nodes of their own
+        shallow = len(first) + 2 <= KEY_HEAD
+        if not shallow:
+            keys = list(map(self._node, keys))
+        chars = list(map(Character._from_key, text, keys))
+
+        self._chars.update(chars)
+        for char in chars:
+            self._index[char._key] = char
+        self._newlines.update(char for char in chars if char._val == "\n")
+        self._text.insert(self._node_offset(chars[0]._key), text)
+        return chars if shallow else list(map(self._public, chars))
+
+    def _new_key(self, prev_key, succ_key):
+        key = tuple(self.generatePosBetween(prev_key, succ_key)) + (self.siteID,)
+        # identifiers are never reused, a remote replica would ignore the insert
+        while key in self._deleted:
+            key = tuple(self.generatePosBetween(key, succ_key)) + (self.siteID,)
+        return key
+
+    # generates a position between two identifiers (Character._key)
+    def generatePosBetween(self, id1, id2):
+        return self._allocator.between(id1, id2)
+
+
+BLOCK_SIZE = 1024
+
+
+class Block:
+    """
+    A run of consecutive characters by one author. Character i of the run has the
+    identifier _prefix + (_start + i, _author), so a whole run is stored as one node
+    with a single key and one string.
+    """
+
+    __slots__ = ("_text", "_prefix", "_start", "_author", "_key")
+
+    def __init__(self, text, prefix, start, author):
+        self._text = text
+        self._prefix = prefix
+        self._start = start
+        self._author = author
+        self._key = prefix + (start, author)
+
+    def __len__(self):
+        return len(self._text)
+
+    def __str__(self):
+        return self._text
+
+    def key(self, i):
+        return self._prefix + (self._start + i, self._author)
+
+    def char(self, i):
+        return Character._from_key(self._text[i], self.key(i))
+
+    def find(self, key):
+        """
+        For a key no smaller than the block's first one, returns how many of the
+        block's characters sort before key and whether key is one of the characters.
+        """
+        size = len(self._prefix)
+        if len(key) <= size or key[:size] != self._prefix:
+            # key parted from the prefix on the greater side, it's after the block
+            return len(self._text), False
+
+        i = key[size] - self._start
+        if i >= len(self._text):
+            return len(self._text), False
+
+        rest = key[size + 1 :]
+        if rest == (self._author,):
+            return i, True
+        return (i + 1 if rest > (self._author,) else i), False
+
+    def _move_start(self, count):
+        self._text = self._text[count:]
+        self._start += count
+        self._key = self.key(0)
+
+
+class CRDT_BLOCK_DOC(CRDT_DOC):
+    """
+    A CRDT_DOC that stores runs of characters as Blocks instead of one Character
+    per character. Here _chars holds the Blocks, and the characters handed out by
+    insert, char_at and the other lookups are built on demand. A block is split when
+    something is inserted or deleted in its middle.
+
+    Typing extends the block of the character before the cursor whenever its author
+    is this site, which keeps most blocks long.
+    """
+
+    def __init__(
+        self, file_path=None, siteID=1, id_bound=10, base_range=4, allocator=None
+    ):
+        self._length = 0
+        self._sizes = None
+        CRDT_DOC.__init__(self, file_path, siteID, id_bound, base_range, allocator)
+
+    def __str__(self):
+        return str([""] + list("".join(b._text for b in self._chars)) + [""])
+
+    def from_scratch(self):
+        return SortedList(key=_sort_key)
+
+    def _from_text(self, text):
+        self._length = len(text)
+        self._sizes = None
+
+        # runs of a single level under the prefix (1,) sit between the sentinels
+        prefix = (1,)
+        self._newlines = SortedList(
+            (
+                Character._from_key(val, prefix + (i + 1, self.siteID))
+                for i, val in enumerate(text)
+                if val == "\n"
+            ),
+            key=_sort_key,
+        )
+
+        return SortedList(
+            (
+                Block(text[i : i + BLOCK_SIZE], prefix, i + 1, self.siteID)
+                for i in range(0, len(text), BLOCK_SIZE)
+            ),
+            key=_sort_key,
+        )
+
+    def _from_keys(self, text, keys):
+        for val, key in zip(text, keys):
+            self._insert_key(val, key)
+        return self._chars
+
+    def _keys(self):
+        return (b.key(i) for b in self._chars for i in range(len(b._text)))
+
+    def text(self):
+        return "".join(b._text for b in self._chars)
+
+    def slice(self, start, end):
+        end = min(end, self._length)
+        if start >= end:
+            return ""
+
+        rank, i = self._block_sizes().find(start)
+        parts = []
+        remaining = end - start
+        while remaining > 0:
+            part = self._chars[rank]._text[i : i + remaining]
+            parts.append(part)
+            remaining -= len(part)
+            rank += 1
+            i = 0
+        return "".join(parts)
+
+    def get_size(self):
+        return self._length + 2
+
+    def text_length(self):
+        return self._length
+
+    def node_count(self):
+        return len(self._chars)
+
+    def _block_sizes(self):
+        # built on the first lookup, updated in place from then on
+        if self._sizes == None:
+            self._sizes = SizeIndex(len(b._text) for b in self._chars)
+        return self._sizes
+
+    def _resize(self, rank, delta):
+        self._length += delta
+        if self._sizes != None:
+            self._sizes.add(rank, delta)
+
+    def _add_block(self, block):
+        self._chars.add(block)
+        if self._sizes != None:
+            rank = self._chars.bisect_key_left(block._key)
+            self._sizes.insert(rank, len(block._text))
+
+    def _remove_block(self, rank):
+        del self._chars[rank]
+        if self._sizes != None:
+            self._sizes.remove(rank)
+
+    def _locate(self, key):
+        """
+        Returns (rank, i, exact): key sorts before character i of the block at rank,
+        and exact tells whether it is that character
+        """
+        rank = self._chars.bisect_key_right(key) - 1
+        if rank < 0:
+            return 0, 0, False
+        i, exact = self._chars[rank].find(key)
+        return rank, i, exact
+
+    def char_at(self, offset):
+        if 0 <= offset < self._length:
+            rank, i = self._block_sizes().find(offset)
+            return self._chars[rank].char(i)
+        return None
+
+    def _key_at(self, offset):
+        if offset >= self._length:
+            return self.empty_end._key
+        rank, i = self._block_sizes().find(offset)
+        return self._chars[rank].key(i)
+
+    def offset_of(self, id):
+        rank, i, _ = self._locate(tuple(id))
+        return self._block_sizes().prefix_sum(rank) + i
+
+    # the identifiers are stored as they are, they are their own nodes
+    _node = CRDT_DOC._intern
+    _node_at = _key_at
+    _node_offset = offset_of
+
+    def _link(self, char):
+        if char._val == "\n":
+            self._newlines.add(char)
+
+    def _unlink(self, char):
+        self._deleted.add(char._key)
+        if char._val == "\n":
+            self._newlines.remove(char)
+
+    def _insert_key(self, val, key):
+        """
+        Adds the character val with the identifier key, either by extending the
+        block it follows or as a new block. Returns the new Character, or None if
+        key is already in the document.
+        """
+        rank, i, exact = self._locate(key)
+        if exact:
+            return None
+
+        if self._chars:
+            block = self._chars[rank]
+            size = len(block._text)
+            if i == size and size < BLOCK_SIZE and key == block.key(size):
+                block._text += val
+                self._resize(rank, 1)
+                char = Character._from_key(val, key)
+                self._link(char)
+                return char
+
+            if 0 < i < size:
+                self._split(rank, i)
+
+        self._add_block(Block(val, key[:-2], key[-2], key[-1]))
+        self._length += 1
+        char = Character._from_key(val, key)
+        self._link(char)
+        return char
+
+    def _split(self, rank, i):
+        # the characters from i on become a block of their own, right after rank
+        block = self._chars[rank]
+        right = Block(block._text[i:], block._prefix, block._start + i, block._author)
+        block._text = block._text[:i]
+        self._chars.add(right)
+        if self._sizes != None:
+            self._sizes.add(rank, -len(right._text))
+            self._sizes.insert(rank + 1, len(right._text))
+
+    def _cut(self, rank, i, count):
+        """
+        Removes count characters of the block at rank, starting with character i.
+        Returns how many blocks the next character is past rank.
+        """
+        block = self._chars[rank]
+        size = len(block._text)
+
+        if count == size:
+            self._remove_block(rank)
+            self._length -= count
+            return 0
+
+        if i == 0:
+            # the first key changes, but the block keeps its place in the order
+            self._chars.remove(block)
+            block._move_start(count)
+            self._chars.add(block)
+            self._resize(rank, -count)
+        elif i + count == size:
+            block._text = block._text[:i]
+            self._resize(rank, -count)
+        else:
+            self._split(rank, i + count)
+            block._text = block._text[:i]
+            self._resize(rank, -count)
+        return 1
+
+    def insert(self, val, prev_char=None, succ_char=None):
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+
+        # carrying on from our own character keeps the run going
+        key = None
+        if prev_char != None and prev_key[-1] == self.siteID:
+            key = prev_key[:-2] + (prev_key[-2] + 1, self.siteID)
+        if key == None or not key < succ_key or key in self._deleted:
+            key = self._new_key(prev_key, succ_key)
+
+        return self._insert_key(val, key)
+
+    def has_id(self, id):
+        return self._locate(tuple(id))[2]
+
+    def insert_by_id(self, val, id):
+        id = self._intern(id)
+        if id in self._deleted:
+            return None
+        return self._insert_key(val, id)
+
+    def insert_text(self, text, prev_char=None, succ_char=None):
+        if not text:
+            return []
+
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+
+        # carrying on from our own character keeps the run going, like insert does
+        if prev_char != None and prev_key[-1] == self.siteID:
+            prefix, start = prev_key[:-2], prev_key[-2] + 1
+            keys = [prefix + (start + i, self.siteID) for i in range(len(text))]
+            if keys[-1] < succ_key and self._deleted.isdisjoint(keys):
+                self._extend_run(text, prefix, start)
+                chars = list(map(Character._from_key, text, keys))
+                self._newlines.update(char for char in chars if char._val == "\n")
+                return chars
+
+        first = self._new_key(prev_key, succ_key)
+        chars = [self._insert_key(text[0], first)]
+
+        # the rest of the run is first + (i, siteID), which is exactly a block under the
+        # prefix first
+        for i in range(1, len(text), BLOCK_SIZE):
+            self._add_block(Block(text[i : i + BLOCK_SIZE], first, i, self.siteID))
+        self._length += len(text) - 1
+
+        chars.extend(
+            Character._from_key(val, first + (i, self.siteID))
+            for i, val in enumerate(text[1:], 1)
+        )
+        self._newlines.update(char for char in chars[1:] if char._val == "\n")
+        return chars
 
-    # generates and Id between two positions
-    def generatePosBetween(self, pos1, pos2, depth=0, newPos=[], is_root=True):
-        # get id at tree depth or set 0
-        id1 = pos1[depth] if len(pos1) >= (depth + 1) else 0
-        id2 = pos2[depth] if len(pos2) >= (depth + 1) else 0
+    def _extend_run(self, text, prefix, start):
+        # adds text as prefix + (start + i, siteID), filling up the block that ends
+        # right before it first
+        key = prefix + (start, self.siteID)
+        rank, i, _ = self._locate(key)
+        count = 0
+        if self._chars:
+            block = self._chars[rank]
+            if i == len(block._text) and block.key(i) == key:
+                count = min(len(text), BLOCK_SIZE - len(block._text))
+                block._text += text[:count]
+                self._resize(rank, count)
 
-        alloc_strategy = self.get_strategy(depth)
+        for i in range(count, len(text), BLOCK_SIZE):
+            block = Block(text[i : i + BLOCK_SIZE], prefix, start + i, self.siteID)
+            self._add_block(block)
+        self._length += len(text) - count
 
-        # new needs to be reset after multiple passes
-        if is_root:
-            newPos = []
+    def delete_by_id(self, id):
+        id = tuple(id)
+        rank, i, exact = self._locate(id)
+        if not exact:
+            self._deleted.add(self._intern(id))
+            return None
+
+        char = self._chars[rank].char(i)
+        self._cut(rank, i, 1)
+        self._unlink(char)
+        return char
+
+    def delete_range(self, start_id, end_id):
+        start = self.offset_of(start_id)
+        rank, i, exact = self._locate(tuple(end_id))
+        end = self._block_sizes().prefix_sum(rank) + i + (1 if exact else 0)
+        if start >= end:
+            return []
+
+        removed = self._remove_range(start, end)
+        for char in removed:
+            self._unlink(char)
+        return removed
+
+    def _remove_range(self, start, end):
+        # removes the characters from offset start to end and returns them
+        removed = []
+        remaining = end - start
+        rank, i = self._block_sizes().find(start)
+        while remaining > 0:
+            block = self._chars[rank]
+            count = min(len(block._text) - i, remaining)
+            removed.extend(block.char(j) for j in range(i, i + count))
+            remaining -= count
+            rank += self._cut(rank, i, count)
+            i = 0
+        return removed
+
+    def _add_batch(self, vals, keys):
+        # blocks are extended and split a character at a time anyway
+        for val, key in zip(vals, keys):
+            self._insert_key(val, key)
+        return self._runs(vals, map(self.offset_of, keys))
+
+    def _remove_batch(self, keys, runs):
+        for offset, chars in reversed(runs):
+            self._remove_range(offset, offset + len(chars))
+
+
+# a packed identifier has a field of PACKED_BITS bits for each of its first
+# PACKED_DIGITS digits (counting the author), holding the digit + 1 or 0 past its end,
+# then a bit that is set when the identifier didn't fit
+PACKED_BITS = 10
+PACKED_DIGITS = 6
+# codes per array, an array is split in two when it gets twice as long
+PACKED_CHUNK = 4096
+
+_PACKED_LIMIT = (1 << PACKED_BITS) - 2
+_PACKED_MASK = (1 << PACKED_BITS) - 1
+_PACKED_SHIFTS = [
+    PACKED_BITS * (PACKED_DIGITS - 1 - i) + 1 for i in range(PACKED_DIGITS)
+]
+# digit -> its field at each place, so packing an identifier is one map in C
+_PACKED_FIELDS = [
+    [(v + 1) << shift for v in range(_PACKED_LIMIT)] for shift in _PACKED_SHIFTS
+]
+# field -> the digit it holds, the same int object every time
+_PACKED_DIGITS = [None] + list(range(_PACKED_LIMIT))
+# bit length of the lowest set bit of a code -> the number of fields it uses
+_PACKED_LENGTHS = [0] + [
+    PACKED_DIGITS - (bit - 2) // PACKED_BITS for bit in range(1, 64)
+]
+
+
+def _pack(key):
+    """
+    Returns the 64 bit code of the identifier key. Codes sort like the identifiers,
+    except that identifiers that didn't fit can share a code.
+    """
+    if len(key) <= PACKED_DIGITS and max(key) < _PACKED_LIMIT:
+        return sum(map(list.__getitem__, _PACKED_FIELDS, key))
+
+    # a digit too big for its field gets the biggest field, and what follows it or
+    # the last field only orders the identifiers with the same code
+    code = 0
+    for i in range(PACKED_DIGITS):
+        field = key[i] + 1 if i < len(key) else 0
+        if field >= _PACKED_MASK:
+            code = (code << PACKED_BITS | _PACKED_MASK) << PACKED_BITS * (
+                PACKED_DIGITS - 1 - i
+            )
+            break
+        code = code << PACKED_BITS | field
+    return code << 1 | 1
+
+
+def _unpack(code):
+    # the identifier of a code with the low bit clear
+    fields = map(and_, map(rshift, repeat(code), _PACKED_SHIFTS), repeat(_PACKED_MASK))
+    return tuple(map(_PACKED_DIGITS.__getitem__, filter(None, fields)))
+
+
+def _unpack_all(codes):
+    # _unpack of an array of codes, a field at a time so the loops stay in C
+    fields = [
+        map(
+            _PACKED_DIGITS.__getitem__,
+            map(and_, map(rshift, codes, repeat(shift)), repeat(_PACKED_MASK)),
+        )
+        for shift in _PACKED_SHIFTS
+    ]
+    lowest = map(int.bit_length, map(and_, codes, map(neg, codes)))
+    lengths = map(_PACKED_LENGTHS.__getitem__, lowest)
+    return map(getitem, zip(*fields), map(slice, lengths))
+
+
+def _unpack_chunks(chunks, deep):
+    # the identifiers of the codes in chunks, the ones that didn't fit come from deep
+    deep = {code: iter(keys) for code, keys in deep.items()}
+    for chunk in chunks:
+        if not deep or not any(map(and_, chunk, repeat(1))):
+            yield from _unpack_all(chunk)
+            continue
+        for code in chunk:
+            yield next(deep[code]) if code & 1 else _unpack(code)
+
+
+class CRDT_PACKED_DOC(CRDT_DOC):
+    """
+    A CRDT_DOC for very large documents, with nothing stored per character but an
+    int in an array and the character in the TextBuffer.
+
+    The identifiers are packed into 64 bit codes (_pack) that are kept in document
+    order in _chars, a list of arrays, so loading and saving the document are scans
+    over arrays rather than over objects. An identifier too deep to be packed whole
+    gets a code it shares with others like it, and is kept in full in _deep. The
+    characters handed out by insert, char_at and the other lookups are built on
+    demand, like in CRDT_BLOCK_DOC.
+    """
+
+    def __init__(
+        self, file_path=None, siteID=1, id_bound=10, base_range=4, allocator=None
+    ):
+        self._length = 0
+        self._sizes = None
+        # the largest code of every array of _chars
+        self._maxes = []
+        # code -> sorted list of the identifiers with that code, for the ones that
+        # didn't fit
+        self._deep = {}
+        CRDT_DOC.__init__(self, file_path, siteID, id_bound, base_range, allocator)
+        # the unpacked identifiers share the table's digits, so the interned ones do too
+        digits = _PACKED_DIGITS[1:]
+        self._digits = dict(zip(digits, digits))
 
-        # if id's are not adjacent
-        if (id2 - id1) > 1:
-            newDigit = self.generatePosInLevel(id1, id2, depth)
-            newPos.append(newDigit)
-            return newPos
+    def __str__(self):
+        return str([""] + list(self.text()) + [""])
+
+    def from_scratch(self):
+        self._maxes = []
+        self._sizes = None
+        return []
+
+    def _from_text(self, text):
+        digits = self._balanced_digits(len(text))
+        if len(digits) >= PACKED_DIGITS or self.siteID >= _PACKED_LIMIT:
+            return CRDT_DOC._from_text(self, text)
+
+        # packed a level at a time, without making the identifiers
+        codes = repeat(_PACKED_FIELDS[len(digits)][self.siteID], len(text))
+        for fields, column in zip(_PACKED_FIELDS, digits):
+            codes = map(add, codes, map(fields.__getitem__, column))
+        self._deep = {}
+        return self._from_codes(text, array("Q", codes))
+
+    def _from_keys(self, text, keys):
+        self._deep = {}
+        codes = array("Q")
+        keys = iter(keys)
+        for _ in range(0, len(text), PACKED_CHUNK):
+            batch = list(islice(keys, PACKED_CHUNK))
+            packed = array("Q", map(_pack, batch))
+            codes.extend(packed)
+            self._add_deep(compress(batch, map(and_, packed, repeat(1))))
+        return self._from_codes(text, codes)
 
-        # adjacent ids
+    def _from_codes(self, text, codes):
+        self._text = TextBuffer(text)
+        self._set_codes(codes)
+
+        newlines = map(eq, text, repeat("\n"))
+        if self._deep:
+            keys = map(self._key_at, compress(count(), newlines))
         else:
-            # check next depth
-            if len(pos1) >= (depth + 1) or len(pos2) >= (depth + 1):
-                newPos.append(id1)
-                return self.generatePosBetween(pos1, pos2, depth + 1, newPos, False)
+            keys = _unpack_all(array("Q", compress(codes, newlines)))
+        self._newlines = SortedList(
+            map(Character._from_key, repeat("\n"), keys), key=_sort_key
+        )
+        return self._chars
+
+    def _set_codes(self, codes):
+        # replaces the arrays with the codes of an array, in order
+        self._length = len(codes)
+        self._chars = [
+            codes[i : i + PACKED_CHUNK] for i in range(0, len(codes), PACKED_CHUNK)
+        ]
+        self._maxes = [chunk[-1] for chunk in self._chars]
+        self._sizes = None
+
+    def _keys(self):
+        return _unpack_chunks(self._chars, self._deep)
+
+    def _copy_keys(self):
+        # copying the arrays is a memcpy, the codes are unpacked by whoever reads them
+        chunks = [chunk[:] for chunk in self._chars]
+        deep = {code: list(keys) for code, keys in self._deep.items()}
+        return _unpack_chunks(chunks, deep)
+
+    def get_size(self):
+        return self._length + 2
+
+    def text_length(self):
+        return self._length
+
+    def _chunk_sizes(self):
+        # rebuilt lazily after arrays are added or removed, updated in place otherwise
+        if self._sizes == None:
+            self._sizes = FenwickTree(map(len, self._chars))
+        return self._sizes
+
+    def _locate(self, key):
+        """
+        Returns (rank, code, exact): key sorts before the character at offset rank,
+        and exact tells whether it is that character
+        """
+        code = _pack(key)
+        c = bisect_left(self._maxes, code)
+        if c == len(self._chars):
+            return self._length, code, False
+
+        chunk = self._chars[c]
+        i = bisect_left(chunk, code)
+        rank = self._chunk_sizes().prefix_sum(c) + i
+        if not code & 1:
+            return rank, code, chunk[i] == code
+
+        deep = self._deep.get(code, ())
+        j = bisect_left(deep, key)
+        return rank + j, code, j < len(deep) and deep[j] == key
+
+    def _iter_keys(self, start, end):
+        # the identifiers of the characters from offset start to end
+        c, i = self._chunk_sizes().find(start)
+        rank = start
+        deep, j = None, 0
+        while rank < end:
+            for code in self._chars[c][i : i + end - rank]:
+                if not code & 1:
+                    yield _unpack(code)
+                else:
+                    if deep != code:
+                        # where the identifiers with this code start
+                        deep, j = code, rank - self._locate(self._deep[code][0])[0]
+                    yield self._deep[code][j]
+                    j += 1
+                rank += 1
+            c, i = c + 1, 0
+
+    def char_at(self, offset):
+        if 0 <= offset < self._length:
+            return Character._from_key(
+                self._text.slice(offset, offset + 1), self._key_at(offset)
+            )
+        return None
+
+    def _key_at(self, offset):
+        if offset >= self._length:
+            return self.empty_end._key
+        return next(self._iter_keys(offset, offset + 1))
+
+    def offset_of(self, id):
+        return self._locate(tuple(id))[0]
+
+    # the identifiers are stored as they are, they are their own nodes
+    _node = CRDT_DOC._intern
+    _node_at = _key_at
+    _node_offset = offset_of
+
+    def has_id(self, id):
+        return self._locate(tuple(id))[2]
 
-            # if Ids are at max depth, new level is created
+    def _link(self, char):
+        if char._val == "\n":
+            self._newlines.add(char)
+
+    def _unlink(self, char):
+        self._deleted.add(char._key)
+        if char._val == "\n":
+            self._newlines.remove(char)
+
+    def _add_deep(self, keys):
+        # keys are sorted, so the ones with the same code come together
+        for code, group in groupby(keys, _pack):
+            group = list(group)
+            deep = self._deep.setdefault(code, [])
+            i = bisect_left(deep, group[0])
+            if i == len(deep) or group[-1] < deep[i]:
+                # a character or a pasted run, which go in as one piece
+                deep[i:i] = group
+            else:
+                deep.extend(group)
+                deep.sort()
+
+    def _remove_deep(self, keys):
+        for code, group in groupby(keys, _pack):
+            if code & 1:
+                gone = set(group)
+                deep = [key for key in self._deep[code] if key not in gone]
+                if deep:
+                    self._deep[code] = deep
+                else:
+                    del self._deep[code]
+
+    def _insert_codes(self, rank, codes):
+        # codes go in at rank, in the order they are in
+        if not self._chars:
+            self._chars.append(array("Q"))
+            self._maxes.append(0)
+            self._sizes = None
+
+        c, i = self._chunk_sizes().find(rank)
+        if c == len(self._chars):
+            c -= 1
+            i = len(self._chars[c])
+        chunk = self._chars[c]
+        chunk[i:i] = array("Q", codes)
+        self._maxes[c] = chunk[-1]
+        self._length += len(codes)
+
+        if len(chunk) > 2 * PACKED_CHUNK:
+            parts = [
+                chunk[j : j + PACKED_CHUNK] for j in range(0, len(chunk), PACKED_CHUNK)
+            ]
+            self._chars[c : c + 1] = parts
+            self._maxes[c : c + 1] = [part[-1] for part in parts]
+            self._sizes = None
+        elif self._sizes != None:
+            self._sizes.add(c, len(codes))
+
+    def _remove(self, start, end, keys):
+        # removes the characters from offset start to end, whose identifiers are keys
+        self._remove_codes(start, end)
+        self._text.delete(start, end)
+        if self._deep:
+            self._remove_deep(keys)
+
+    def _remove_codes(self, start, end):
+        c, i = self._chunk_sizes().find(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = self._chars[c]
+            count = min(len(chunk) - i, remaining)
+            del chunk[i : i + count]
+            remaining -= count
+            if chunk:
+                self._maxes[c] = chunk[-1]
+                if self._sizes != None:
+                    self._sizes.add(c, -count)
+                c += 1
             else:
-                newPos.append(id1)
-                new_digit = self.generatePosInLevel(id1, id2, depth + 1)
-                newPos.append(new_digit)
-                return newPos
-
-    def generatePosInLevel(self, id1, id2, depth):
-        strategy = self.get_strategy(depth)
-        interval = id2 - id1 - 1
-        step = min(self._id_boundary, interval)
-        new_id = None
-
-        if step == 0 or step == -1:
-            new_id = randint(3, (self._base_range - 1))
-
-        elif strategy == "+" and step > 0:
-            new_id = id2
-            # loop prevents duplicate IDs
-            while id2 == new_id:
-                new_id = id1 + randint(0, step) + 1
-
-        elif strategy == "-" and step > 0:
-            new_id = id1
-            while id1 == new_id or id2 == new_id:
-                new_id = id2 - randint(0, step)
+                del self._chars[c]
+                del self._maxes[c]
+                self._sizes = None
+            i = 0
+        self._length -= end - start
+
+    def _add_batch(self, vals, keys):
+        codes = list(map(_pack, keys))
+        if len(codes) * 4 < self._length:
+            for key, code in zip(keys, codes):
+                self._insert_codes(self._locate(key)[0], [code])
+                if code & 1:
+                    self._add_deep([key])
         else:
-            raise Exception("new level failure")
+            # equal codes are interchangeable, their order is kept in _deep
+            self._set_codes(array("Q", sorted(chain(chain(*self._chars), codes))))
+            self._add_deep(compress(keys, map(and_, codes, repeat(1))))
 
-        return new_id
+        self._newlines.update(
+            Character._from_key(val, key) for val, key in zip(vals, keys) if val == "\n"
+        )
+        runs = self._runs(vals, map(self.offset_of, keys))
+        self._text.insert_runs(runs)
+        return runs
 
-    def get_strategy(self, depth):
-        if depth not in self._id_strategy:
-            self._id_strategy[depth] = "+" if randint(0, 2) == 0 else "-"
-        return self._id_strategy[depth]
+    def _remove_batch(self, keys, runs):
+        if len(runs) * 4 < self._length:
+            for offset, chars in reversed(runs):
+                self._remove_codes(offset, offset + len(chars))
+        else:
+            codes = array("Q", chain(*self._chars))
+            kept = array("Q")
+            at = 0
+            for offset, chars in runs:
+                kept.extend(codes[at:offset])
+                at = offset + len(chars)
+            kept.extend(codes[at:])
+            self._set_codes(kept)
 
+        self._text.delete_runs(runs)
+        if self._deep:
+            self._remove_deep(keys)
 
-if __name__ == "__main__":
-    # For unit tests
-    pass
+    def _insert_key(self, val, key):
+        """
+        Adds the character val with the identifier key. Returns the new Character, or
+        None if key is already in the document.
+        """
+        rank, code, exact = self._locate(key)
+        if exact:
+            return None
+
+        self._insert_codes(rank, [code])
+        if code & 1:
+            self._add_deep([key])
+        self._text.insert(rank, val)
+        char = Character._from_key(val, key)
+        self._link(char)
+        return char
+
+    def insert(self, val, prev_char=None, succ_char=None):
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+        return self._insert_key(val, self._new_key(prev_key, succ_key))
+
+    def insert_by_id(self, val, id):
+        id = self._intern(id)
+        if id in self._deleted:
+            return None
+        return self._insert_key(val, id)
+
+    def insert_text(self, text, prev_char=None, succ_char=None):
+        if not text:
+            return []
+
+        prev_key = prev_char._key if prev_char != None else self.empty_start._key
+        succ_key = succ_char._key if succ_char != None else self.empty_end._key
+        first = self._new_key(prev_key, succ_key)
+        keys = [first]
+        keys.extend(first + (i, self.siteID) for i in range(1, len(text)))
+
+        rank = self._locate(first)[0]
+        codes = list(map(_pack, keys))
+        self._insert_codes(rank, codes)
+        self._add_deep(compress(keys, map(and_, codes, repeat(1))))
+        self._text.insert(rank, text)
+
+        chars = list(map(Character._from_key, text, keys))
+        self._newlines.update(char for char in chars if char._val == "\n")
+        return chars
+
+    def delete_by_id(self, id):
+        id = tuple(id)
+        rank, _, exact = self._locate(id)
+        if not exact:
+            self._deleted.add(self._intern(id))
+            return None
+
+        char = Character._from_key(self._text.slice(rank, rank + 1), id)
+        self._remove(rank, rank + 1, [id])
+        self._unlink(char)
+        return char
+
+    def delete_range(self, start_id, end_id):
+        start = self._locate(tuple(start_id))[0]
+        rank, _, exact = self._locate(tuple(end_id))
+        end = rank + 1 if exact else rank
+        if start >= end:
+            return []
+
+        keys = list(self._iter_keys(start, end))
+        removed = list(map(Character._from_key, self._text.slice(start, end), keys))
+        self._remove(start, end, keys)
+        for char in removed:
+            self._unlink(char)
+        return removed
 
 
-# Unique id allocation - incomplete - based on LSEQ paper
 if __name__ == "__main__":
+    # For unit tests
     print("testing insert ...", end=" ")
     doc = CRDT_DOC()
 
@@ -211,25 +1850,457 @@ if __name__ == "__main__":
 
     # empty case
     assert doc.get_size() == 11
-    doc.delete_by_id([99, 99, 99])
+    assert doc.delete_by_id([99, 99, 99]) == None
     assert doc.get_size() == 11
     print("0", end=" ")
 
     # delete from begining
-    doc.delete_by_id(char1._pos)
+    doc.delete_by_id(char1._key)
     assert doc.get_size() == 10
     assert doc._chars[1]._val == "3"
     print("1", end=" ")
 
     # delete from end
-    doc.delete_by_id(char9._pos)
+    doc.delete_by_id(char9._key)
     assert doc.get_size() == 9
     assert doc._chars[doc.get_size() - 2]._val == "1"
     print("2", end=" ")
 
     # delete middle
-    doc.delete_by_id(char4._pos)
+    doc.delete_by_id(char4._key)
     assert doc.get_size() == 8
     assert doc._chars[3]._val == "x"
+    print("3", end=" ")
+
+    # deleting twice is a no-op
+    assert doc.delete_by_id(char4._key) == None
+    assert doc.get_size() == 8
+
+    # the document stays sorted after deletes
+    char10 = doc.insert("z", char3, char2)
+    assert doc._chars[4]._val == "z"
+    print("4")
+
+    print("testing delete range... ", end=" ")
+    # ['3', 'q', 'x', 'z', 'b', '2', '1']
+    removed = doc.delete_range(char3._key, char2._key)
+    assert [c._val for c in removed] == ["x", "z", "b"]
+    assert "".join(str(c) for c in doc._chars) == "3q21"
+    print("0", end=" ")
+
+    # sentinels are never deleted
+    doc.delete_range(doc.empty_start._key, doc.empty_end._key)
+    assert doc.get_size() == 2
+    assert len(doc._index) == 0
+    print("1")
+
+    print("testing line index... ", end=" ")
+    doc = CRDT_DOC()
+    prev = None
+    for c in "ab\ncd\n\nef":
+        prev = doc.insert(c, prev, None)
+    text = "ab\ncd\n\nef"
+
+    # every offset survives a round trip through a Tk index
+    for offset in range(len(text) + 1):
+        index = doc.offset_to_index(offset)
+        assert doc.index_to_offset(index) == offset
+    assert doc.offset_to_index(0) == "1.0"
+    assert doc.offset_to_index(4) == "2.1"
+    assert doc.offset_to_index(6) == "3.0"
+    assert doc.offset_to_index(len(text)) == "4.2"
+    print("0", end=" ")
+
+    # Tk clamps columns to the end of the line, and lines to the end of the text
+    assert doc.index_to_offset("1.99") == 2
+    assert doc.index_to_offset("0.0") == 0
+    assert doc.index_to_offset("99.0") == len(text)
+    print("1", end=" ")
+
+    # identifiers to and from indices
+    char_d = doc.char_at_index("2.1")
+    assert char_d._val == "d"
+    assert doc.index_of(char_d._key) == "2.1"
+    assert doc.char_at_index("4.2") == None
+    print("2", end=" ")
+
+    # the index follows deletes
+    doc.delete_by_id(doc.char_at_index("1.2")._key)
+    assert doc.index_of(char_d._key) == "1.3"
+    assert doc.char_at_index("3.1")._val == "f"
+    print("3")
+
+    print("testing bulk load... ", end=" ")
+    text = "def f(x):\n    return x * 2\n" * 50
+    doc = CRDT_DOC.from_text(text, siteID=3)
+    assert "".join(str(c) for c in doc._chars) == text
+    assert doc.get_size() == len(text) + 2
+    print("0", end=" ")
+
+    # evenly spaced, sorted and as shallow as possible
+    keys = [c._key for c in doc._chars]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+    assert max(len(c._pos) for c in doc._chars) == 3
+    print("1", end=" ")
+
+    # the indices are built too
+    assert doc.char_at_index("2.4")._val == "r"
+    assert doc.index_to_offset("51.0") == len(text) // 2
+    print("2", end=" ")
+
+    # and deleted from like any other document
+    doc.delete_by_id(doc.char_at(0)._key)
+    assert doc.get_size() == len(text) + 1
+    assert CRDT_DOC.from_text("").get_size() == 2
+    print("3")
+
+    print("testing blocks... ", end=" ")
+    text = "ab\ncd\n"
+    doc = CRDT_BLOCK_DOC.from_text(text, siteID=1)
+    assert doc.node_count() == 1
+    assert doc.char_at_index("2.1")._val == "d"
+    print("0", end=" ")
+
+    # typing after our own characters extends the run
+    prev = doc.char_at(len(text) - 1)
+    for c in "ef":
+        prev = doc.insert(c, prev, None)
+    assert doc.node_count() == 1
+    assert doc.get_size() == len(text) + 4
+    print("1", end=" ")
+
+    # inserting and deleting in the middle split the run
+    doc.insert("x", doc.char_at(0), doc.char_at(1))
+    assert str(doc) == str(["", "a", "x", "b", "\n", "c", "d", "\n", "e", "f", ""])
+    assert doc.node_count() == 3
+    doc.delete_by_id(doc.char_at_index("2.1")._key)
+    assert doc.node_count() == 4
+    assert doc.index_to_offset("3.1") == 7
+    print("2", end=" ")
+
+    # a random edit history matches a plain list
+    import random
+
+    rand = random.Random(5)
+    model = list(text)
+    doc = CRDT_BLOCK_DOC.from_text(text, siteID=2)
+    cursor = 0
+    for _ in range(400):
+        if rand.random() < 0.1 or cursor > len(model):
+            cursor = rand.randint(0, len(model))
+        if rand.random() < 0.8:
+            val = rand.choice("ab \n")
+            prev = doc.char_at(cursor - 1) if cursor > 0 else None
+            doc.insert(val, prev, doc.char_at(cursor))
+            model.insert(cursor, val)
+            cursor += 1
+        elif model:
+            start = rand.randrange(len(model))
+            end = min(len(model), start + rand.randint(1, 4))
+            doc.delete_range(doc.char_at(start)._key, doc.char_at(end - 1)._key)
+            del model[start:end]
+    assert str(doc) == str([""] + model + [""])
+    keys = [doc.char_at(i)._key for i in range(len(model))]
+    assert keys == sorted(keys)
+    assert all(doc.offset_of(key) == i for i, key in enumerate(keys))
+    assert doc.node_count() < len(model)
+    print("3")
+
+    print("testing packed identifiers... ", end=" ")
+    rand = random.Random(7)
+    keys = [(1, 3), (1, 3, 0, 2), (1, 3, 5), (1, 1021, 2), (1, 1022, 2), (1, 5000, 2),
+            (2, 1, 2, 3, 4, 5), (2, 1, 2, 3, 4, 5, 6), (2, 1, 2, 3, 4, 6), (15, 0)]
+    keys += [tuple(rand.randint(0, 1100) for _ in range(rand.randint(2, 9)))
+             for _ in range(2000)]
+    # codes sort like the identifiers, up to the ones that share a code
+    assert sorted(keys) == sorted(keys, key=lambda key: (_pack(key), key))
+    assert all(_unpack(_pack(key)) == key for key in keys if not _pack(key) & 1)
+    assert _pack((1, 1021, 2)) & 1 == 0 and _pack((1, 1022, 2)) & 1
+    print("0", end=" ")
+
+    # a file loads into arrays, without a Character per character
+    text = "line\n" * (3 * PACKED_CHUNK)
+    doc = CRDT_PACKED_DOC.from_text(text, siteID=2)
+    assert len(doc._chars) > 1 and not doc._deep
+    assert list(doc._keys()) == CRDT_DOC.from_text(text, siteID=2)._balanced_keys(
+        len(text), 2
+    )
+    assert doc.index_to_offset("100.2") == 99 * 5 + 2
+    assert doc.line(3 * PACKED_CHUNK) == "line"
+    print("1", end=" ")
+
+    # a random edit history matches the object-based document, deep identifiers and
+    # long pastes included
+    doc = CRDT_PACKED_DOC.from_text("ab\ncd", siteID=3)
+    other = CRDT_DOC.from_text("ab\ncd", siteID=3)
+    # the edits come from rand, the identifiers from the module's generator
+    rand.seed(3)
+    random.seed(3)
+    for step in range(1500):
+        offset = rand.randint(0, other.text_length())
+        roll = rand.random()
+        if roll < 0.6:
+            # in the middle of the last inserts, which makes the identifiers deep
+            val = rand.choice("xy\n")
+            char = other.insert(val, other.char_at(offset - 1), other.char_at(offset))
+            assert doc.insert_by_id(val, char._key) != None
+        elif roll < 0.62:
+            chars = other.insert_text(
+                "p\n" * rand.randint(1, 1500), other.char_at(offset - 1),
+                other.char_at(offset),
+            )
+            for char in chars:
+                doc.insert_by_id(char._val, char._key)
+        elif offset < other.text_length():
+            end = min(other.text_length(), offset + rand.randint(1, 50))
+            removed = other.delete_range(other._key_at(offset), other._key_at(end - 1))
+            ids = [char._key for char in removed]
+            assert [char._key for char in doc.delete_range(ids[0], ids[-1])] == ids
+        if step % 100 == 0:
+            assert doc.get_state() == other.get_state()
+    assert doc._deep and len(doc._chars) > 1
+    assert doc.get_state() == other.get_state()
+    assert all(doc.offset_of(key) == i for i, key in enumerate(other._keys()))
+    assert all(
+        doc.offset_to_index(i) == other.offset_to_index(i)
+        for i in range(0, other.text_length(), 7)
+    )
+    print("2", end=" ")
+
+    # and it can be typed into directly
+    prev = doc.char_at(10)
+    for val in "typed":
+        prev = doc.insert(val, prev, doc.char_at(11))
+    assert doc.slice(11, 16) == "typed"
+    assert CRDT_PACKED_DOC.from_state(doc.get_state()).get_state() == doc.get_state()
+    doc.delete_range(doc.empty_start._key, doc.empty_end._key)
+    assert doc.get_size() == 2 and not doc._deep and doc._chars == []
+    print("3")
+
+    print("testing allocator... ", end=" ")
+    for allocator in (LSEQAllocator(), BoundaryAllocator(), BoundaryAllocator(strategy="-")):
+        doc = CRDT_DOC(siteID=3, allocator=allocator)
+        model = []
+        for _ in range(1000):
+            offset = rand.randint(0, len(model))
+            prev = doc.char_at(offset - 1) if offset > 0 else None
+            char = doc.insert("a", prev, doc.char_at(offset))
+            assert char._pos[-1] != 0
+            model.insert(offset, char._key)
+        assert [doc.char_at(i)._key for i in range(len(model))] == model
+    print("0", end=" ")
+
+    # characters that got the same position on two sites can still be split
+    allocator = LSEQAllocator()
+    for p, q in [((5, 1), (5, 2)), ((5, 40), (6, 3)), ((3, 5), (3, 5, 0, 1))]:
+        for _ in range(100):
+            assert p < tuple(allocator.between(p, q)) + (7,) < q
+    print("1", end=" ")
+
+    # the base doubles with every level
+    assert [allocator.base(d) for d in range(3)] == [16, 32, 64]
+    print("2")
+
+    print("testing remote ops... ", end=" ")
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        local = doc_class.from_text("ab\ncd", siteID=1)
+        remote = doc_class.from_state(local.get_state(), siteID=2)
+        assert remote.text() == "ab\ncd"
+        assert remote.get_state() == local.get_state()
+
+        prev = local.char_at(1)
+        succ = local.char_at(2)
+        ops = []
+        for val in "xyz":
+            prev = local.insert(val, prev, succ)
+            ops.append((val, prev._key))
+
+        # duplicated and out of order inserts end up in the same place
+        for val, key in reversed(ops + ops):
+            remote.insert_by_id(val, key)
+        assert remote.text() == local.text() == "abxyz\ncd"
+        assert remote.index_of(ops[0][1]) == "1.2"
+
+        # so do deletes, including ones for characters that are already gone
+        key = ops[1][1]
+        local.delete_by_id(key)
+        assert remote.delete_by_id(key) != None
+        assert remote.delete_by_id(key) == None
+        assert not remote.has_id(key) and remote.has_id(ops[0][1])
+        assert remote.get_state() == local.get_state()
+
+        # until the delete is forgotten
+        assert key in remote.deleted_ids()
+        remote.forget_deleted([list(key)])
+        assert key not in remote.deleted_ids()
+        remote.insert_by_id("y", key)
+        assert remote.text() == "abxyz\ncd"
+    print("0")
+
+    print("testing text... ", end=" ")
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        model = "first\nsecond\n" * 100
+        doc = doc_class.from_text(model, siteID=4)
+        for _ in range(300):
+            offset = rand.randint(0, len(model))
+            if rand.random() < 0.7:
+                val = rand.choice("ab\n")
+                doc.insert(val, doc.char_at(offset - 1), doc.char_at(offset))
+                model = model[:offset] + val + model[offset:]
+            elif offset < len(model):
+                end = min(len(model), offset + rand.randint(1, 700))
+                doc.delete_range(doc.char_at(offset)._key, doc.char_at(end - 1)._key)
+                model = model[:offset] + model[end:]
+            start = rand.randint(0, len(model))
+            assert doc.slice(start, start + 50) == model[start : start + 50]
+        assert doc.text() == model
+        lines = model.split("\n")
+        assert [doc.line(i + 1) for i in range(len(lines))] == lines
+    print("0", end=" ")
+
+    # chunks are split and merged away as the text grows and shrinks
+    text = TextBuffer()
+    text.insert(0, "x" * 5 * TEXT_CHUNK)
+    assert text.slice(TEXT_CHUNK - 2, TEXT_CHUNK + 2) == "xxxx"
+    text.insert(TEXT_CHUNK, "y")
+    assert len(text._chunks) > 1
+    text.delete(0, len(text))
+    assert text.text() == "" and text._chunks == []
+    text.insert(0, "z")
+    assert text.text() == "z"
+    print("1")
+
+    print("testing insert text... ", end=" ")
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        doc = doc_class.from_text("ab\ncd", siteID=5)
+        remote = doc_class.from_state(doc.get_state(), siteID=6)
+        pasted = "x\n" * BLOCK_SIZE
+        chars = doc.insert_text(pasted, doc.char_at(1), doc.char_at(2))
+        assert [char._val for char in chars] == list(pasted)
+        assert doc.text() == "ab" + pasted + "\ncd"
+        keys = [doc.char_at(i)._key for i in range(doc.text_length())]
+        assert keys == sorted(keys) and keys[2 : 2 + len(pasted)] == [c._key for c in chars]
+        assert doc.line(BLOCK_SIZE + 1) == "" and doc.line(BLOCK_SIZE + 2) == "cd"
+        print("0", end=" ")
+
+        # the run can be typed into, deleted from and sent to another replica
+        typed = doc.insert("y", chars[9], chars[10])
+        doc.delete_range(chars[3]._key, chars[5]._key)
+        assert doc.text() == "ab" + pasted[:3] + pasted[6:10] + "y" + pasted[10:] + "\ncd"
+        for char in reversed(chars):
+            remote.insert_by_id(char._val, char._key)
+        remote.insert_by_id("y", typed._key)
+        for char in chars[3:6]:
+            remote.delete_by_id(char._key)
+        assert remote.text() == doc.text()
+        assert doc.insert_text("") == []
+    print("1")
+
+    print("testing interned identifiers... ", end=" ")
+    import json
+
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        doc = doc_class(siteID=1)
+        doc.insert("a")
+        prev = doc.insert("z", doc.char_at(0))
+        # inserting in the middle over and over makes the identifiers deep
+        for _ in range(100):
+            n = doc.text_length()
+            doc.insert("b", doc.char_at(n // 2 - 1), doc.char_at(n // 2))
+        state = json.loads(json.dumps(doc.get_state()))
+        remote = doc_class.from_state(state, siteID=2)
+        keys = list(remote._keys())
+        # the prefixes of remote identifiers share their digits (a block works out the
+        # last digit of its characters)
+        for key, other in zip(keys, keys[1:]):
+            assert all(a is b for a, b in zip(key[:-2], other[:-2]) if a == b)
+        assert remote.get_state() == doc.get_state()
+
+        assert max(max(key) for key in keys) > 256  # past the ints Python caches
+        later = json.loads(json.dumps(list(doc.insert("c", prev)._key)))
+        key = remote.insert_by_id("c", later)._key
+        assert all(digit is remote._digits[digit] for digit in key[:-2])
+        assert remote.text() == doc.text()
+
+    # deep identifiers share their prefix in chunks, and their nodes sort like them
+    doc = CRDT_DOC(siteID=1)
+    prefix = [random.randint(0, 1000) for _ in range(KEY_HEAD + 3 * KEY_CHUNK**2)]
+    keys = [tuple(prefix[: random.randint(0, len(prefix))]) for _ in range(200)]
+    keys = [key + (random.randint(0, 9), 1) for key in keys]
+    nodes = list(map(doc._node, keys))
+    assert [doc._flat(node) for node in nodes] == keys
+    order = sorted(range(200), key=keys.__getitem__)
+    assert sorted(range(200), key=nodes.__getitem__) == order
+    # the prefix fills the first group of these
+    deep = [n for n, k in zip(nodes, keys) if len(k) > KEY_HEAD + KEY_CHUNK**2 + 2]
+    assert deep and all(node[KEY_HEAD] is deep[0][KEY_HEAD] for node in deep)
+    print("1")
+
+    print("testing batches... ", end=" ")
+    # runs of text go into and out of a buffer together, a few or many at once
+    for count in (3, 3 * TEXT_CHUNK):
+        model = "abc\n" * TEXT_CHUNK
+        text = TextBuffer(model)
+        runs = []
+        for offset in sorted(rand.sample(range(len(model)), count)):
+            runs.append((offset + sum(len(run) for _, run in runs), "x\n"))
+        for offset, run in runs:
+            model = model[:offset] + run + model[offset:]
+        text.insert_runs(runs)
+        assert text.text() == model
+        text.delete_runs(runs)
+        assert text.text() == "abc\n" * TEXT_CHUNK
+    print("0", end=" ")
+
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        # a few operations, and enough of them to rebuild the whole document
+        for num_edits in (5, 1000):
+            local = doc_class.from_text("first\nsecond\n" * 50, siteID=1)
+            state = local.get_state()
+            inserted, deleted = [], []
+            for _ in range(num_edits):
+                offset = rand.randint(0, local.text_length())
+                chars = local.insert_text(
+                    rand.choice(["a", "b\n", "cd"]),
+                    local.char_at(offset - 1) if offset > 0 else None,
+                    local.char_at(offset),
+                )
+                inserted += [(char._val, char._key) for char in chars]
+                if rand.random() < 0.4:
+                    key = local.char_at(rand.randrange(local.text_length()))._key
+                    local.delete_by_id(key)
+                    deleted.append(key)
+
+            # deletes of characters whose inserts are in the same batch are remembered,
+            # and duplicates are left out
+            rand.shuffle(inserted)
+            remote = doc_class.from_state(state, siteID=2)
+            assert remote.delete_batch(deleted + deleted[:3]) != []
+            before = remote.text()
+            runs = remote.insert_batch(
+                [val for val, _ in inserted + inserted[:3]],
+                [key for _, key in inserted + inserted[:3]],
+            )
+            assert remote.text() == local.text()
+            assert list(remote._keys()) == list(local._keys())
+            assert remote.line(2) == local.line(2)
+            for offset, run in runs:
+                before = before[:offset] + run + before[offset:]
+            assert before == remote.text()
+            assert remote.insert_batch(*zip(*inserted)) == []
+
+            # the runs deleted are where they were before the delete
+            keys = rand.sample(list(remote._keys()), num_edits // 2 + 1)
+            before = remote.text()
+            for offset, run in reversed(remote.delete_batch(keys)):
+                assert before[offset : offset + len(run)] == run
+                before = before[:offset] + before[offset + len(run) :]
+            for key in keys:
+                local.delete_by_id(key)
+            assert before == remote.text() == local.text()
+            assert remote.get_state() == local.get_state()
+            lines = local.text().split("\n")
+            assert [remote.line(i + 1) for i in range(len(lines))] == lines
+    print("1")
 
     print(doc)
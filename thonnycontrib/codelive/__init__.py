@@ -17,7 +17,6 @@ from thonnycontrib.codelive.views.create_session import CreateSessionDialog
 from thonnycontrib.codelive.views.join_session import JoinSessionDialog
 from thonnycontrib.codelive.views.toolbar_popup import ToolbarPopup
 
-import thonnycontrib.codelive.patched_callbacks as pc
 import thonnycontrib.codelive.utils as utils
 
 BUG_REPORT_URL = "https://github.com/codelive-project/codelive/issues/new"
@@ -62,11 +61,18 @@ def create_session_vanilla(data=None):
         "shared_editors": WORKBENCH.get_editor_notebook().winfo_children(),
     }
 
+    resume = Session.can_resume(data_session["topic"]) and tk.messagebox.askyesno(
+        parent=WORKBENCH,
+        title="Resume Session",
+        message="A session on this topic didn't end properly. "
+        "Resume its documents from where they were left?",
+    )
     session = Session.create_session(
         name=data_session["name"],
         topic=data_session["topic"],
         broker=data_session["broker"],
         shared_editors=data_session["shared_editors"],
+        resume=resume,
     )
     session.start()
     get_workbench().bind("CoLiveSessionEnd", cleanup)
@@ -352,6 +358,3 @@ def add_menu_items():
 
 def load_plugin():
     add_menu_items()
-
-    EnhancedText.insert = pc.patched_insert
-    EnhancedText.delete = pc.patched_delete
@@ -0,0 +1,74 @@
+"""
+Measures identifier length under front, back and random insertion for each
+identifier allocator.
+
+    python -m thonnycontrib.codelive.bench.allocator [num_inserts ...]
+
+A single boundary strategy grows identifiers linearly when inserting against it
+(boundary+ at the front, boundary- at the back), which is why LSEQ mixes them.
+"""
+import math
+import random
+import sys
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC, LSEQAllocator, BoundaryAllocator
+
+DEFAULT_SIZES = [1000, 10000]
+SEED = 1234
+
+ALLOCATORS = {
+    "lseq": LSEQAllocator,
+    "boundary+": lambda: BoundaryAllocator(strategy="+"),
+    "boundary-": lambda: BoundaryAllocator(strategy="-"),
+}
+
+WORKLOADS = {
+    "front": lambda rand, size: 0,
+    "back": lambda rand, size: size,
+    "random": lambda rand, size: rand.randint(0, size),
+}
+
+
+def run(allocator, workload, num_inserts, seed=SEED):
+    rand = random.Random(seed)
+    random.seed(seed)  # the allocators draw from the module's generator
+    doc = CRDT_DOC(allocator=allocator)
+
+    for size in range(num_inserts):
+        offset = workload(rand, size)
+        prev = doc.char_at(offset - 1) if offset > 0 else None
+        doc.insert("a", prev, doc.char_at(offset))
+
+    lengths = [len(doc.char_at(i)._pos) for i in range(num_inserts)]
+    return sum(lengths) / num_inserts, max(lengths)
+
+
+def main(sizes=DEFAULT_SIZES):
+    results = []
+    print(
+        "%-10s %-7s %8s %8s %5s %7s"
+        % ("allocator", "load", "inserts", "avg", "max", "log2(n)")
+    )
+    for num_inserts in sizes:
+        for alloc_name, allocator in ALLOCATORS.items():
+            for load_name, workload in WORKLOADS.items():
+                avg, longest = run(allocator(), workload, num_inserts)
+                results.append(
+                    {
+                        "allocator": alloc_name,
+                        "workload": load_name,
+                        "inserts": num_inserts,
+                        "avg_length": avg,
+                        "max_length": longest,
+                    }
+                )
+                print(
+                    "%-10s %-7s %8d %8.2f %5d %7.1f"
+                    % (alloc_name, load_name, num_inserts, avg, longest,
+                       math.log2(num_inserts))
+                )
+    return results
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,123 @@
+"""
+Compares the node count and memory of CRDT_BLOCK_DOC against one Character per
+character (CRDT_DOC) on the plugin's own Python sources.
+
+    python -m thonnycontrib.codelive.bench.blocks
+
+"load" shares the files at session start, "typing" types them out from scratch
+while fixing typos and going back to add lines now and then.
+"""
+import glob
+import os
+import random
+import tracemalloc
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC, CRDT_BLOCK_DOC
+
+CODELIVE_PATH = os.path.dirname(os.path.dirname(__file__))
+SEED = 1234
+TYPO_RATE = 0.02
+JUMP_RATE = 0.01
+
+
+def sample_text():
+    text = []
+    for path in sorted(glob.glob(os.path.join(CODELIVE_PATH, "*.py"))):
+        with open(path, encoding="UTF-8") as file:
+            text.append(file.read())
+    return "\n".join(text)
+
+
+def type_out(doc, text, seed=SEED):
+    """
+    Types text into doc a character at a time, like a student would
+    """
+    rand = random.Random(seed)
+    lines = text.splitlines(True)
+    typed_lines = 0
+    cursor = 0
+
+    for line in lines:
+        if typed_lines > 10 and rand.random() < JUMP_RATE * len(line):
+            # go back to an earlier line and add a comment there
+            line_no = rand.randint(1, typed_lines)
+            at = doc.index_to_offset("%d.0" % line_no)
+            for val in "# note\n":
+                prev = doc.char_at(at - 1) if at > 0 else None
+                doc.insert(val, prev, doc.char_at(at))
+                at += 1
+            cursor = doc.text_length()
+
+        for val in line:
+            if rand.random() < TYPO_RATE:
+                typo = doc.insert("x", doc.char_at(cursor - 1), None)
+                doc.delete_by_id(typo._key)
+            prev = doc.char_at(cursor - 1) if cursor > 0 else None
+            doc.insert(val, prev, None)
+            cursor += 1
+        typed_lines += 1
+
+    return doc
+
+
+def measure(build):
+    tracemalloc.start()
+    doc = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return doc, size
+
+
+def per_character_copy(doc):
+    """
+    Returns a CRDT_DOC holding one Character per character of doc, with the same
+    identifiers
+    """
+    copy = CRDT_DOC(siteID=doc.siteID)
+    copy._chars = copy._from_keys(doc.text(), doc._keys())
+    return copy
+
+
+def run(name, build_blocks):
+    block_doc, block_mem = measure(build_blocks)
+    text = "".join(str(b) for b in block_doc._chars)
+
+    char_doc, char_mem = measure(lambda: per_character_copy(block_doc))
+
+    char_nodes = char_doc.get_size() - 2
+    block_nodes = block_doc.node_count()
+    return {
+        "workload": name,
+        "chars": len(text),
+        "char_nodes": char_nodes,
+        "block_nodes": block_nodes,
+        "node_ratio": char_nodes / block_nodes,
+        "char_bytes": char_mem,
+        "block_bytes": block_mem,
+        "memory_ratio": char_mem / block_mem,
+    }
+
+
+def main():
+    text = sample_text()
+    results = [
+        run("load", lambda: CRDT_BLOCK_DOC.from_text(text)),
+        run("typing", lambda: type_out(CRDT_BLOCK_DOC(siteID=1), text)),
+    ]
+
+    print(
+        "%-8s %8s %10s %10s %7s %12s %12s %7s"
+        % ("workload", "chars", "char_nodes", "blk_nodes", "ratio", "char_bytes",
+           "blk_bytes", "ratio")
+    )
+    for r in results:
+        print(
+            "%-8s %8d %10d %10d %7.1f %12d %12d %7.1f"
+            % (r["workload"], r["chars"], r["char_nodes"], r["block_nodes"],
+               r["node_ratio"], r["char_bytes"], r["block_bytes"], r["memory_ratio"])
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
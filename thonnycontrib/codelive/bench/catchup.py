@@ -0,0 +1,82 @@
+"""
+Measures catching a replica up on the operations it missed, one operation at a time
+with insert_by_id and delete_by_id, and in two batches with delete_batch and
+insert_batch the way Session._integrate_released does. Both find the offsets of what
+changed, which the text widget is updated at.
+
+    python -m thonnycontrib.codelive.bench.catchup [num_ops ...]
+
+The operations are random edits of the sample text by another site, applied to a
+replica loaded with the text as it was before them.
+"""
+import random
+import sys
+import time
+
+from thonnycontrib.codelive.bench.blocks import sample_text
+from thonnycontrib.codelive.bench.crdt import DOCS, random_trace
+from thonnycontrib.codelive.bench.journal import to_ops
+
+DEFAULT_SIZES = [1000, 5000, 20000]
+SEED = 1234
+
+
+def missed_ops(doc_class, num_ops):
+    random.seed(SEED)  # the allocators draw from the module's generator
+    doc = doc_class.from_text(sample_text(), siteID=1)
+    ops = list(to_ops(doc, random_trace(sample_text(), num_ops)))
+    return ops, doc.text()
+
+
+def one_at_a_time(doc, ops):
+    for op in ops:
+        if op["type"] == "I":
+            for val, key in zip(op["text"], op["keys"]):
+                if doc.insert_by_id(val, key) != None:
+                    doc.offset_of(key)
+        else:
+            for key in op["keys"]:
+                if doc.has_id(key):
+                    doc.offset_of(key)
+                doc.delete_by_id(key)
+
+
+def batched(doc, ops):
+    doc.delete_batch([key for op in ops if op["type"] == "D" for key in op["keys"]])
+    inserts = [op for op in ops if op["type"] == "I"]
+    doc.insert_batch(
+        "".join(op["text"] for op in inserts),
+        [key for op in inserts for key in op["keys"]],
+    )
+
+
+def run(num_ops, doc_name, doc_class):
+    ops, text = missed_ops(doc_class, num_ops)
+    result = {"ops": len(ops), "doc": doc_name}
+    for name, apply in (("single", one_at_a_time), ("batch", batched)):
+        # the identifiers from_text gives are the same on every replica
+        doc = doc_class.from_text(sample_text(), siteID=2)
+        start = time.perf_counter()
+        apply(doc, ops)
+        result[name + "_sec"] = time.perf_counter() - start
+        assert doc.text() == text
+    result["speedup"] = result["single_sec"] / result["batch_sec"]
+    return result
+
+
+def main(sizes=DEFAULT_SIZES):
+    results = []
+    print("%7s %-7s %10s %10s %8s" % ("ops", "doc", "single", "batch", "speedup"))
+    for num_ops in sizes:
+        for doc_name, doc_class in DOCS.items():
+            r = run(num_ops, doc_name, doc_class)
+            results.append(r)
+            print(
+                "%7d %-7s %10.4f %10.4f %8.1f"
+                % (r["ops"], r["doc"], r["single_sec"], r["batch_sec"], r["speedup"])
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,93 @@
+"""
+Compares the memory footprint and insert throughput of CRDT.Character against the
+list based class it replaced.
+
+    python -m thonnycontrib.codelive.bench.character [num_chars]
+"""
+import random
+import sys
+import time
+import tracemalloc
+
+from sortedcontainers import SortedList
+
+from thonnycontrib.codelive.CRDT import Character, _sort_key
+
+DEFAULT_NUM_CHARS = 200000  # roughly a 5,000 line file
+MAX_DEPTH = 6
+SEED = 1234
+
+
+class LegacyCharacter:
+    """The Character class as it was before __slots__ and tuple keys"""
+
+    def __init__(self, val, pos, author):
+        self._val = val
+        self._pos = pos
+        self._author = author
+
+    def __lt__(self, other):
+        if self._pos == None or other._pos == None:
+            raise Exception("Can not compare uninitialized variables:", self, other)
+        return (self._pos + [self._author]) < (other._pos + [other._author])
+
+
+def random_positions(n, seed=SEED):
+    rand = random.Random(seed)
+    return [
+        [rand.randint(1, 2 ** (4 + d)) for d in range(rand.randint(1, MAX_DEPTH))]
+        for _ in range(n)
+    ]
+
+
+def measure_memory(cls, positions):
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    chars = [cls("a", pos, 1) for pos in positions]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # positions are allocated outside of the measurement, but LegacyCharacter keeps a
+    # reference to them, so they have to be accounted for
+    if cls is LegacyCharacter:
+        end += sum(sys.getsizeof(pos) for pos in positions)
+
+    del chars
+    return (end - start) / len(positions)
+
+
+def measure_inserts(doc, cls, positions):
+    chars = [cls("a", pos, 1) for pos in positions]
+
+    start = time.perf_counter()
+    for char in chars:
+        doc.add(char)
+    elapsed = time.perf_counter() - start
+
+    return len(chars) / elapsed
+
+
+def main(num_chars=DEFAULT_NUM_CHARS):
+    positions = random_positions(num_chars)
+
+    results = {
+        "legacy": (
+            measure_memory(LegacyCharacter, positions),
+            measure_inserts(SortedList(), LegacyCharacter, positions),
+        ),
+        "slots": (
+            measure_memory(Character, positions),
+            measure_inserts(SortedList(key=_sort_key), Character, positions),
+        ),
+    }
+
+    print("%d characters" % num_chars)
+    print("%-8s %14s %14s" % ("class", "bytes/char", "inserts/sec"))
+    for name, (mem, ops) in results.items():
+        print("%-8s %14.1f %14.0f" % (name, mem, ops))
+
+    return results
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_CHARS)
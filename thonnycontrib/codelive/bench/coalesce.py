@@ -0,0 +1,136 @@
+"""
+Counts the messages a typist sends with the operations coalesced (Coalescer) against
+one message per operation, and how long coalescing holds the operations back.
+
+    python -m thonnycontrib.codelive.bench.coalesce [--gap 70] [--max-delay 30 100 ...]
+
+The plugin's sources are typed out with the time between keys drawn around --gap
+milliseconds, with typos corrected by backspace, and the indentation after a newline
+inserted at once like Thonny's auto-indent does. For each max_delay it reports
+    messages   messages sent, and how many times fewer than one per operation
+    latency    milliseconds operations were held, on average and at most
+"""
+import argparse
+import heapq
+import itertools
+import random
+
+from thonnycontrib.codelive.coalesce import Coalescer, MAX_DELAY
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.bench.blocks import sample_text
+
+SEED = 1234
+NUM_KEYS = 5000
+TYPO_RATE = 0.02
+DEFAULT_GAP = 70
+DEFAULT_DELAYS = [MAX_DELAY, 100]
+
+
+def keystrokes(text, num_keys, gap, seed=SEED):
+    """
+    Yields (seconds, offset, deleted, text) edits of typing text
+    """
+    rand = random.Random(seed)
+    now = 0.0
+    offset = 0
+    lines = iter(text[:num_keys].split("\n"))
+    for i, line in enumerate(lines):
+        if i > 0:
+            now += rand.lognormvariate(0, 0.5) * gap / 1000
+            yield now, offset, 0, "\n"
+            offset += 1
+            indent = line[: len(line) - len(line.lstrip(" "))]
+            if indent:
+                yield now, offset, 0, indent
+                offset += len(indent)
+            line = line[len(indent) :]
+        for val in line:
+            now += rand.lognormvariate(0, 0.5) * gap / 1000
+            if rand.random() < TYPO_RATE:
+                yield now, offset, 0, "x"
+                now += rand.lognormvariate(0, 0.5) * 2 * gap / 1000
+                yield now, offset, 1, ""
+            yield now, offset, 0, val
+            offset += 1
+
+
+def run(num_keys, gap, max_delay):
+    random.seed(SEED)  # the allocators draw from the module's generator
+    doc = CRDT_DOC(siteID=1)
+    now = [0.0]
+    timers = []
+    ids = itertools.count()
+    sent = []
+    held = []
+    latencies = []
+
+    def send(op):
+        sent.append(op)
+        latencies.extend(now[0] - added for added in held)
+        held.clear()
+
+    def schedule(ms, callback):
+        heapq.heappush(timers, (now[0] + ms / 1000, next(ids), callback))
+
+    def advance(until):
+        while timers and timers[0][0] <= until:
+            now[0], _, callback = heapq.heappop(timers)
+            callback()
+        now[0] = until
+
+    outbox = Coalescer(
+        send, schedule, min_delay=min(1, max_delay), max_delay=max_delay,
+        clock=lambda: now[0]
+    )
+    num_ops = 0
+    for at, offset, deleted, text in keystrokes(sample_text(), num_keys, gap):
+        advance(at)
+        if deleted:
+            removed = doc.delete_range(doc._key_at(offset), doc._key_at(offset))
+            op = {"type": "D", "keys": [list(c._key) for c in removed], "deps": {}}
+        else:
+            prev = doc.char_at(offset - 1) if offset > 0 else None
+            chars = doc.insert_text(text, prev, doc.char_at(offset))
+            op = {"type": "I", "keys": [list(c._key) for c in chars], "text": text}
+        op.update({"doc": 0, "user_pos": "1.0"})
+        num_ops += 1
+        held.append(now[0])
+        outbox.add(op)
+        if len(outbox) == 0:
+            # squashed away, nothing is sent for it
+            held.clear()
+    advance(float("inf"))
+
+    return {
+        "ops": num_ops,
+        "max_delay_ms": max_delay,
+        "messages": len(sent),
+        "reduction": num_ops / len(sent),
+        "mean_latency_ms": 1000 * sum(latencies) / len(latencies),
+        "max_latency_ms": 1000 * max(latencies),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--keys", type=int, default=NUM_KEYS)
+    parser.add_argument("--gap", type=float, default=DEFAULT_GAP, help="ms between keys")
+    parser.add_argument("--max-delay", type=int, nargs="*", default=DEFAULT_DELAYS)
+    args = parser.parse_args(args)
+
+    results = []
+    print("%6s %6s %8s %9s %8s %8s" % ("ops", "delay", "messages", "reduction",
+                                        "mean_ms", "max_ms"))
+    for max_delay in args.max_delay:
+        r = run(args.keys, args.gap, max_delay)
+        results.append(r)
+        print(
+            "%6d %6d %8d %9.1f %8.1f %8.1f"
+            % (r["ops"], r["max_delay_ms"], r["messages"], r["reduction"],
+               r["mean_latency_ms"], r["max_latency_ms"])
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Replays editing traces against the CRDT documents and reports how fast and how big
+they get.
+
+    python -m thonnycontrib.codelive.bench.crdt [--out results.json] [trace.json ...]
+
+A trace is a list of (offset, deleted, text) patches: delete that many characters at
+offset, then insert text there. Recorded traces can be given as JSON files, either a
+plain list of patches or the {"txns": [{"patches": [...]}, ...]} layout of the
+published editing traces. The synthetic ones are
+
+    typing   the plugin's sources typed out a character at a time, with typos
+    random   single characters inserted and deleted anywhere
+    prepend  text typed at the start of the document, the worst case for identifiers
+    paste    large blocks pasted and cut at random places
+
+The results are printed and written as JSON, so runs can be compared across changes.
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC
+from thonnycontrib.codelive.bench.blocks import sample_text
+
+SEED = 1234
+TYPO_RATE = 0.02
+NUM_TYPING = 5000
+NUM_RANDOM = 5000
+NUM_PREPEND = 3000
+NUM_PASTES = 100
+
+DOCS = {
+    "chars": CRDT_DOC,
+    "blocks": CRDT_BLOCK_DOC,
+    "packed": CRDT_PACKED_DOC,
+}
+
+
+def typing_trace(text, num_ops=NUM_TYPING, seed=SEED):
+    rand = random.Random(seed)
+    trace = []
+    for offset, val in enumerate(text[:num_ops]):
+        if rand.random() < TYPO_RATE:
+            trace.append((offset, 0, "x"))
+            trace.append((offset, 1, ""))
+        trace.append((offset, 0, val))
+    return trace
+
+
+def random_trace(text, num_ops=NUM_RANDOM, seed=SEED):
+    rand = random.Random(seed)
+    trace = []
+    length = 0
+    for _ in range(num_ops):
+        if length and rand.random() < 0.3:
+            trace.append((rand.randrange(length), 1, ""))
+            length -= 1
+        else:
+            trace.append((rand.randint(0, length), 0, rand.choice(text)))
+            length += 1
+    return trace
+
+
+def prepend_trace(text, num_ops=NUM_PREPEND):
+    # typed forwards, but always in front of what was typed before
+    trace = []
+    at = 0
+    for val in text[:num_ops]:
+        trace.append((at, 0, val))
+        at = 0 if val == "\n" else at + 1
+    return trace
+
+
+def paste_trace(text, num_ops=NUM_PASTES, seed=SEED):
+    rand = random.Random(seed)
+    trace = []
+    length = 0
+    for _ in range(num_ops):
+        if length > 2000 and rand.random() < 0.25:
+            start = rand.randrange(length)
+            count = min(rand.randint(100, 2000), length - start)
+            trace.append((start, count, ""))
+            length -= count
+        else:
+            start = rand.randrange(len(text))
+            block = text[start : start + rand.randint(200, 5000)]
+            trace.append((rand.randint(0, length), 0, block))
+            length += len(block)
+    return trace
+
+
+def load_trace(path):
+    with open(path, encoding="UTF-8") as file:
+        data = json.load(file)
+    if isinstance(data, dict):
+        return [tuple(patch) for txn in data["txns"] for patch in txn["patches"]]
+    return [tuple(patch) for patch in data]
+
+
+def replay(doc, trace):
+    for offset, deleted, text in trace:
+        if deleted:
+            doc.delete_range(doc._key_at(offset), doc._key_at(offset + deleted - 1))
+        if text:
+            prev = doc.char_at(offset - 1) if offset > 0 else None
+            doc.insert_text(text, prev, doc.char_at(offset))
+    return doc
+
+
+def node_count(doc):
+    if isinstance(doc, CRDT_BLOCK_DOC):
+        return doc.node_count()
+    return doc.get_size() - 2
+
+
+def run(name, trace, doc_name, doc_class, seed=SEED):
+    random.seed(seed)  # the allocators draw from the module's generator
+    start = time.perf_counter()
+    doc = replay(doc_class(siteID=1), trace)
+    elapsed = time.perf_counter() - start
+
+    random.seed(seed)
+    tracemalloc.start()
+    replay(doc_class(siteID=1), trace)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the last digit of an identifier is its author
+    depths = [len(key) - 1 for key in doc._keys()] or [0]
+    return {
+        "trace": name,
+        "doc": doc_name,
+        "ops": len(trace),
+        "ops_per_sec": len(trace) / elapsed,
+        "peak_bytes": peak,
+        "avg_depth": sum(depths) / len(depths),
+        "max_depth": max(depths),
+        "chars": doc.text_length(),
+        "nodes": node_count(doc),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("traces", nargs="*", help="recorded traces as JSON")
+    parser.add_argument("--out", default="crdt_bench.json", help="JSON results file")
+    args = parser.parse_args(args)
+
+    text = sample_text()
+    traces = {
+        "typing": typing_trace(text),
+        "random": random_trace(text),
+        "prepend": prepend_trace(text),
+        "paste": paste_trace(text),
+    }
+    for path in args.traces:
+        traces[os.path.splitext(os.path.basename(path))[0]] = load_trace(path)
+
+    results = []
+    print(
+        "%-10s %-7s %7s %10s %12s %6s %4s %8s %8s"
+        % ("trace", "doc", "ops", "ops/sec", "peak_bytes", "avg_d", "max",
+           "chars", "nodes")
+    )
+    for name, trace in traces.items():
+        for doc_name, doc_class in DOCS.items():
+            r = run(name, trace, doc_name, doc_class)
+            results.append(r)
+            print(
+                "%-10s %-7s %7d %10.0f %12d %6.2f %4d %8d %8d"
+                % (r["trace"], r["doc"], r["ops"], r["ops_per_sec"], r["peak_bytes"],
+                   r["avg_depth"], r["max_depth"], r["chars"], r["nodes"])
+            )
+
+    with open(args.out, "w", encoding="UTF-8") as file:
+        json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
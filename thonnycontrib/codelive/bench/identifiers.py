@@ -0,0 +1,147 @@
+"""
+Measures the memory of the identifiers of a remote replica stored as they are decoded,
+with interned digits only (CRDT_DOC._intern) and as nodes that share their prefixes
+(CRDT_DOC._node), on a document typed by inserting in the middle over and over, where
+identifiers get deepest.
+
+    python -m thonnycontrib.codelive.bench.identifiers [num_inserts ...]
+
+"state" builds the replica from the JSON state handed to a joining peer, "ops"
+replays the inserts as they arrive over the network. "lookup" is the time taken to
+find the offset of every character, which is all identifier comparisons.
+
+Interning the digits saves their int objects, but every key is still a tuple of its
+depth, so the bytes per character grow with the depth. Nodes take about as many bytes
+per character at any depth.
+"""
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+
+DEFAULT_SIZES = [2000, 5000]
+SEED = 1234
+
+
+class DigitsDoc(CRDT_DOC):
+    """
+    A CRDT_DOC that stores its identifiers as flat tuples of interned digits
+    """
+
+    def _node(self, id):
+        return self._intern(id)
+
+    def _flat(self, node):
+        return node
+
+    def _public(self, char):
+        return char
+
+
+class PlainDoc(DigitsDoc):
+    """
+    A CRDT_DOC that stores its identifiers as they were decoded
+    """
+
+    def _intern(self, id):
+        return tuple(id)
+
+
+def middle_inserts(num_inserts, seed=SEED):
+    random.seed(seed)  # the allocators draw from the module's generator
+    rand = random.Random(seed)
+    doc = CRDT_DOC(siteID=1)
+    for _ in range(num_inserts):
+        size = doc.text_length()
+        offset = max(0, min(size, size // 2 + rand.randint(-5, 5)))
+        prev = doc.char_at(offset - 1) if offset > 0 else None
+        doc.insert("a", prev, doc.char_at(offset))
+    return doc
+
+
+def from_state(doc_class, data):
+    return doc_class.from_state(json.loads(data), siteID=2)
+
+
+def from_ops(doc_class, data):
+    doc = doc_class(siteID=2)
+    for val, key in json.loads(data):
+        doc.insert_by_id(val, key)
+    return doc
+
+
+def measure(build, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    doc = build(*args)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for key in list(doc._keys()):
+        doc.offset_of(key)
+    return size, elapsed, time.perf_counter() - start
+
+
+def run(num_inserts):
+    doc = middle_inserts(num_inserts)
+    keys = list(doc._keys())
+    depths = [len(key) - 1 for key in keys]
+    state = json.dumps(doc.get_state())
+    # in the order they were typed, more or less: shuffled like a network would
+    ops = [(doc.char_at(i)._val, key) for i, key in enumerate(keys)]
+    random.Random(SEED).shuffle(ops)
+    ops = json.dumps(ops)
+
+    results = []
+    for name, build, data in (("state", from_state, state), ("ops", from_ops, ops)):
+        plain_bytes, plain_build, plain_lookup = measure(build, PlainDoc, data)
+        digits_bytes, _, _ = measure(build, DigitsDoc, data)
+        bytes_, build_sec, lookup = measure(build, CRDT_DOC, data)
+        results.append(
+            {
+                "workload": name,
+                "inserts": num_inserts,
+                "avg_depth": sum(depths) / len(depths),
+                "max_depth": max(depths),
+                "plain_bytes": plain_bytes,
+                "digits_bytes": digits_bytes,
+                "node_bytes": bytes_,
+                "node_bytes_per_char": bytes_ / len(keys),
+                "memory_ratio": plain_bytes / bytes_,
+                "plain_build_sec": plain_build,
+                "node_build_sec": build_sec,
+                "plain_lookup_sec": plain_lookup,
+                "node_lookup_sec": lookup,
+            }
+        )
+    return results
+
+
+def main(sizes=DEFAULT_SIZES):
+    results = []
+    print(
+        "%-6s %7s %6s %5s %10s %10s %10s %6s %5s %7s %7s %7s %7s"
+        % ("load", "inserts", "avg_d", "max", "plain_B", "digits_B", "node_B",
+           "B/char", "ratio", "p_build", "n_build", "p_look", "n_look")
+    )
+    for num_inserts in sizes:
+        for r in run(num_inserts):
+            results.append(r)
+            print(
+                "%-6s %7d %6.1f %5d %10d %10d %10d %6d %5.2f %7.3f %7.3f %7.3f %7.3f"
+                % (r["workload"], r["inserts"], r["avg_depth"], r["max_depth"],
+                   r["plain_bytes"], r["digits_bytes"], r["node_bytes"],
+                   r["node_bytes_per_char"], r["memory_ratio"],
+                   r["plain_build_sec"], r["node_build_sec"],
+                   r["plain_lookup_sec"], r["node_lookup_sec"])
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,128 @@
+"""
+Measures what journaling a long session costs with and without snapshots: the
+operations of a typing trace go through a Journal the way Session._journal_op puts
+them, and the journal is then read back like when resuming.
+
+    python -m thonnycontrib.codelive.bench.journal [num_ops ...] [--every 5000]
+
+For each length it reports
+    file       bytes on disk when the session ends
+    capture    seconds the Tk thread spent taking snapshots, in total and at most
+    encode     seconds to encode the last snapshot, which the writer thread does
+    recover    seconds to rebuild the replica and the OpLog from the file
+    log        operations the OpLog keeps, which catch-ups can be served from
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import thonnycontrib.codelive.journal as journal
+import thonnycontrib.codelive.snapshot as snapshot
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.oplog import OpLog
+from thonnycontrib.codelive.bench.blocks import sample_text
+from thonnycontrib.codelive.bench.crdt import typing_trace
+
+SEED = 1234
+DEFAULT_SIZES = [10000, 40000]
+DOC_ID = 0
+
+
+def to_ops(doc, trace):
+    """
+    Applies trace to doc and yields the operations it makes, like Session._send_op
+    """
+    for offset, deleted, text in trace:
+        if deleted:
+            removed = doc.delete_range(
+                doc._key_at(offset), doc._key_at(offset + deleted - 1)
+            )
+            yield {"type": "D", "keys": [list(char._key) for char in removed]}
+        if text:
+            prev = doc.char_at(offset - 1) if offset > 0 else None
+            chars = doc.insert_text(text, prev, doc.char_at(offset))
+            yield {"type": "I", "keys": [list(char._key) for char in chars], "text": text}
+
+
+def run(num_ops, every, path):
+    random.seed(SEED)  # the allocators draw from the module's generator
+    text = sample_text()
+    doc = CRDT_DOC(siteID=1)
+    log = OpLog()
+    # no snapshots besides the first one when every is 0
+    _journal = journal.Journal(path, snapshot_ops=every or float("inf"))
+    _journal.snapshot(doc, log.version())
+
+    captures = []
+    start = time.perf_counter()
+    for op in to_ops(doc, typing_trace(text, num_ops)):
+        op.update({"doc": DOC_ID, "site": 1, "seq": log.next_seq(1), "deps": {}})
+        log.add(op)
+        _journal.append(op)
+        if _journal.due():
+            previous = _journal.snapshot_version
+            began = time.perf_counter()
+            _journal.snapshot(doc, log.version())
+            captures.append(time.perf_counter() - began)
+            log.compact(previous)
+    _journal.close()
+    elapsed = time.perf_counter() - start
+
+    began = time.perf_counter()
+    snapshot.encode(*snapshot.capture(doc))
+    encode = time.perf_counter() - began
+
+    began = time.perf_counter()
+    copy, copy_log = journal.load(path, DOC_ID)
+    recover = time.perf_counter() - began
+    assert copy.text() == doc.text() and copy_log.version() == log.version()
+
+    return {
+        "ops": log.version()[1],
+        "snapshot_every": every,
+        "chars": doc.text_length(),
+        "ops_per_sec": log.version()[1] / elapsed,
+        "file_bytes": os.path.getsize(path),
+        "snapshots": len(captures),
+        "capture_sec": sum(captures),
+        "max_capture_sec": max(captures, default=0.0),
+        "encode_sec": encode,
+        "recover_sec": recover,
+        "log_ops": sum(len(ops) for ops in log._ops.values()),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sizes", type=int, nargs="*", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--every", type=int, default=journal.SNAPSHOT_OPS, help="ops between snapshots"
+    )
+    args = parser.parse_args(args)
+
+    path = os.path.join(tempfile.mkdtemp(), "codelive", "0.log")
+    results = []
+    print(
+        "%7s %6s %7s %9s %10s %4s %8s %8s %8s %8s %7s"
+        % ("ops", "every", "chars", "ops/sec", "file", "snap", "capture", "max",
+           "encode", "recover", "log")
+    )
+    for num_ops in args.sizes:
+        for every in (0, args.every):
+            r = run(num_ops, every, path)
+            results.append(r)
+            print(
+                "%7d %6s %7d %9.0f %10d %4d %8.3f %8.4f %8.3f %8.3f %7d"
+                % (r["ops"], r["snapshot_every"] or "-", r["chars"], r["ops_per_sec"],
+                   r["file_bytes"], r["snapshots"], r["capture_sec"],
+                   r["max_capture_sec"], r["encode_sec"], r["recover_sec"],
+                   r["log_ops"])
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+Runs a whole session in one process: N replicas of a CRDT_DOC, each typed into by a
+simulated student, exchanging their operations over a fake network that delays,
+reorders, duplicates and loses messages. No broker is needed.
+
+    python -m thonnycontrib.codelive.bench.simulator [--sites 10 30 60] [--loss 0.1]
+
+Every operation is sent to every other site on its own, like a message through the
+broker, and lost operations are recovered the way the plugin does it after a
+reconnect: a site sends its version vector and gets back the operations it's missing.
+Here every site does that with a random peer every --sync seconds.
+
+For each session size it reports
+    converge   simulated seconds from the last edit until all replicas are the same
+    ops/sec    remote operations integrated per second of real time
+    behind     operations a replica was missing, averaged (and at worst) over time
+    messages   messages and bytes sent through the network, as JSON
+"""
+import argparse
+import heapq
+import json
+import random
+import time
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.oplog import OpLog
+from thonnycontrib.codelive.bench.blocks import sample_text
+
+SEED = 1234
+DOC_ID = 0
+# how often the replicas are compared, in simulated seconds
+SAMPLE_INTERVAL = 0.5
+# give up on converging this long after the last edit
+MAX_SETTLE = 120.0
+
+
+class Network:
+    """
+    Delivers messages after latency plus up to jitter seconds. With probability
+    reorder a message is held back for up to ten times the latency more, so it
+    arrives after later ones. Every delivery can also be lost or duplicated.
+    """
+
+    def __init__(
+        self, latency=0.05, jitter=0.02, reorder=0.0, duplicate=0.0, loss=0.0, seed=SEED
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.loss = loss
+        self._rand = random.Random(seed)
+        self.messages = 0
+        self.bytes = 0
+
+    def delays(self):
+        """
+        Returns the delays after which a message sent now arrives, one per copy
+        """
+        rand = self._rand
+        if rand.random() < self.loss:
+            return []
+        copies = 2 if rand.random() < self.duplicate else 1
+
+        delays = []
+        for _ in range(copies):
+            delay = self.latency + rand.uniform(0, self.jitter)
+            if rand.random() < self.reorder:
+                delay += rand.uniform(0, 10 * self.latency)
+            delays.append(delay)
+        return delays
+
+    def count(self, msg):
+        self.messages += 1
+        self.bytes += len(json.dumps(msg))
+
+
+class Site:
+    """
+    A replica and the student typing into it. The student types at a cursor, makes
+    typos, pastes now and then and sometimes moves elsewhere in the document.
+    """
+
+    def __init__(self, site_id, state, seed=SEED):
+        self.site_id = site_id
+        self.doc = CRDT_DOC.from_state(state, siteID=site_id)
+        self.log = OpLog()
+        self._rand = random.Random(seed * 1000 + site_id)
+        self._cursor = self._rand.randint(0, self.doc.text_length())
+
+    def edit(self, text):
+        doc, rand = self.doc, self._rand
+        length = doc.text_length()
+        if rand.random() < 0.05:
+            self._cursor = rand.randint(0, length)
+        self._cursor = min(self._cursor, length)
+
+        roll = rand.random()
+        if roll < 0.15 and self._cursor > 0:
+            # backspace over a few characters
+            start = max(0, self._cursor - rand.randint(1, 3))
+            removed = doc.delete_range(
+                doc._key_at(start), doc._key_at(self._cursor - 1)
+            )
+            self._cursor = start
+            op = {"type": "D", "keys": [list(char._key) for char in removed]}
+        else:
+            if roll > 0.98:
+                start = rand.randrange(len(text))
+                val = text[start : start + rand.randint(20, 400)]
+            else:
+                val = rand.choice(text)
+            prev = doc.char_at(self._cursor - 1) if self._cursor > 0 else None
+            chars = doc.insert_text(val, prev, doc.char_at(self._cursor))
+            self._cursor += len(val)
+            op = {"type": "I", "keys": [list(char._key) for char in chars], "text": val}
+
+        op["doc"] = DOC_ID
+        op["site"] = self.site_id
+        op["seq"] = self.log.next_seq(self.site_id)
+        self.log.add(op)
+        return op
+
+    def apply(self, op):
+        if not self.log.add(op):
+            return False
+
+        if op["type"] == "I":
+            for val, key in zip(op["text"], op["keys"]):
+                self.doc.insert_by_id(val, key)
+        else:
+            for key in op["keys"]:
+                self.doc.delete_by_id(key)
+        return True
+
+
+class Simulation:
+    def __init__(
+        self, num_sites, network, duration=20.0, rate=2.0, sync=1.0, seed=SEED
+    ):
+        self.network = network
+        self.duration = duration
+        self.rate = rate
+        self.sync = sync
+        self._rand = random.Random(seed)
+        self._text = sample_text()
+
+        random.seed(seed)  # the allocators draw from the module's generator
+        state = CRDT_DOC.from_text(self._text[:2000]).get_state()
+        self.sites = [Site(i + 1, state, seed) for i in range(num_sites)]
+
+        self._events = []
+        self._counter = 0
+        self.now = 0.0
+
+    def _schedule(self, at, kind, site, msg=None):
+        # the counter keeps events with the same time in the order they were made
+        self._counter += 1
+        heapq.heappush(self._events, (at, self._counter, kind, site, msg))
+
+    def _send(self, receiver, msg):
+        self.network.count(msg)
+        for delay in self.network.delays():
+            self._schedule(self.now + delay, "deliver", receiver, msg)
+
+    def _broadcast(self, sender, msg):
+        for site in self.sites:
+            if site is not sender:
+                self._send(site, msg)
+
+    def _next_edit(self, site):
+        at = self.now + self._rand.expovariate(self.rate)
+        if at < self.duration:
+            self._schedule(at, "edit", site)
+
+    def _deliver(self, site, msg):
+        if msg["type"] == "V":
+            ops = site.log.missing(msg["version"])
+            if ops:
+                self._send(self.sites[msg["site"] - 1], {"type": "C", "ops": ops})
+            return 0
+        if msg["type"] == "C":
+            return sum(site.apply(op) for op in msg["ops"])
+        return int(site.apply(msg))
+
+    def _converged(self):
+        version = self.sites[0].log.version()
+        if any(site.log.version() != version for site in self.sites):
+            return False
+        text = self.sites[0].doc.text()
+        return all(site.doc.text() == text for site in self.sites)
+
+    def _behind(self):
+        total = sum(site.log.next_seq(site.site_id) - 1 for site in self.sites)
+        return [total - sum(site.log.version().values()) for site in self.sites]
+
+    def run(self):
+        for site in self.sites:
+            self._next_edit(site)
+            self._schedule(self._rand.uniform(0, self.sync), "sync", site)
+        self._schedule(SAMPLE_INTERVAL, "sample", None)
+
+        behind = []
+        integrated = 0
+        converged_at = None
+        start = time.perf_counter()
+        while self._events:
+            self.now, _, kind, site, msg = heapq.heappop(self._events)
+            if kind == "edit":
+                self._broadcast(site, site.edit(self._text))
+                self._next_edit(site)
+            elif kind == "deliver":
+                integrated += self._deliver(site, msg)
+            elif kind == "sync":
+                peer = self._rand.choice(self.sites)
+                if peer is not site:
+                    version = site.log.version()
+                    msg = {"type": "V", "site": site.site_id, "version": version}
+                    self._send(peer, msg)
+                self._schedule(self.now + self.sync, "sync", site)
+            elif kind == "sample":
+                behind.extend(self._behind())
+                if self.now >= self.duration and self._converged():
+                    converged_at = self.now
+                    break
+                if self.now >= self.duration + MAX_SETTLE:
+                    break
+                self._schedule(self.now + SAMPLE_INTERVAL, "sample", None)
+        elapsed = time.perf_counter() - start
+
+        return {
+            "sites": len(self.sites),
+            "latency": self.network.latency,
+            "jitter": self.network.jitter,
+            "reorder": self.network.reorder,
+            "duplicate": self.network.duplicate,
+            "loss": self.network.loss,
+            "edits": sum(site.log.next_seq(site.site_id) - 1 for site in self.sites),
+            "converged": converged_at != None,
+            "convergence_sec": (
+                converged_at - self.duration if converged_at != None else None
+            ),
+            "integrated": integrated,
+            "ops_per_sec": integrated / elapsed,
+            "avg_behind": sum(behind) / len(behind),
+            "max_behind": max(behind),
+            "messages": self.network.messages,
+            "bytes": self.network.bytes,
+            "chars": self.sites[0].doc.text_length(),
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sites", type=int, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--duration", type=float, default=20.0, help="typing time")
+    parser.add_argument("--rate", type=float, default=2.0, help="edits/sec per site")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--reorder", type=float, default=0.1)
+    parser.add_argument("--duplicate", type=float, default=0.01)
+    parser.add_argument("--loss", type=float, default=0.01)
+    parser.add_argument("--sync", type=float, default=1.0, help="catch-up interval")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args(args)
+
+    results = []
+    print(
+        "%5s %6s %9s %10s %8s %8s %9s %11s"
+        % ("sites", "edits", "converge", "ops/sec", "behind", "max", "messages",
+           "bytes")
+    )
+    for num_sites in args.sites:
+        network = Network(
+            args.latency, args.jitter, args.reorder, args.duplicate, args.loss,
+            args.seed,
+        )
+        r = Simulation(
+            num_sites, network, args.duration, args.rate, args.sync, args.seed
+        ).run()
+        results.append(r)
+        print(
+            "%5d %6d %9s %10.0f %8.1f %8d %9d %11d"
+            % (r["sites"], r["edits"],
+               "%.2f" % r["convergence_sec"] if r["converged"] else "never",
+               r["ops_per_sec"], r["avg_behind"], r["max_behind"], r["messages"],
+               r["bytes"])
+        )
+
+    if args.out:
+        with open(args.out, "w", encoding="UTF-8") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares the size and the encode/decode time of binary snapshots against the JSON
+state (CRDT_DOC.get_state) on the plugin's own Python sources.
+
+    python -m thonnycontrib.codelive.bench.snapshot
+
+"load" shares the files at session start, "typing" types them out a character at a
+time, which gives deeper identifiers and more authors runs to encode.
+"""
+import json
+import time
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.bench.blocks import sample_text, type_out
+import thonnycontrib.codelive.snapshot as snapshot
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run(name, doc):
+    def json_dumps(doc):
+        return json.dumps(doc.get_state()).encode("utf-8")
+
+    def json_loads(data):
+        return CRDT_DOC.from_state(json.loads(data))
+
+    json_data, json_encode = timed(json_dumps, doc)
+    json_doc, json_decode = timed(json_loads, json_data)
+    snap_data, snap_encode = timed(snapshot.dumps, doc)
+    snap_doc, snap_decode = timed(snapshot.loads, snap_data)
+    assert json_doc.get_state() == snap_doc.get_state() == doc.get_state()
+
+    return {
+        "workload": name,
+        "chars": doc.text_length(),
+        "json_bytes": len(json_data),
+        "snapshot_bytes": len(snap_data),
+        "json_encode_sec": json_encode,
+        "snapshot_encode_sec": snap_encode,
+        "json_decode_sec": json_decode,
+        "snapshot_decode_sec": snap_decode,
+    }
+
+
+def main():
+    text = sample_text()
+    results = [
+        run("load", CRDT_DOC.from_text(text)),
+        run("typing", type_out(CRDT_DOC(siteID=1), text)),
+    ]
+
+    print(
+        "%-8s %8s %10s %10s %8s %8s %8s %8s"
+        % ("workload", "chars", "json_B", "snap_B", "json_enc", "snap_enc",
+           "json_dec", "snap_dec")
+    )
+    for r in results:
+        print(
+            "%-8s %8d %10d %10d %8.3f %8.3f %8.3f %8.3f"
+            % (r["workload"], r["chars"], r["json_bytes"], r["snapshot_bytes"],
+               r["json_encode_sec"], r["snapshot_encode_sec"], r["json_decode_sec"],
+               r["snapshot_decode_sec"])
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the messages of a typing session encoded by wire against JSON with
+UserEncoder, the way they were sent before it.
+
+    python -m thonnycontrib.codelive.bench.wire [--keys 5000]
+
+The plugin's sources are typed out one key at a time like in bench.coalesce, and each
+edit is put in the envelope MqttConnection.publish sends. It reports per message
+    bytes      the mean size
+    dumps_us   microseconds to encode
+    loads_us   microseconds to parse, which MqttConnection.on_message does per message
+"""
+import argparse
+import json
+import random
+import time
+
+import thonnycontrib.codelive.wire as wire
+
+from thonnycontrib.codelive.bench.blocks import sample_text
+from thonnycontrib.codelive.bench.coalesce import keystrokes, NUM_KEYS, SEED
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.user import UserDecoder, UserEncoder
+
+REPEAT = 5
+
+
+def typed_messages(num_keys):
+    random.seed(SEED)  # the allocators draw from the module's generator
+    doc = CRDT_DOC(siteID=3)
+    messages = []
+    for seq, (_, offset, deleted, text) in enumerate(
+        keystrokes(sample_text(), num_keys, gap=70), 1
+    ):
+        if deleted:
+            removed = doc.delete_range(doc._key_at(offset), doc._key_at(offset))
+            instr = {"type": "D", "keys": [list(c._key) for c in removed]}
+        else:
+            prev = doc.char_at(offset - 1) if offset > 0 else None
+            chars = doc.insert_text(text, prev, doc.char_at(offset))
+            instr = {"type": "I", "keys": [list(c._key) for c in chars], "text": text}
+        before = doc.text()[:offset]
+        user_pos = "%d.%d" % (before.count("\n") + 1, offset - before.rfind("\n") - 1)
+        instr.update({"user": 2, "user_pos": user_pos, "doc": 0,
+                      "site": 3, "seq": seq, "deps": {}})
+        messages.append({"id": 2, "instr": instr, "unique_code": None,
+                         "id_assigned": None})
+    return messages
+
+
+def measure(messages, dumps, loads):
+    encoded = [dumps(msg) for msg in messages]
+    best_dumps = best_loads = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for msg in messages:
+            dumps(msg)
+        best_dumps = min(best_dumps, time.perf_counter() - start)
+        start = time.perf_counter()
+        for data in encoded:
+            loads(data)
+        best_loads = min(best_loads, time.perf_counter() - start)
+    return {
+        "bytes": sum(map(len, encoded)) / len(encoded),
+        "dumps_us": 1e6 * best_dumps / len(messages),
+        "loads_us": 1e6 * best_loads / len(messages),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--keys", type=int, default=NUM_KEYS)
+    args = parser.parse_args(args)
+
+    messages = typed_messages(args.keys)
+    codecs = {
+        "json": (
+            lambda msg: json.dumps(msg, cls=UserEncoder).encode("utf-8"),
+            lambda data: json.loads(data, cls=UserDecoder),
+        ),
+        "wire": (wire.dumps, wire.loads),
+    }
+    results = []
+    print("%8s %-5s %8s %9s %9s" % ("messages", "codec", "bytes", "dumps_us", "loads_us"))
+    for name, (dumps, loads) in codecs.items():
+        r = measure(messages, dumps, loads)
+        r.update({"messages": len(messages), "codec": name})
+        results.append(r)
+        print(
+            "%8d %-5s %8.1f %9.2f %9.2f"
+            % (r["messages"], name, r["bytes"], r["dumps_us"], r["loads_us"])
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
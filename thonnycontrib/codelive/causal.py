@@ -0,0 +1,198 @@
+"""
+Holds back remote operations until the operations they depend on have been applied.
+
+MQTT at QoS 0 doesn't keep messages in order, so a delete can arrive before the insert
+of the characters it removes. Every operation names what it depends on:
+
+    its site's previous operation, seq - 1
+    deps    for deletes, {site: seq} of the sites that wrote the deleted characters,
+            as far as the sender had seen them
+
+An operation whose dependencies aren't in the OpLog yet is held, and released as soon
+as they are. One that is held for too long was most likely lost rather than late, so
+the sites it waits for are reported and asked for what is missing.
+"""
+import heapq
+import time
+
+# seconds an operation can wait before its missing dependencies are asked for again
+TIMEOUT = 2.0
+# more held operations than this and the oldest are dropped, the catch-up that
+# follows brings them back
+MAX_HELD = 1000
+
+
+def dependencies(op, version):
+    """
+    Returns the deps of op, sent by a replica at version. op["site"] must be set.
+    """
+    if op["type"] != "D":
+        return dict()
+    authors = {key[-1] for key in op["keys"]} - {op["site"]}
+    return {site: version[site] for site in authors if site in version}
+
+
+class CausalBuffer:
+    """
+    Applies the operations pushed into it with apply(op) in causal order. log is the
+    OpLog that apply adds them to, which tells which dependencies are met.
+    """
+
+    def __init__(
+        self, log, apply, timeout=TIMEOUT, max_held=MAX_HELD, clock=time.monotonic
+    ):
+        self._log = log
+        self._apply = apply
+        self._timeout = timeout
+        self._max_held = max_held
+        self._clock = clock
+        # (site, seq) -> [op, time it was held or last asked for]
+        self._held = dict()
+        # site -> heap of (seq needed, (site, seq) of the held operation)
+        self._waiting = dict()
+        # sites of dropped operations, to be asked for at the next check
+        self._dropped = set()
+
+    def __len__(self):
+        return len(self._held)
+
+    def held(self):
+        return [op for op, _ in self._held.values()]
+
+    def push(self, op):
+        """
+        Applies op and everything it was holding up, or holds op. Returns the number of
+        operations applied.
+        """
+        site, seq = op["site"], op["seq"]
+        if seq <= self._log.version().get(site, 0) or (site, seq) in self._held:
+            return 0
+
+        if self._wait(op, self._clock()):
+            if len(self._held) > self._max_held:
+                self._drop_oldest()
+            return 0
+        return self._release(op)
+
+    def expired(self):
+        """
+        Returns the sites whose operations held ones have waited on for longer than the
+        timeout, so they can be asked again. The clock of those is restarted.
+        """
+        now = self._clock()
+        sites = self._dropped
+        self._dropped = set()
+        for (site, seq), held in self._held.items():
+            if now - held[1] >= self._timeout:
+                held[1] = now
+                missing = self._missing(held[0])
+                if missing != None:
+                    sites.add(missing[0])
+        return sites
+
+    def _missing(self, op):
+        # returns the first (site, seq) op depends on that isn't applied, or None
+        version = self._log.version()
+        if version.get(op["site"], 0) < op["seq"] - 1:
+            return op["site"], op["seq"] - 1
+        for site, seq in op.get("deps", dict()).items():
+            # JSON turns the site numbers into strings
+            if version.get(int(site), 0) < seq:
+                return int(site), seq
+        return None
+
+    def _wait(self, op, since):
+        # holds op if one of its dependencies is missing
+        missing = self._missing(op)
+        if missing == None:
+            return False
+
+        key = op["site"], op["seq"]
+        self._held[key] = [op, since]
+        heapq.heappush(self._waiting.setdefault(missing[0], []), (missing[1], key))
+        return True
+
+    def _release(self, op):
+        applied = 0
+        ready = [op]
+        while ready:
+            op = ready.pop()
+            self._apply(op)
+            applied += 1
+
+            # whatever waited on this site up to where it's now complete may be ready
+            site = op["site"]
+            waiting = self._waiting.get(site, [])
+            version = self._log.version().get(site, 0)
+            while waiting and waiting[0][0] <= version:
+                _, key = heapq.heappop(waiting)
+                if key in self._held:
+                    held, since = self._held.pop(key)
+                    if not self._wait(held, since):
+                        ready.append(held)
+        return applied
+
+    def _drop_oldest(self):
+        key = min(self._held, key=lambda key: self._held[key][1])
+        op, _ = self._held.pop(key)
+        self._dropped.add(op["site"])
+
+
+if __name__ == "__main__":
+    from thonnycontrib.codelive.oplog import OpLog
+
+    def buffer(**kwargs):
+        log = OpLog()
+        applied = []
+
+        def apply(op):
+            log.add(op)
+            applied.append((op["site"], op["seq"]))
+
+        return CausalBuffer(log, apply, **kwargs), applied
+
+    print("testing causal delivery... ", end=" ")
+    # a delete of characters site 1 wrote, by site 2 that had seen 2 of site 1's ops
+    insert1 = {"type": "I", "site": 1, "seq": 1, "keys": [[3, 1]]}
+    insert2 = {"type": "I", "site": 1, "seq": 2, "keys": [[4, 1]]}
+    delete = {"type": "D", "site": 2, "seq": 1, "keys": [[3, 1], [4, 1]]}
+    delete["deps"] = dependencies(delete, {1: 2, 2: 0})
+    assert delete["deps"] == {1: 2}
+    assert dependencies(insert1, {1: 0}) == {}
+
+    causal, applied = buffer()
+    assert causal.push(delete) == 0
+    assert causal.push(insert2) == 0
+    assert len(causal) == 2
+    assert causal.push(insert1) == 3
+    assert applied == [(1, 1), (1, 2), (2, 1)]
+    assert len(causal) == 0
+    print("0", end=" ")
+
+    # duplicates are dropped, whether applied or still held
+    assert causal.push(insert1) == 0
+    causal, applied = buffer()
+    assert causal.push(insert2) == 0
+    assert causal.push(insert2) == 0
+    assert len(causal) == 1
+    # the dependencies also work after a trip through JSON
+    delete["deps"] = {"1": 2}
+    assert causal.push(delete) == 0
+    assert causal.push(insert1) == 3
+    print("1", end=" ")
+
+    # held for too long, the site that is missing is asked for again, once per timeout
+    now = [0.0]
+    causal, applied = buffer(timeout=2.0, max_held=2, clock=lambda: now[0])
+    causal.push(insert2)
+    assert causal.expired() == set()
+    now[0] = 2.5
+    assert causal.expired() == {1}
+    assert causal.expired() == set()
+
+    # past max_held the oldest is dropped and its site asked for
+    causal.push({"type": "I", "site": 3, "seq": 2, "keys": []})
+    causal.push({"type": "I", "site": 4, "seq": 2, "keys": []})
+    assert len(causal) == 2
+    assert causal.expired() == {1}
+    print("2")
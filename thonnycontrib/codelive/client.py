@@ -1,3 +1,4 @@
+import base64
 import copy
 import json
 import os
@@ -10,17 +11,24 @@ import time
 import tkinter as tk
 import types
 
-from thonny import get_workbench
+from concurrent.futures import Future
+from thonny import THONNY_USER_DIR, get_workbench
 from thonny.tktextext import EnhancedText
 
 import thonnycontrib.codelive.patched_callbacks as pc
 import thonnycontrib.codelive.mqtt_connection as cmqtt
 import thonnycontrib.codelive.utils as utils
 import thonnycontrib.codelive.user_management as userManMqtt
-
+import thonnycontrib.codelive.snapshot as snapshot
+import thonnycontrib.codelive.causal as causal
+import thonnycontrib.codelive.journal as journal
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.coalesce import Coalescer
+from thonnycontrib.codelive.oplog import OpLog, _sites
+from thonnycontrib.codelive.undo import UndoStack, inverse
 from thonnycontrib.codelive.user import User, UserEncoder, UserDecoder
 from thonnycontrib.codelive.views.session_status.dialog import SessionDialog
-from thonny.ui_utils import select_sequence
 
 MSGLEN = 2048
 
@@ -29,6 +37,17 @@ DEBUG = False
 
 CURSOR_UPDATE_PERIOD = 1000
 CURSOR_BLINK_HALF_CYCLE = 500
+CAUSAL_CHECK_PERIOD = 1000
+JOURNAL_DIR = os.path.join(THONNY_USER_DIR, "codelive")
+# bindtag of the shared text widgets, its bindings run before the widget's own
+PASTE_TAG = "CodeLivePaste"
+# class of the replicas, CRDT_BLOCK_DOC and CRDT_PACKED_DOC can stand in for it
+DOC_CLASS = CRDT_DOC
+
+
+def _journal_path(topic, doc_id):
+    # topics look like "blue_red_green_pink:1234"
+    return os.path.join(JOURNAL_DIR, re.sub(r"[^\w.-]", "_", topic), "%d.log" % doc_id)
 
 
 class Session:
@@ -41,6 +60,9 @@ class Session:
         broker=None,
         shared_editors=None,
         users=None,
+        replicas=None,
+        versions=None,
+        resume=False,
         debug=DEBUG,
     ):
         self._debug = debug
@@ -61,6 +83,31 @@ class Session:
             if shared_editors == None
             else self._enumerate_s_ed(shared_editors)
         )
+        # doc id -> DOC_CLASS replica of the editor's text. Sites are numbered from 1
+        self._site_id = self.user_id + 1
+        self._replicas = self._init_replicas(replicas or dict())
+        # doc id -> OpLog of the operations applied to the replica
+        self._logs = {
+            _id: OpLog((versions or dict()).get(_id))
+            for _id in self._shared_editors["id_first"]
+        }
+        # doc id -> Journal of the replica, to resume the session if Thonny crashes
+        self._journals = self._init_journals(topic, resume)
+        # doc id -> UndoStack of this user's own edits
+        self._undo = {_id: UndoStack() for _id in self._shared_editors["id_first"]}
+        # doc id -> CausalBuffer holding remote operations that arrived too early
+        self._buffers = {
+            _id: causal.CausalBuffer(log, self._apply_op)
+            for (_id, log) in self._logs.items()
+        }
+        # doc id -> operations the buffer released, integrated together once it's done
+        self._released = {_id: [] for _id in self._shared_editors["id_first"]}
+        # doc id -> deletes the log forgot, whose tombstones a user may still need
+        self._tombstones = {_id: [] for _id in self._shared_editors["id_first"]}
+        # user id -> doc id -> the version the user last sent in a "V" message
+        self._peer_versions = dict()
+        # this user's operations, held for a few milliseconds to be sent merged
+        self._outbox = Coalescer(self._publish_op, WORKBENCH.after)
 
         # Network handles
         self._connection = cmqtt.MqttConnection(self, topic=topic, broker_url=broker)
@@ -86,14 +133,12 @@ class Session:
 
         self.initialized = False
 
-        self._default_insert = None
-        self._defualt_delete = None
-
         self.replace_insert_delete()
         self._add_self(is_host)
 
         self._blink_id = None
         self._pos_sync_after_id = None
+        self._causal_check_id = None
         if is_host:
             self.enable_editing()
         else:
@@ -103,15 +148,27 @@ class Session:
         self.dialog = SessionDialog(WORKBENCH, self)
 
     @classmethod
-    def create_session(cls, name, topic, broker=None, shared_editors=None, debug=False):
+    def create_session(
+        cls, name, topic, broker=None, shared_editors=None, resume=False, debug=False
+    ):
         return Session(
             name=name,
             topic=topic,
             broker=broker or cmqtt.get_default_broker(),
             shared_editors=shared_editors,
             is_host=True,
+            resume=resume,
         )
 
+    @classmethod
+    def can_resume(cls, topic):
+        """
+        Whether a session on topic was left without being ended, so its documents can
+        be resumed from their journals
+        """
+        path = _journal_path(topic, 0)
+        return os.path.exists(path)
+
     @classmethod
     def join_session(cls, name, topic, broker, debug=False):
         current_state = userManMqtt.MqttUserManagement.handshake(name, topic, broker)
@@ -125,6 +182,12 @@ class Session:
 
         shared_editors = utils.intiialize_documents(current_state["docs"])
         users = {user.id: user for user in current_state["users"]}
+        replicas = {
+            int(doc_id): doc["crdt"] for doc_id, doc in current_state["docs"].items()
+        }
+        versions = {
+            int(doc_id): doc["version"] for doc_id, doc in current_state["docs"].items()
+        }
 
         return Session(
             is_host=False,
@@ -134,6 +197,8 @@ class Session:
             broker=broker,
             users=users,
             shared_editors=shared_editors,
+            replicas=replicas,
+            versions=versions,
         )
 
     def bind_event(self, widget, seq, handler, override=True, debug=False):
@@ -159,15 +224,9 @@ class Session:
 
     def bind_locals(self, debug=False):
         """
-        Bind keypress binds the events from components with callbacks. The function keys
-        associated with the bindings are returned as values of a dictionary whose keys are string of
-        the event sequence and the widget's name separated by a "|"
-
-        If the event is bound to a widget, the name of the widget is "editor_<the editor's assigned id>".
+        Binds the LocalInsert and LocalDelete events, which the patched insert and delete of
+        the shared text widgets generate for every edit they apply.
         """
-        for widget in self._shared_editors["txt_first"]:
-            self.bind_event(widget, "<KeyPress>", self.broadcast_keypress, True, debug)
-
         self.bind_event(
             get_workbench(), "LocalInsert", self.broadcast_insert, True, debug
         )
@@ -195,21 +254,10 @@ class Session:
             print("Done")
 
     def bind_special_keys(self, debug=False):
-        seqs = [
-            "<KeyRelease-Meta_L>",
-            "<KeyRelease-Super_L>",
-            "<KeyRelease-Control_L>",
-            "<KeyRelease-Alt_L>",
-            select_sequence("<Control-s>", "<Command-s>"),
-            select_sequence("<Control-x>", "<Command-x>"),
-            select_sequence("<Control-z>", "<Command-z>"),
-            select_sequence("<Control-v>", "<Command-v>"),
-            select_sequence("<Control-Shift-z>", "<Command-Shift-z>"),
-        ]
-
+        # Tk's own undo and redo would replay everyone's edits, without sending them
         for text_widget in self._shared_editors["txt_first"]:
-            for seq in seqs:
-                self.bind_event(text_widget, seq, self.handle_special_keys, True, debug)
+            self.bind_event(text_widget, "<<Undo>>", self.handle_undo, True, debug)
+            self.bind_event(text_widget, "<<Redo>>", self.handle_redo, True, debug)
 
     def bind_all(self, debug=False):
         if debug:
@@ -290,6 +338,7 @@ class Session:
 
     def remove_user(self, rm_id, new_host=None):
         del self._users[rm_id]
+        self._peer_versions.pop(rm_id, None)
         self.dialog.remove_id(rm_id, new_host)
 
     def request_control(self):
@@ -321,6 +370,7 @@ class Session:
     def start(self):
         self._connection.Connect()
         self.user_man.Connect()
+        self._causal_check_id = WORKBENCH.after(CAUSAL_CHECK_PERIOD, self._check_causal)
 
     def leave(self):
         """
@@ -376,10 +426,19 @@ class Session:
         - enable edits
         - destroy dialog
         """
+        self._outbox.flush()
         self._connection.Disconnect()
         self.user_man.Disconnect()
+        if self._causal_check_id:
+            WORKBENCH.after_cancel(self._causal_check_id)
+            self._causal_check_id = None
+        # the journals are only there for sessions that didn't end
+        for _journal in self._journals.values():
+            _journal.close()
+            os.remove(_journal.path)
 
         self.unbind_all()
+        self.restore_insert_delete()
         self.enable_editing()
 
         self.dialog.destroy()
@@ -442,16 +501,36 @@ class Session:
             return len(existing)
 
     def get_docs(self):
-        json_form = dict()
-        for editor in self._shared_editors["ed_first"]:
-            content = editor.get_text_widget().get("0.0", tk.END)
-            # remove needles \n at the end of file
-            if len(content) >= 1:
-                content = content[:-1]
+        """
+        Returns the title, snapshot and version of every shared document, for a user who
+        joins. They are read together on the Tk thread, where local edits and remote
+        operations (see MqttConnection.remote_change) are both integrated, so a version
+        is always that of its snapshot.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self._capture_docs()
+
+        docs = Future()
+
+        def capture():
+            try:
+                docs.set_result(self._capture_docs())
+            except Exception as e:
+                docs.set_exception(e)
 
-            temp = {"title": editor.get_title(), "content": content}
-            json_form[self.id_from_editor(editor)] = temp
+        WORKBENCH.after(0, capture)
+        return docs.result()
 
+    def _capture_docs(self):
+        json_form = dict()
+        for editor in self._shared_editors["ed_first"]:
+            _id = self.id_from_editor(editor)
+            # the snapshot has the text, the joining user's editor is filled from it
+            json_form[_id] = {
+                "title": editor.get_title(),
+                "crdt": self._encode_replica(_id),
+                "version": self._logs[_id].version(),
+            }
         return json_form
 
     def get_active_users(self, in_json=False):
@@ -460,17 +539,70 @@ class Session:
 
         return json.dumps((self._users.values()), cls=UserEncoder)
 
+    def _encode_replica(self, _id):
+        return base64.b64encode(snapshot.dumps(self._replicas[_id])).decode("ascii")
+
+    def _init_replicas(self, snapshots):
+        replicas = dict()
+        for _id in self._shared_editors["id_first"]:
+            if _id in snapshots:
+                data = base64.b64decode(snapshots[_id])
+                replicas[_id] = snapshot.loads(
+                    data, siteID=self._site_id, doc_class=DOC_CLASS
+                )
+                widget = self.text_widget_from_id(_id)
+                widget.direct_delete("1.0", tk.END)
+                widget.direct_insert("1.0", replicas[_id].text())
+            else:
+                text = self.text_widget_from_id(_id).get("1.0", "end-1c")
+                replicas[_id] = DOC_CLASS.from_text(text, siteID=self._site_id)
+        return replicas
+
+    def _init_journals(self, topic, resume):
+        journals = dict()
+        for _id in self._shared_editors["id_first"]:
+            path = _journal_path(topic, _id)
+            if resume and os.path.exists(path):
+                doc, log = journal.load(
+                    path, _id, siteID=self._site_id, doc_class=DOC_CLASS
+                )
+                self._replicas[_id], self._logs[_id] = doc, log
+                widget = self.text_widget_from_id(_id)
+                widget.direct_delete("1.0", tk.END)
+                widget.direct_insert("1.0", doc.text())
+                journals[_id] = journal.Journal(path, resume=True)
+            else:
+                journals[_id] = journal.Journal(path)
+                journals[_id].snapshot(self._replicas[_id], self._logs[_id].version())
+        return journals
+
     def replace_insert_delete(self):
-        defn_saved = False
+        """
+        Routes both the Tk commands (typing, paste, cut) and the python calls of insert and
+        delete of the shared text widgets through the patched callbacks
+        """
+        # Thonny's own <<Paste>> binding removes the selection with direct_delete, which
+        # isn't published, so a binding that comes before it deletes it with delete
+        WORKBENCH.bind_class(PASTE_TAG, "<<Paste>>", self.handle_paste)
+        for widget in self._shared_editors["txt_first"]:
+            widget.insert = widget._tk_proxies["insert"] = types.MethodType(
+                pc.patched_insert, widget
+            )
+            widget.delete = widget._tk_proxies["delete"] = types.MethodType(
+                pc.patched_delete, widget
+            )
+            widget.bindtags((PASTE_TAG,) + widget.bindtags())
 
+    def restore_insert_delete(self):
         for widget in self._shared_editors["txt_first"]:
-            if not defn_saved:
-                self._default_insert = widget.insert
-                self._default_delete = widget.delete
-                defn_saved = True
+            widget.insert = widget._tk_proxies["insert"] = widget.intercept_insert
+            widget.delete = widget._tk_proxies["delete"] = widget.intercept_delete
+            widget.bindtags([tag for tag in widget.bindtags() if tag != PASTE_TAG])
 
-            widget.insert = types.MethodType(pc.patched_insert, widget)
-            widget.delete = types.MethodType(pc.patched_delete, widget)
+    def handle_paste(self, event):
+        widget = event.widget
+        if not widget.is_read_only() and widget.has_selection():
+            widget.delete("sel.first", "sel.last")
 
     def enable_cursor_blink(self):
         if self._blink_id == None:
@@ -528,16 +660,87 @@ class Session:
         }
         self.send(instr)
 
-    def handle_special_keys(self, event):
-        SYNC_DELAY_MS = 1000
-        text_widget = event.widget
-
-        if text_widget.is_read_only():
-            return
+    def handle_undo(self, event):
+        _id = self.e_id_from_text(event.widget)
+        if _id != -1 and not event.widget.is_read_only():
+            stack = self._undo[_id]
+            stack.push_redo(self._apply_inverse(_id, stack.pop_undo()))
+        return "break"
 
+    def handle_redo(self, event):
         _id = self.e_id_from_text(event.widget)
+        if _id != -1 and not event.widget.is_read_only():
+            stack = self._undo[_id]
+            stack.push_undo(self._apply_inverse(_id, stack.pop_redo()))
+        return "break"
 
-        WORKBENCH.after(SYNC_DELAY_MS, self.sync_docs, _id)
+    def _apply_inverse(self, editor_id, step):
+        """
+        Undoes the edits of step, last one first, in the replica and the text widget of
+        editor_id and sends them. Returns the step that undoes this again.
+        """
+        if not step:
+            return None
+
+        done = []
+        for edit in reversed(step):
+            kind, keys, text = inverse(edit)
+            if kind == "D":
+                done.append(self._delete_keys(editor_id, keys))
+            else:
+                done.append(self._reinsert(editor_id, keys, text))
+        return [edit for edit in done if edit[1]]
+
+    def _delete_keys(self, editor_id, keys):
+        # the characters of keys that are still there, someone else may have deleted some
+        doc = self._replicas[editor_id]
+        widget = self.text_widget_from_id(editor_id)
+        present = [tuple(key) for key in keys if doc.has_id(key)]
+        if not present:
+            return "D", [], ""
+
+        start = doc.offset_to_index(doc.offset_of(present[0]))
+        text = "".join(doc.char_at(doc.offset_of(key))._val for key in present)
+        self._integrate_delete(editor_id, present)
+        widget.mark_set(tk.INSERT, start)
+        widget.see(start)
+
+        instr = utils.get_delete_instr(editor_id, present, self.user_id, start)
+        self._send_op(editor_id, instr)
+        return "D", present, text
+
+    def _reinsert(self, editor_id, keys, text):
+        """
+        Inserts the deleted characters keys again where they were, with new identifiers
+        since deleted ones are never reused
+        """
+        doc = self._replicas[editor_id]
+        widget = self.text_widget_from_id(editor_id)
+
+        # characters typed in between by others split the text into groups
+        groups = []
+        for key, val in zip(keys, text):
+            offset = doc.offset_of(key)
+            if groups and groups[-1][0] == offset:
+                groups[-1][1].append(val)
+            else:
+                groups.append((offset, [val]))
+
+        new_keys = []
+        # going backwards leaves the offsets of the groups that are left unchanged
+        for offset, vals in reversed(groups):
+            index = doc.offset_to_index(offset)
+            widget.direct_insert(index, "".join(vals))
+            chars = self._insert_local(editor_id, offset, "".join(vals), index)
+            new_keys[:0] = [char._key for char in chars]
+
+        # the other steps go on with the characters under their new identifiers
+        self._undo[editor_id].remap(keys, new_keys)
+
+        end = doc.offset_to_index(doc.offset_of(new_keys[-1]) + 1)
+        widget.mark_set(tk.INSERT, end)
+        widget.see(end)
+        return "I", new_keys, text
 
     def _stop_sync_pos(self):
         if self._pos_sync_after_id:
@@ -579,61 +782,150 @@ class Session:
         pass
 
     def broadcast_insert(self, event):
-        editor = WORKBENCH.get_editor_notebook().get_current_editor()
-        editor_id = self.id_from_editor(editor)
-        instr = utils.get_latent_instr(event, editor_id, True, user_id=self.user_id)
-
-        if instr == None:
+        editor_id = self.e_id_from_text(event.text_widget)
+        if editor_id == -1:
             return
 
-        if self._debug:
-            print("*****************\nSending: %s\n*****************" % repr(instr))
-        self.send(instr)
+        offset = self._replicas[editor_id].index_to_offset(event.index)
+        chars = self._insert_local(
+            editor_id, offset, event.text, event.cursor_after_change
+        )
+        self._record(editor_id, ("I", [char._key for char in chars], event.text), offset)
 
     def broadcast_delete(self, event):
-        editor = WORKBENCH.get_editor_notebook().get_current_editor()
-        editor_id = self.id_from_editor(editor)
-        instr = utils.get_latent_instr(event, editor_id, False, user_id=self.user_id)
+        editor_id = self.e_id_from_text(event.text_widget)
+        if editor_id == -1:
+            return
+
+        doc = self._replicas[editor_id]
+        start = doc.index_to_offset(event.index1)
+        if event.index2 != None:
+            end = doc.index_to_offset(event.index2)
+        else:
+            end = min(start + 1, doc.text_length())
+        removed = self._delete_local(editor_id, start, end, event.cursor_after_change)
+        text = "".join(char._val for char in removed)
+        self._record(editor_id, ("D", [char._key for char in removed], text), start)
 
-        if instr == None:
+    def _record(self, editor_id, edit, offset):
+        if not edit[1]:
             return
+        stack = self._undo[editor_id]
+        # whatever else the same user action edits is part of the same undo step
+        if stack.record(edit, offset):
+            WORKBENCH.after_idle(stack.close)
 
-        if self._debug:
-            print("*****************\nSending: %s\n*****************" % repr(instr))
+    def _insert_local(self, editor_id, offset, text, cursor_pos):
+        """
+        Adds text at offset to the replica of editor_id and sends the identifiers it got.
+        Returns the new Characters.
+        """
+        if not text:
+            return []
 
-        self.send(instr)
+        doc = self._replicas[editor_id]
+        chars = doc.insert_text(text, doc.char_at(offset - 1), doc.char_at(offset))
+        keys = [char._key for char in chars]
 
-    def broadcast_keypress(self, event):
-        text_widget = event.widget
+        instr = utils.get_insert_instr(editor_id, keys, text, self.user_id, cursor_pos)
+        self._send_op(editor_id, instr)
+        return chars
 
-        if text_widget.is_read_only():
-            text_widget.bell()
-            return
+    def _delete_local(self, editor_id, start, end, cursor_pos):
+        """
+        Removes the text from start to end (exclusive) from the replica of editor_id and
+        sends the identifiers of the removed characters. Returns the removed Characters.
+        """
+        if start >= end:
+            return []
 
-        sel_start = text_widget.index(tk.INSERT)
-        editor_id = self.e_id_from_text(event.widget)
+        doc = self._replicas[editor_id]
+        removed = doc.delete_range(doc.char_at(start)._key, doc.char_at(end - 1)._key)
 
-        # if text was selected, delete the selection before inserting
-        if text_widget.tag_ranges("sel"):
-            sel_start = text_widget.index("sel.first")
-            sel_end = text_widget.index("sel.last")
+        instr = utils.get_delete_instr(
+            editor_id, [char._key for char in removed], self.user_id, cursor_pos
+        )
+        self._send_op(editor_id, instr)
+        return removed
+
+    def _send_op(self, editor_id, instr):
+        # the dependencies are what this replica had seen when the edit was made
+        instr["site"] = self._site_id
+        instr["deps"] = causal.dependencies(instr, self._logs[editor_id].version())
+        self._outbox.add(instr)
+
+    def _publish_op(self, instr):
+        # numbered per site once merged, so peers can tell which operations they are
+        # missing
+        editor_id = instr["doc"]
+        log = self._logs[editor_id]
+        instr["seq"] = log.next_seq(self._site_id)
+        log.add(instr)
+        self._journal_op(editor_id, instr)
 
-            del_instr = utils.del_selection_instr(
-                sel_start, sel_end, editor_id, self.user_id, self._debug
-            )
-            if self._debug:
-                print("Deleting selection")
-            self.send(del_instr)
+        if self._debug:
+            print("*****************\nSending: %s\n*****************" % repr(instr))
+        self.send(instr)
+
+    def request_catch_up(self):
+        """
+        Sends the version of every replica, so the driver can send back just the
+        operations that were missed while this peer was disconnected, and the other
+        users know which deletes it has seen
+        """
+        instr = {
+            "type": "V",
+            "user": self.user_id,
+            "versions": {_id: log.version() for (_id, log) in self._logs.items()},
+        }
+        self.send(instr)
 
-        instr = utils.get_direct_instr(event, editor_id, self.user_id, sel_start, False)
+    def send_catch_up(self, msg):
+        versions = self._peer_versions.setdefault(msg["user"], dict())
+        for doc_id, version in msg["versions"].items():
+            versions[int(doc_id)] = _sites(version)
 
-        if instr == None:
+        # the driver answers requests to everyone, a request can also be addressed
+        if msg.get("to", self.get_driver()[0]) != self.user_id:
             return
 
-        if self._debug:
-            print("in broadcast: -%s-" % instr)
+        for doc_id, version in msg["versions"].items():
+            doc_id = int(doc_id)
+            log = self._logs[doc_id]
+            ops = log.missing(version)
+            if ops == None:
+                # the operations it needs are older than our replica's snapshot
+                instr = {
+                    "type": "C",
+                    "doc": doc_id,
+                    "crdt": self._encode_replica(doc_id),
+                    "version": log.version(),
+                }
+            elif ops:
+                instr = {"type": "C", "doc": doc_id, "ops": ops}
+            else:
+                continue
+            self._connection.publish(instr, to=msg["user"])
 
-        self.send(instr)
+    def _check_causal(self):
+        """
+        Asks the sites that remote operations have been waiting on for too long for the
+        operations of that document this replica is missing
+        """
+        for doc_id, buffer in self._buffers.items():
+            for site in buffer.expired():
+                user_id = site - 1
+                if user_id not in self._users:
+                    user_id = self.get_driver()[0]
+                instr = {
+                    "type": "V",
+                    "user": self.user_id,
+                    "to": user_id,
+                    "versions": {doc_id: self._logs[doc_id].version()},
+                }
+                self._connection.publish(instr, to=user_id)
+
+        self._causal_check_id = WORKBENCH.after(CAUSAL_CHECK_PERIOD, self._check_causal)
 
     def enable_editing(self):
         for text_widget in self._shared_editors["txt_first"]:
@@ -663,20 +955,6 @@ class Session:
 
         return -1, "null"
 
-    def sync_docs(self, _id):
-        text_widget = self.text_widget_from_id(_id)
-        instr = utils.get_sync_instr(
-            text_widget, _id, self.user_id, text_widget.index(tk.INSERT), self._debug
-        )
-
-        if instr == None:
-            return
-
-        if self._debug:
-            print("in broadcast: -%s-" % instr)
-
-        self.send(instr)
-
     def change_host(self, user_id=None, forced=False):
         if user_id == self.user_id:
             self.be_host(forced)
@@ -733,44 +1011,30 @@ class Session:
 
     def apply_remote_changes(self, event):
         """
-        WARNING: We don't expect the host (driver) to be getting ANY remote changes. So, we only expect
-        apply_remote_changes to be used in "client" users. So, the function makes the editor
-        read only immediately after apply changes.
+        Integrates a remote operation into the replica of its document and mirrors it in the
+        text widget. Operations name characters by their CRDT identifiers, so they land in
+        the right place whatever was edited since, and applying one twice does nothing.
         """
         msg = event.change
 
         if self._debug:
             print("command: %s" % msg)
 
-        widget = self.text_widget_from_id(msg["doc"])
+        if msg["type"] in ("I", "D"):
+            self._buffers[msg["doc"]].push(msg)
+            if self._integrate_released(msg["doc"]):
+                self.text_widget_from_id(msg["doc"]).see(msg["user_pos"])
 
-        if msg["type"] == "I":
-            pos = msg["pos"]
-            new_text = msg["text"]
+        elif msg["type"] == "V":
+            self.send_catch_up(msg)
 
-            widget.set_read_only(False)
-            tk.Text.insert(widget, pos, new_text)
-            # widget.mark_set(tk.INSERT, msg["user_pos"])
-            widget.see(msg["user_pos"])
-            widget.set_read_only(True)
-
-        elif msg["type"] == "D":
-            widget.set_read_only(False)
-            if "end" in msg:
-                tk.Text.delete(widget, msg["start"], msg["end"])
+        elif msg["type"] == "C":
+            if "ops" in msg:
+                for op in msg["ops"]:
+                    self._buffers[msg["doc"]].push(op)
+                self._integrate_released(msg["doc"])
             else:
-                tk.Text.delete(widget, msg["start"])
-            # widget.mark_set(tk.INSERT, msg["user_pos"])
-            widget.see(msg["user_pos"])
-            widget.set_read_only(True)
-
-        elif msg["type"] == "S":
-            widget.set_read_only(False)
-            tk.Text.delete(widget, "0.0", tk.END)
-            tk.Text.insert(widget, "0.0", msg["text"])
-            # widget.mark_set(tk.INSERT, msg["user_pos"])
-            widget.see(msg["user_pos"])
-            widget.set_read_only(True)
+                self._merge_replica(msg["doc"], msg["crdt"], msg["version"])
 
         elif msg["type"] == "M":
             # user_id = msg["user"]
@@ -780,6 +1044,144 @@ class Session:
             # self._users[user_id].position(doc_id, pos)
             pass
 
+    def _apply_op(self, msg):
+        # returns False for operations that were already applied
+        if not self._logs[msg["doc"]].add(msg):
+            return False
+        self._released[msg["doc"]].append(msg)
+        return True
+
+    def _integrate_released(self, doc_id):
+        """
+        Integrates the operations released by the buffer of doc_id since the last call,
+        all of the deletes in one batch and all of the inserts in another, so a catch-up
+        of thousands of operations updates the replica and the widget once. Returns
+        whether there were any.
+        """
+        ops, self._released[doc_id] = self._released[doc_id], []
+        if not ops:
+            return False
+
+        # deleting first is safe, an insert released with a delete of the same
+        # character is left out since the identifier is remembered as deleted
+        deletes = [op for op in ops if op["type"] == "D"]
+        if deletes:
+            self._integrate_delete(doc_id, [key for op in deletes for key in op["keys"]])
+        inserts = [op for op in ops if op["type"] == "I"]
+        if inserts:
+            self._integrate_insert(
+                doc_id,
+                [key for op in inserts for key in op["keys"]],
+                "".join(op["text"] for op in inserts),
+            )
+
+        for op in ops:
+            self._journal_op(doc_id, op)
+        return True
+
+    def _journal_op(self, doc_id, op):
+        _journal = self._journals[doc_id]
+        _journal.append(op)
+        if not _journal.due():
+            return
+
+        # the log keeps the operations since the previous snapshot, so a peer a little
+        # behind is still sent those rather than the whole replica
+        log = self._logs[doc_id]
+        previous = _journal.snapshot_version
+        _journal.snapshot(self._replicas[doc_id], log.version())
+        if previous != None:
+            self._prune_tombstones(doc_id, log.compact(previous))
+        # the other users prune the tombstones of the deletes this replica has seen
+        self.request_catch_up()
+
+    def _prune_tombstones(self, doc_id, forgotten):
+        """
+        Forgets the identifiers deleted by the operations the log of doc_id forgot,
+        once every other user has sent a version with those deletes in it. Before that,
+        merging the snapshot of a user who hasn't seen one would bring its character
+        back. The identifiers of this site stay, its allocator must not hand them out
+        again.
+        """
+        pending = self._tombstones[doc_id] + [
+            op for op in forgotten if op["type"] == "D"
+        ]
+        versions = [
+            self._peer_versions.get(user_id, dict()).get(doc_id, dict())
+            for user_id in self._users
+            if user_id != self.user_id
+        ]
+        seen = lambda op: all(v.get(op["site"], 0) >= op["seq"] for v in versions)
+        self._replicas[doc_id].forget_deleted(
+            key
+            for op in pending
+            if seen(op)
+            for key in op["keys"]
+            if key[-1] != self._site_id
+        )
+        self._tombstones[doc_id] = [op for op in pending if not seen(op)]
+
+    def _merge_replica(self, doc_id, data, version):
+        # the sender's log was compacted past what this replica has seen. The replica is
+        # rebuilt from its snapshot, which drops characters the sender saw deleted even
+        # if it pruned their tombstones, then the operations the sender hasn't seen are
+        # applied again. When some of those aren't kept anymore, the snapshot is merged
+        # into the replica instead
+        data = base64.b64decode(data)
+        log = self._logs[doc_id]
+        ops = log.missing(version)
+        if ops == None:
+            doc = self._replicas[doc_id]
+            text, keys, deleted = snapshot.iter_snapshot(data)
+            doc.delete_batch(deleted)
+            doc.insert_batch(text, keys)
+        else:
+            old = self._replicas[doc_id]
+            doc = snapshot.loads(data, siteID=self._site_id, doc_class=DOC_CLASS)
+            doc.delete_batch(old.deleted_ids())
+            deletes = [op for op in ops if op["type"] == "D"]
+            doc.delete_batch([key for op in deletes for key in op["keys"]])
+            inserts = [op for op in ops if op["type"] == "I"]
+            doc.insert_batch(
+                "".join(op["text"] for op in inserts),
+                [key for op in inserts for key in op["keys"]],
+            )
+            self._replicas[doc_id] = doc
+
+        self._prune_tombstones(doc_id, log.compact(version))
+        self._journals[doc_id].snapshot(doc, log.version())
+        held = self._buffers[doc_id].held()
+        self._buffers[doc_id] = causal.CausalBuffer(self._logs[doc_id], self._apply_op)
+
+        widget = self.text_widget_from_id(doc_id)
+        widget.direct_delete("1.0", tk.END)
+        widget.direct_insert("1.0", doc.text())
+        for op in held:
+            self._buffers[doc_id].push(op)
+        self._integrate_released(doc_id)
+
+    def _integrate_insert(self, doc_id, keys, text):
+        doc = self._replicas[doc_id]
+        widget = self.text_widget_from_id(doc_id)
+
+        # the runs are in document order with their offsets after the insert, so each
+        # lands after the ones before it in the widget too. The widget bypasses the
+        # patched insert here, so nothing is sent back out
+        for offset, chars in doc.insert_batch(text, keys):
+            widget.direct_insert(doc.offset_to_index(offset), chars)
+
+    def _integrate_delete(self, doc_id, keys):
+        doc = self._replicas[doc_id]
+        widget = self.text_widget_from_id(doc_id)
+
+        # the offsets of the runs are from before the delete, and the widget still has
+        # the text the replica had then, less the runs deleted from it so far
+        removed = 0
+        for offset, chars in doc.delete_batch(keys):
+            index = doc.offset_to_index(offset - removed)
+            widget.direct_delete(index, "%s+%dc" % (index, len(chars)))
+            removed += len(chars)
+
     def update_remote_cursor(self, user_id, index, is_keypress=False):
         color = self._users[user_id].color
         text_widget = self._editor_notebook.get_current_editor().get_text_widget()
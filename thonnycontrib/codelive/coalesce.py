@@ -0,0 +1,202 @@
+"""
+Holds back this user's operations for a few milliseconds and merges them before they
+are sent, so typing fast doesn't publish a message per keystroke.
+
+Operations made by the same replica commute, except for a delete of characters whose
+insert is still held. Those characters are taken out of both, a typo and its
+correction are never sent. So per document there is at most one insert and one delete
+to send, however many edits were made while they waited:
+
+    I + I    one insert with the characters of both, in document order
+    D + D    one delete with the characters of both
+    I + D    the characters deleted from the insert are left out of both
+
+The wait adapts to the typing: it doubles while operations come closer together than
+max_delay and halves when they don't, so a lone edit goes out about right away.
+No operation waits longer than max_delay.
+"""
+import time
+
+# milliseconds the first operation after a pause waits
+MIN_DELAY = 1
+# milliseconds an operation can wait at most
+MAX_DELAY = 30
+
+
+class Coalescer:
+    """
+    Passes the operations added to it to send(op), merged, once they waited for the
+    current delay. schedule(ms, callback) calls back after ms milliseconds, like
+    Tk's after.
+    """
+
+    def __init__(
+        self,
+        send,
+        schedule,
+        min_delay=MIN_DELAY,
+        max_delay=MAX_DELAY,
+        clock=time.monotonic,
+    ):
+        self._send = send
+        self._schedule = schedule
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._clock = clock
+        self.delay = min_delay
+        # (doc, type) -> merged operation waiting to be sent, in the order they came
+        self._held = dict()
+        # batches flushed so far, a callback for an earlier one has nothing to do
+        self._batch = 0
+        self._last_add = None
+
+    def __len__(self):
+        return len(self._held)
+
+    def add(self, op):
+        """
+        Holds op, an "I" or "D" operation, to be sent with whatever comes before the
+        delay runs out
+        """
+        now = self._clock()
+        if self._last_add != None and (now - self._last_add) * 1000 < self._max_delay:
+            self.delay = min(self._max_delay, self.delay * 2)
+        else:
+            self.delay = max(self._min_delay, self.delay / 2)
+        self._last_add = now
+
+        was_empty = not self._held
+        if op["type"] == "D":
+            self._squash(op)
+        if op["keys"]:
+            self._merge(op)
+
+        if was_empty and self._held:
+            batch = self._batch
+            self._schedule(int(self.delay), lambda: self._flush_batch(batch))
+
+    def flush(self):
+        """
+        Sends what is held right away
+        """
+        held = list(self._held.values())
+        self._held.clear()
+        self._batch += 1
+        for op in held:
+            self._send(op)
+
+    def _flush_batch(self, batch):
+        if batch == self._batch:
+            self.flush()
+
+    def _merge(self, op):
+        key = op["doc"], op["type"]
+        held = self._held.get(key)
+        if held == None:
+            self._held[key] = op
+            return
+
+        if op["type"] == "I":
+            pairs = sorted(zip(held["keys"] + op["keys"], held["text"] + op["text"]))
+            held["keys"] = [key for key, _ in pairs]
+            held["text"] = "".join(val for _, val in pairs)
+        else:
+            held["keys"] += op["keys"]
+            deps = held.setdefault("deps", dict())
+            for site, seq in op.get("deps", dict()).items():
+                deps[site] = max(seq, deps.get(site, 0))
+        held["user_pos"] = op["user_pos"]
+
+    def _squash(self, op):
+        # takes the characters of op that are still held in an insert out of both
+        insert = self._held.get((op["doc"], "I"))
+        if insert == None:
+            return
+
+        deleted = set(map(tuple, op["keys"]))
+        kept = [(key, val) for key, val in zip(insert["keys"], insert["text"])
+                if tuple(key) not in deleted]
+        if len(kept) == len(insert["keys"]):
+            return
+
+        squashed = deleted & set(map(tuple, insert["keys"]))
+        op["keys"] = [key for key in op["keys"] if tuple(key) not in squashed]
+        insert["keys"] = [key for key, _ in kept]
+        insert["text"] = "".join(val for _, val in kept)
+        if not kept:
+            del self._held[(op["doc"], "I")]
+
+
+if __name__ == "__main__":
+    now = [0.0]
+    timers = []
+
+    def coalescer(**kwargs):
+        sent = []
+        schedule = lambda ms, callback: timers.append((now[0] + ms / 1000, callback))
+        return Coalescer(sent.append, schedule, clock=lambda: now[0], **kwargs), sent
+
+    def advance(seconds):
+        now[0] += seconds
+        for timer in [t for t in timers if t[0] <= now[0]]:
+            timers.remove(timer)
+            timer[1]()
+
+    def insert(keys, text, doc=0):
+        return {"type": "I", "keys": [list(k) for k in keys], "text": text, "doc": doc,
+                "user_pos": "1.%d" % len(text)}
+
+    def delete(keys, doc=0, deps=None):
+        return {"type": "D", "keys": [list(k) for k in keys], "doc": doc,
+                "user_pos": "1.0", "deps": deps or dict()}
+
+    print("testing coalescing... ", end=" ")
+    # a lone edit goes out after the least delay
+    outbox, sent = coalescer()
+    outbox.add(insert([(5, 1)], "a"))
+    assert sent == [] and outbox.delay == MIN_DELAY
+    advance(0.001)
+    assert len(sent) == 1 and len(outbox) == 0
+
+    # edits made together go out together, sorted, and a typo and its correction not
+    # at all
+    now[0] = 10.0
+    for i, val in reversed(list(enumerate("abxc"))):
+        outbox.add(insert([(6 + i, 1)], val))
+    outbox.add(delete([(8, 1)], deps={2: 4}))
+    advance(0.001)
+    assert sent[1]["keys"] == [[6, 1], [7, 1], [9, 1]] and sent[1]["text"] == "abc"
+    assert len(sent) == 2
+    print("0", end=" ")
+
+    # deletes of characters that were sent are merged, with the deps of both
+    outbox.add(delete([(1, 2)], deps={2: 3}))
+    outbox.add(delete([(3, 1), (4, 2)], deps={2: 5}))
+    outbox.add(insert([(2, 1)], "z", doc=1))
+    outbox.flush()
+    assert [op["type"] for op in sent[2:]] == ["D", "I"]
+    assert sent[2]["keys"] == [[1, 2], [3, 1], [4, 2]] and sent[2]["deps"] == {2: 5}
+    advance(1.0)
+    assert len(sent) == 4
+    print("1", end=" ")
+
+    # the delay grows while edits come close together, never past max_delay, and
+    # shrinks when they stop
+    outbox, sent = coalescer(max_delay=20)
+    for i in range(20):
+        outbox.add(insert([(i + 1, 1)], "a"))
+        advance(0.005)
+    assert outbox.delay == 20
+    outbox.flush()
+    first = len(sent)
+    assert first < 10
+    outbox.add(insert([(50, 1)], "b"))
+    advance(0.019)
+    assert len(sent) == first
+    advance(0.001)
+    assert len(sent) == first + 1
+    for i in range(6):
+        advance(1.0)
+        outbox.add(insert([(60 + i, 1)], "c"))
+    assert outbox.delay == MIN_DELAY
+    print("2")
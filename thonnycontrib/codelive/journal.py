@@ -0,0 +1,322 @@
+"""
+An append-only file per shared document with everything applied to its replica, so
+a session can be resumed after Thonny crashed.
+
+A journal is MAGIC, version, then records of a varint byte length and a body:
+
+    "S"  varint count, (site, seq) varint pairs of the version, then a snapshot
+    "I"  varint site, seq, count and (site, seq) pairs of deps, count of keys and
+         byte length of the keys prefix-delta encoded like in a snapshot, then
+         the text in UTF-8
+    "D"  the same without the text
+
+Reading it back starts from the snapshot and replays the operations after it. The
+records are encoded and written by a thread of their own, a batch at a time, so
+journaling an operation costs the Tk thread a queue put.
+
+A snapshot is due every SNAPSHOT_OPS operations or SNAPSHOT_SECONDS, whichever comes
+first. Writing one starts the file over with it, so the journal of a session that ran
+for hours is a recent snapshot and a short tail.
+"""
+import os
+import queue
+import threading
+import time
+
+import thonnycontrib.codelive.snapshot as snapshot
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+from thonnycontrib.codelive.oplog import OpLog
+from thonnycontrib.codelive.snapshot import (
+    _decode_varints,
+    _encode_varints,
+    _prefix_deltas,
+    _read_keys,
+    _read_varint,
+)
+
+MAGIC = b"CLJRNL"
+VERSION = 1
+# most records written at once
+BATCH_SIZE = 256
+SNAPSHOT_OPS = 5000
+SNAPSHOT_SECONDS = 600
+
+_CLOSE = object()
+
+
+class Journal:
+    """
+    Writes the journal at path. Unless resume is true, whatever was in the file is
+    replaced.
+    """
+
+    def __init__(
+        self,
+        path,
+        resume=False,
+        snapshot_ops=SNAPSHOT_OPS,
+        snapshot_seconds=SNAPSHOT_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not resume or not os.path.exists(path):
+            with open(path, "wb") as file:
+                file.write(MAGIC + bytes([VERSION]))
+
+        self._snapshot_ops = snapshot_ops
+        self._snapshot_seconds = snapshot_seconds
+        self._clock = clock
+        self._ops = 0
+        self._snapshot_time = clock()
+        # version of the last snapshot taken
+        self.snapshot_version = None
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_batches, daemon=True)
+        self._thread.start()
+
+    def append(self, op):
+        self._queue.put(op)
+        self._ops += 1
+
+    def due(self):
+        """
+        Whether enough has been appended since the last snapshot to take another
+        """
+        return self._ops >= self._snapshot_ops or (
+            self._ops > 0
+            and self._clock() - self._snapshot_time >= self._snapshot_seconds
+        )
+
+    def snapshot(self, doc, version):
+        """
+        Records the whole replica, and drops the operations before it from the file
+        """
+        # JSON turns the site numbers into strings
+        version = {int(site): seq for site, seq in version.items()}
+        # the parts are taken right away, the replica keeps changing on the Tk thread
+        self._queue.put(("S", snapshot.capture(doc), version))
+        self._ops = 0
+        self._snapshot_time = self._clock()
+        self.snapshot_version = version
+
+    def close(self):
+        """
+        Writes what is left in the queue and stops the writer thread
+        """
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def _write_batches(self):
+        file = open(self.path, "ab")
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get())
+
+            out = bytearray()
+            for item in batch:
+                if item is _CLOSE:
+                    file.write(out)
+                    file.close()
+                    return
+
+                record = _encode_record(item)
+                if record.startswith(b"S"):
+                    file.write(out)
+                    file.close()
+                    file = self._start_over(record)
+                    out = bytearray()
+                else:
+                    out += _encode_varints([len(record)]) + record
+            file.write(out)
+            file.flush()
+
+    def _start_over(self, record):
+        # a new file replaces the old one in one step, so a crash leaves one of them
+        new_path = self.path + ".new"
+        with open(new_path, "wb") as file:
+            file.write(MAGIC + bytes([VERSION]))
+            file.write(_encode_varints([len(record)]) + record)
+        os.replace(new_path, self.path)
+        return open(self.path, "ab")
+
+
+def load(path, doc_id, siteID=1, doc_class=CRDT_DOC):
+    """
+    Rebuilds the replica and the OpLog of document doc_id from the journal at path
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+
+    doc, log = doc_class(siteID=siteID), OpLog()
+    for record in iter_journal(data):
+        if isinstance(record, tuple):
+            _, snap, version = record
+            doc = snapshot.loads(snap, siteID=siteID, doc_class=doc_class)
+            log = OpLog(version)
+            continue
+
+        op = record
+        op["doc"] = doc_id
+        op["user"] = op["site"] - 1
+        if not log.add(op):
+            continue
+        if op["type"] == "I":
+            for val, key in zip(op["text"], op["keys"]):
+                doc.insert_by_id(val, key)
+        else:
+            for key in op["keys"]:
+                doc.delete_by_id(key)
+    return doc, log
+
+
+def iter_journal(data):
+    """
+    Yields the records of a journal, ("S", snapshot, version) for snapshots and the op
+    dicts for operations. A record cut short by a crash ends the journal.
+    """
+    data = memoryview(data)
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a CRDT journal")
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError("Unsupported journal version %d" % data[len(MAGIC)])
+
+    at = len(MAGIC) + 1
+    while at < len(data):
+        try:
+            size, start = _read_varint(data, at)
+        except IndexError:
+            return
+        if start + size > len(data):
+            return
+        yield _decode_record(data[start : start + size])
+        at = start + size
+
+
+def _encode_record(item):
+    if isinstance(item, tuple):
+        _, parts, version = item
+        pairs = [i for site in sorted(version) for i in (site, version[site])]
+        return b"S" + _encode_varints([len(version)] + pairs) + snapshot.encode(*parts)
+
+    op = item
+    deps = {int(site): seq for site, seq in op.get("deps", dict()).items()}
+    keys = _encode_varints(_prefix_deltas(tuple(key) for key in op["keys"]))
+    header = [op["site"], op["seq"], len(deps)]
+    header += [i for site in sorted(deps) for i in (site, deps[site])]
+    header += [len(op["keys"]), len(keys)]
+
+    out = op["type"].encode("ascii") + _encode_varints(header) + keys
+    if op["type"] == "I":
+        out += op["text"].encode("utf-8")
+    return out
+
+
+def _decode_record(body):
+    kind = chr(body[0])
+    at = 1
+    if kind == "S":
+        count, at = _read_varint(body, at)
+        version = dict()
+        for _ in range(count):
+            site, at = _read_varint(body, at)
+            version[site], at = _read_varint(body, at)
+        return "S", bytes(body[at:]), version
+
+    op = {"type": kind}
+    op["site"], at = _read_varint(body, at)
+    op["seq"], at = _read_varint(body, at)
+    count, at = _read_varint(body, at)
+    deps = dict()
+    for _ in range(count):
+        site, at = _read_varint(body, at)
+        deps[site], at = _read_varint(body, at)
+    op["deps"] = deps
+
+    count, at = _read_varint(body, at)
+    size, at = _read_varint(body, at)
+    keys = _read_keys(_decode_varints(body[at : at + size]))
+    op["keys"] = [list(key) for key, _ in zip(keys, range(count))]
+    if kind == "I":
+        op["text"] = str(body[at + size :], "utf-8")
+    return op
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    print("testing journal... ", end=" ")
+    path = os.path.join(tempfile.mkdtemp(), "codelive", "0.log")
+    doc = CRDT_DOC.from_text("hello\nworld", siteID=1)
+    log = OpLog()
+    journal = Journal(path)
+    journal.snapshot(doc, log.version())
+
+    # ops as Session._send_op makes them
+    chars = doc.insert_text("ünï", doc.char_at(4), doc.char_at(5))
+    ops = [{"type": "I", "keys": [list(c._key) for c in chars], "text": "ünï"}]
+    removed = doc.delete_range(doc.char_at(0)._key, doc.char_at(1)._key)
+    ops.append({"type": "D", "keys": [list(c._key) for c in removed]})
+    for seq, op in enumerate(ops, 1):
+        op.update({"site": 1, "seq": seq, "deps": {}, "doc": 0})
+        log.add(op)
+        journal.append(op)
+    journal.close()
+
+    copy, copy_log = load(path, 0, siteID=1)
+    assert copy.get_state() == doc.get_state()
+    assert copy_log.version() == {1: 2}
+    assert copy_log.next_seq(1) == 3
+    # followers that saw the first op are sent just the second
+    assert [op["seq"] for op in copy_log.missing({1: 1})] == [2]
+    print("0", end=" ")
+
+    # resuming appends to the journal, a later snapshot supersedes what came before
+    journal = Journal(path, resume=True)
+    journal.append({"type": "D", "keys": [list(doc.char_at(0)._key)], "site": 2,
+                    "seq": 1, "deps": {"1": 2}})
+    doc.delete_by_id(doc.char_at(0)._key)
+    journal.close()
+    copy, copy_log = load(path, 0, siteID=1)
+    assert copy.text() == doc.text() and copy_log.version() == {1: 2, 2: 1}
+    assert copy_log.missing({1: 2})[0]["deps"] == {1: 2}
+
+    journal = Journal(path, resume=True)
+    journal.snapshot(doc, {1: 7})
+    journal.close()
+    copy, copy_log = load(path, 0)
+    assert copy.text() == doc.text() and copy_log.version() == {1: 7}
+    print("1", end=" ")
+
+    # a record cut short by a crash is left out
+    journal = Journal(path, resume=True)
+    journal.append(ops[1])
+    journal.close()
+    with open(path, "rb") as file:
+        data = file.read()
+    assert len(list(iter_journal(data))) == 2
+    assert len(list(iter_journal(data[:-3]))) == 1
+    print("2", end=" ")
+
+    # snapshots are due after enough operations or time, and leave only the tail
+    now = [0.0]
+    journal = Journal(path, snapshot_ops=3, snapshot_seconds=60, clock=lambda: now[0])
+    assert not journal.due()
+    now[0] = 100.0
+    assert not journal.due()
+    for op in ops:
+        journal.append(op)
+    assert journal.due()
+    journal.snapshot(doc, {"1": 2})
+    assert not journal.due() and journal.snapshot_version == {1: 2}
+    journal.append(ops[0])
+    now[0] = 200.0
+    assert journal.due()
+    journal.close()
+    with open(path, "rb") as file:
+        records = list(iter_journal(file.read()))
+    assert [type(record) for record in records] == [tuple, dict]
+    print("3")
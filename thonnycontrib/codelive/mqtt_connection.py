@@ -1,22 +1,17 @@
-import json
 import os
 import random
 import string
 import sys
-import time
-import uuid
-import copy
 import threading
 
 import tkinter as tk
 import paho.mqtt.client as mqtt_client
-import paho.mqtt.publish as mqtt_publish
-import paho.mqtt.subscribe as mqtt_subscribe
 
 import thonnycontrib.codelive.utils as utils
+import thonnycontrib.codelive.rpc as rpc
+import thonnycontrib.codelive.wire as wire
 import thonnycontrib.codelive.client as thonny_client
 
-from thonnycontrib.codelive.user import UserDecoder, UserEncoder
 from thonny import get_workbench
 
 WORKBENCH = get_workbench()
@@ -31,12 +26,57 @@ BROKER_URLS = [
 
 USER_COLORS = ["blue", "green", "red", "pink", "orange", "black", "white", "purple"]
 SINGLE_PUBLISH_HEADER = b"CODELIVE_MSG:"
+# seconds single_publish waits for its message to be written out
+PUBLISH_TIMEOUT = 5
+
+# (broker, port) -> client that single_publish and the requests of its Rpc go through.
+# It is connected the first time something goes to that broker and kept open, so
+# control messages don't each pay for connecting to the broker
+_clients = dict()
+# (broker, port) -> Rpc of the client, for the requests made before joining a session
+_rpcs = dict()
+_clients_lock = threading.Lock()
+
+
+def get_client(broker, port=1883, stale=None):
+    """
+    Returns the open connection to broker, connecting to it if there is none yet. A
+    stale client whose connection was lost is replaced with a new one.
+    """
+    with _clients_lock:
+        client = _clients.get((broker, port))
+        if client != None and client is not stale:
+            return client
+        if client != None:
+            client.loop_stop()
+            client.disconnect()
+            del _clients[(broker, port)]
+
+        client = mqtt_client.Client()
+        _rpc = rpc.Rpc(client, SINGLE_PUBLISH_HEADER)
+        # the subscription doesn't survive a reconnect
+        client.on_connect = lambda client, data, flags, rc: rc == 0 and _rpc.subscribe()
+        client.connect(broker, port, 60)
+        # and goes out before any request
+        _rpc.subscribe()
+        client.loop_start()
+        _clients[(broker, port)] = client
+        _rpcs[(broker, port)] = _rpc
+        return client
+
+
+def get_rpc(broker, port=1883):
+    """
+    Returns the Rpc of the open connection to broker
+    """
+    get_client(broker, port)
+    with _clients_lock:
+        return _rpcs[(broker, port)]
+
 
 def broker_exists(broker):
     try:
-        temp_client = mqtt_client.Client()
-        temp_client.connect(host=broker)
-        temp_client.disconnect()
+        get_client(broker)
         return True
     except Exception as e:
         return False
@@ -46,19 +86,11 @@ def topic_exists(topic, broker = "test.mosquitto.org", timeout = 4, broker_check
         raise ValueError("Error: Unable to connect to broker.")
 
     my_id = -1
-    reply_url = str(uuid.uuid4())
-
     greeting = {
         "id": my_id,
-        "instr": {"type": "exist", "name": "Ablf3brhwb", "reply": reply_url},
+        "instr": {"type": "exist", "name": "Ablf3brhwb"},
     }
-    MqttConnection.single_publish(
-        topic, payload=json.dumps(greeting), hostname=broker
-    )
-
-    payload = MqttConnection.single_subscribe(
-        topic + "/" + reply_url, hostname=broker, timeout= timeout
-    )
+    payload = get_rpc(broker).request(topic, greeting, timeout)
 
     return payload != None
 
@@ -107,10 +139,9 @@ def need_id(my_id):
 
 
 def test_broker(url):
-    client = mqtt_client.Client()
+    # the connection is kept for the messages sent to the broker afterwards
     try:
-        # it seems as if keepalive only takes integers
-        client.connect(url, 1883, 1)
+        get_client(url, 1883)
         return True
     except Exception:
         return False
@@ -134,8 +165,6 @@ def assign_broker(broker_url=None):
 
 
 class MqttConnection(mqtt_client.Client):
-    _single_msg = None
-
     def __init__(
         self,
         session,
@@ -159,67 +188,35 @@ class MqttConnection(mqtt_client.Client):
         self.delay = delay
         self.topic = topic
         self.assigned_ids = dict()  # for handshake
+        self._connected_before = False
 
     @classmethod
     def single_publish(cls, topic, payload, hostname):
-        msg = SINGLE_PUBLISH_HEADER + bytes(payload, "utf-8")
-        mqtt_publish.single(topic, payload=msg, hostname=hostname)
-
-    @classmethod
-    def single_subscribe(cls, topic, hostname, timeout=None):
         """
-        A substitute for paho.mqtt.subscribe.simple. Adds a timeout to messages.
-
-        if timeout is not provided, regular subscribe.simple command will be used
+        Publishes payload to topic on the broker hostname, over the connection kept
+        open to it. Returns once the message is written out.
         """
-        if timeout == None:
-            return mqtt_subscribe.simple(topic, hostname=hostname).payload
-
-        _lock = threading.Lock()
-
-        def is_valid(msg):
-            if msg.topic != topic:
-                return False
-
-            _msg = msg.payload
-
-            return (
-                len(_msg) >= len(SINGLE_PUBLISH_HEADER)
-                and _msg[: len(SINGLE_PUBLISH_HEADER)] == SINGLE_PUBLISH_HEADER
-            )
-
-        def on_message(client, data, _msg):
-            if is_valid(_msg):
-                with _lock:
-                    cls._single_msg = _msg.payload[len(SINGLE_PUBLISH_HEADER) :]
-
-        temp_client = mqtt_client.Client()
-        temp_client.on_message = on_message
-
-        temp_client.connect(host=hostname)
-        temp_client.loop_start()
-        temp_client.subscribe(topic)
-
-        # block as long as the message is None and time hasn't run out
-        start_time = time.perf_counter()
-        wait = True
-        while wait:
-            with _lock:
-                wait = cls._single_msg == None
-            wait = wait and time.perf_counter() - start_time < timeout
-
-        # clean up
-        temp_client.loop_stop()
-        temp_client.disconnect()
-
-        copy_msg = copy.deepcopy(cls._single_msg)
-        cls._single_msg = None
-
-        return copy_msg
+        msg = SINGLE_PUBLISH_HEADER + bytes(payload, "utf-8")
+        client = get_client(hostname)
+        info = client.publish(topic, payload=msg)
+        if info.rc == mqtt_client.MQTT_ERR_NO_CONN:
+            # the connection was lost since the last message
+            client = get_client(hostname, stale=client)
+            info = client.publish(topic, payload=msg)
+        info.wait_for_publish(PUBLISH_TIMEOUT)
 
     def get_port(self):
         return 1883
 
+    def remote_change(self, instr):
+        """
+        Hands instr to the session on the Tk thread. Messages arrive on the network
+        thread, but the replicas, their causal buffers and the text widgets are only
+        touched from the Tk thread, in the order the messages came in.
+        """
+        generate = lambda: WORKBENCH.event_generate("RemoteChange", change=instr)
+        WORKBENCH.after(0, generate)
+
     def on_message(self, client, data, msg):
         if msg.topic == self.topic + "/" + str(self.session.user_id):
             self.addressed_msg(msg.payload)
@@ -231,7 +228,7 @@ class MqttConnection(mqtt_client.Client):
         if len(msg.payload) >= len(SINGLE_PUBLISH_HEADER) and msg.payload[: len(SINGLE_PUBLISH_HEADER)] == SINGLE_PUBLISH_HEADER:
             msg.payload = msg.payload[len(SINGLE_PUBLISH_HEADER):]
             
-        json_msg = json.loads(msg.payload, cls=UserDecoder)
+        json_msg = wire.loads(msg.payload)
         if self.session._debug:
             print(json_msg)
         try:
@@ -249,51 +246,60 @@ class MqttConnection(mqtt_client.Client):
             self.respond_to_exist(instr["reply"])
 
         # on edit
-        elif instr["type"] in ("I", "D", "S", "M"):
-            WORKBENCH.event_generate("RemoteChange", change=instr)
+        elif instr["type"] in ("I", "D", "M", "V"):
+            self.remote_change(instr)
 
         # On new user signal only sent by host
         elif instr["type"] == "new_join":
             if instr["user"].id != self.session.user_id:
                 self.session.add_user(instr["user"])
 
-    def publish(self, msg=None, id_assignment=None, unique_code=None):
+    def publish(self, msg=None, id_assignment=None, unique_code=None, to=None):
+        """
+        Publishes msg to everyone in the session, or only to the user with the id to
+        """
         send_msg = {
             "id": self.session.user_id,
             "instr": msg,
             "unique_code": unique_code,
             "id_assigned": id_assignment,
         }
-        mqtt_client.Client.publish(
-            self, self.topic, payload=json.dumps(send_msg, cls=UserEncoder)
-        )
+        topic = self.topic if to == None else self.topic + "/" + str(to)
+        mqtt_client.Client.publish(self, topic, payload=wire.dumps(send_msg))
 
-    def respond_to_exist(self,reply_url):
-        MqttConnection.single_publish(
-            self.topic + "/" + reply_url,
-            payload="True",
-            hostname=self.broker,
-        )
+    def respond_to_exist(self, reply_topic):
+        MqttConnection.single_publish(reply_topic, payload="True", hostname=self.broker)
 
     def addressed_msg(self, msg):
         if self.session._debug:
             print("in addressed")
-        json_msg = json.loads(msg, cls=UserDecoder)
+        json_msg = wire.loads(msg)
 
         instr = json_msg["instr"]
         if self.session.is_host and instr["type"] == "success":
             user = instr["user"]
             self.session.add_user_host(user)
 
-    def Connect(self):
-        mqtt_client.Client.connect(self, self.broker, self.port, 60)
+        elif instr["type"] in ("C", "V"):
+            self.remote_change(instr)
+
+    def on_connect(self, client, data, flags, rc):
+        if rc != 0:
+            return
+
+        # subscriptions don't survive a reconnect, so they are made here
         mqtt_client.Client.subscribe(self, self.topic, qos=self.qos)
+        mqtt_client.Client.subscribe(
+            self, self.topic + "/" + str(self.session.user_id), qos=self.qos
+        )
 
-        if self.session.is_host:
-            mqtt_client.Client.subscribe(
-                self, self.topic + "/" + str(self.session.user_id), qos=self.qos
-            )
+        # anything published while we were away is lost, ask for it
+        if self._connected_before:
+            WORKBENCH.after(0, self.session.request_catch_up)
+        self._connected_before = True
 
+    def Connect(self):
+        mqtt_client.Client.connect(self, self.broker, self.port, 60)
         self.loop_start()
 
     def Disconnect(self):
@@ -345,20 +351,12 @@ if __name__ == "__main__":
     test_topic = "test_topic"
     test_broker = "test.mosquitto.org"
     test_text = "Hello"
-    test_timeout = 10
 
     def test_single_publish():
         MqttConnection.single_publish(test_topic, test_text, test_broker)
 
-    def test_single_subscribe():
-        payload = MqttConnection.single_subscribe(test_topic, test_broker, test_timeout)
-        print(payload)
-
     if sys.argv[1] == "handshake":
         test_handshake()
 
     if sys.argv[1] == "s_pub":
         test_single_publish()
-
-    if sys.argv[1] == "s_sub":
-        test_single_subscribe()
@@ -0,0 +1,131 @@
+"""
+Keeps the operations applied to a replica, so a peer that missed some of them can be
+sent just those instead of the whole document.
+"""
+
+
+class OpLog:
+    """
+    The operations applied to one shared document, by the site that made them.
+
+    Every site numbers its operations 1, 2, 3... in op["seq"]. The version vector of
+    the log maps each site to the highest seq up to which nothing is missing, which
+    sums up everything the replica has seen in a few numbers per site.
+    """
+
+    def __init__(self, version=None):
+        # site -> highest seq with every operation up to it applied
+        self._version = _sites(version or dict())
+        # the operations up to this came with a snapshot, so they can't be resent
+        self._base = dict(self._version)
+        # site -> {seq: op}
+        self._ops = dict()
+
+    def version(self):
+        return dict(self._version)
+
+    def next_seq(self, site):
+        return self._version.get(site, 0) + 1
+
+    def add(self, op):
+        """
+        Records op. Returns False if it was already applied, in which case it must be
+        dropped.
+        """
+        site, seq = op["site"], op["seq"]
+        ops = self._ops.setdefault(site, dict())
+        if seq <= self._base.get(site, 0) or seq in ops:
+            return False
+
+        ops[seq] = op
+        # operations can arrive out of order, the version only counts the ones
+        # without gaps before them
+        version = self._version.get(site, 0)
+        while version + 1 in ops:
+            version += 1
+        self._version[site] = version
+        return True
+
+    def compact(self, version):
+        """
+        Forgets the operations up to version, which a snapshot now stands for. A
+        replica older than that has to be sent the snapshot instead. Returns the
+        operations that were forgotten.
+        """
+        forgotten = []
+        for site, seq in _sites(version).items():
+            ops = self._ops.get(site, dict())
+            for old in sorted(old for old in ops if old <= seq):
+                forgotten.append(ops.pop(old))
+            self._base[site] = max(self._base.get(site, 0), seq)
+
+            # a snapshot from another replica can be ahead of this one
+            seq = max(self._version.get(site, 0), self._base[site])
+            while seq + 1 in ops:
+                seq += 1
+            self._version[site] = seq
+        return forgotten
+
+    def missing(self, version):
+        """
+        Returns the operations a replica at version hasn't seen, in seq order for
+        each site, or None if some of them aren't kept anymore.
+        """
+        version = _sites(version)
+        for site, base in self._base.items():
+            if version.get(site, 0) < base:
+                return None
+
+        missing = []
+        for site, ops in self._ops.items():
+            known = version.get(site, 0)
+            missing.extend(ops[seq] for seq in sorted(ops) if seq > known)
+        return missing
+
+
+def _sites(version):
+    # JSON turns the site numbers into strings
+    return {int(site): seq for site, seq in version.items()}
+
+
+if __name__ == "__main__":
+    print("testing version vectors... ", end=" ")
+    log = OpLog()
+    assert log.next_seq(1) == 1
+    assert log.add({"site": 1, "seq": 1})
+    assert not log.add({"site": 1, "seq": 1})
+    assert log.add({"site": 2, "seq": 2})
+    assert log.version() == {1: 1, 2: 0}
+    assert log.add({"site": 2, "seq": 1})
+    assert log.version() == {1: 1, 2: 2}
+    assert log.next_seq(2) == 3
+    print("0", end=" ")
+
+    # only what the other replica hasn't seen is sent
+    assert log.missing({1: 1, 2: 2}) == []
+    assert log.missing({"2": 1}) == [{"site": 1, "seq": 1}, {"site": 2, "seq": 2}]
+    print("1", end=" ")
+
+    # a log that started from a snapshot can't go back before it
+    log = OpLog({"1": 5})
+    assert log.next_seq(1) == 6
+    assert not log.add({"site": 1, "seq": 3})
+    assert log.add({"site": 1, "seq": 6})
+    assert log.missing({1: 5}) == [{"site": 1, "seq": 6}]
+    assert log.missing({1: 4}) == None
+    print("2", end=" ")
+
+    # compacting keeps only what came after the snapshot
+    log.add({"site": 2, "seq": 1})
+    log.add({"site": 1, "seq": 7})
+    assert log.compact({1: 6, 2: 1}) == [{"site": 1, "seq": 6}, {"site": 2, "seq": 1}]
+    assert log.missing({1: 6, 2: 1}) == [{"site": 1, "seq": 7}]
+    assert log.missing({1: 5, 2: 1}) == None
+    assert not log.add({"site": 1, "seq": 6})
+    assert log.version() == {1: 7, 2: 1} and log.next_seq(1) == 8
+
+    # or to a snapshot of a replica that saw more, past the gap before what's kept
+    log.add({"site": 3, "seq": 3})
+    log.compact({"3": 2})
+    assert log.version() == {1: 7, 2: 1, 3: 3}
+    print("3")
@@ -1,20 +1,108 @@
-import difflib
+"""
+Stand-ins for the Tk "insert" and "delete" commands of a shared text widget. Typing,
+paste, cut and programmatic edits all go through these, so every edit that the widget
+accepts is published exactly once, after it has been applied.
+
+The indices are resolved before the edit, because that is what they refer to.
+"""
+
 import tkinter as tk
 
 from thonny import get_workbench
-from thonny.tktextext import TweakableText
 from thonnycontrib.codelive.utils import publish_delete, publish_insert
 
 
-def patched_insert(text_widget, index, chars, *args):
-    wb = get_workbench()
-    if not text_widget.is_read_only():
-        publish_insert(wb, text_widget, text_widget.index(tk.INSERT), index, chars)
-    TweakableText.insert(text_widget, index, chars, *args)
+def patched_insert(text_widget, index, chars, *args, **kw):
+    edit_count = text_widget.get_edit_count()
+    try:
+        index = text_widget.index(index)
+    except tk.TclError:
+        return text_widget.intercept_insert(index, chars, *args, **kw)
+
+    text_widget.intercept_insert(index, chars, *args, **kw)
+    if text_widget.get_edit_count() != edit_count:
+        publish_insert(
+            get_workbench(), text_widget, text_widget.index(tk.INSERT), index, chars
+        )
+
+
+def patched_delete(text_widget, index1, index2=None, **kw):
+    edit_count = text_widget.get_edit_count()
+    try:
+        index1 = text_widget.index(index1)
+        index2 = text_widget.index(index2) if index2 else None
+    except tk.TclError:
+        # eg. "sel.first" without a selection, the widget knows how to ignore those
+        return text_widget.intercept_delete(index1, index2, **kw)
+
+    text_widget.intercept_delete(index1, index2, **kw)
+    if text_widget.get_edit_count() != edit_count:
+        publish_delete(
+            get_workbench(), text_widget, text_widget.index(tk.INSERT), index1, index2
+        )
+
+
+if __name__ == "__main__":
+    import types
+
+    from thonnycontrib.codelive.CRDT import CRDT_DOC
+
+    class FakeText:
+        """
+        Resolves and clamps "line.col" indices like a Tk text widget, whose last line
+        always ends with a newline
+        """
+
+        def __init__(self, text):
+            self.text = text + "\n"
+            self.edits = 0
+
+        def get_edit_count(self):
+            return self.edits
+
+        def index(self, index):
+            if index == tk.INSERT:
+                return "1.0"
+            lines = self.text.split("\n")[:-1]
+            line, col = map(int, index.split("."))
+            line = min(max(line, 1), len(lines))
+            return "%d.%d" % (line, min(col, len(lines[line - 1])))
+
+        def offset(self, index):
+            line, col = map(int, self.index(index).split("."))
+            return sum(len(val) + 1 for val in self.text.split("\n")[: line - 1]) + col
+
+        def intercept_delete(self, index1, index2=None):
+            start = self.offset(index1)
+            end = self.offset(index2) if index2 else start + 1
+            if start < end:
+                self.text = self.text[:start] + self.text[end:]
+                self.edits += 1
+
+    published = []
+    workbench = types.SimpleNamespace(
+        event_generate=lambda name, **kw: published.append((name, kw))
+    )
+    get_workbench = lambda: workbench
 
+    print("testing patched delete... ", end=" ")
+    # a delete to the end of the line, "1.6" doesn't exist anymore after it
+    widget = FakeText("abcdef")
+    patched_delete(widget, "1.3", "1.6")
+    assert widget.text == "abc\n"
+    name, event = published[-1]
+    assert name == "LocalDelete"
+    assert (event["index1"], event["index2"]) == ("1.3", "1.6")
+    # which the replica, that still has the text, maps to the deleted characters
+    doc = CRDT_DOC.from_text("abcdef")
+    assert doc.index_to_offset(event["index1"]) == 3
+    assert doc.index_to_offset(event["index2"]) == 6
+    print("0", end=" ")
 
-def patched_delete(text_widget, index1, index2=None):
-    wb = get_workbench()
-    if not text_widget.is_read_only():
-        publish_delete(wb, text_widget, text_widget.index(tk.INSERT), index1, index2)
-    TweakableText.delete(text_widget, index1, index2)
+    # to the end of the document, and nothing is published for what isn't deleted
+    widget = FakeText("ab\ncd")
+    patched_delete(widget, "1.1", "2.2")
+    assert widget.text == "a\n" and published[-1][1]["index2"] == "2.2"
+    patched_delete(widget, "1.1", "1.1")
+    assert len(published) == 2
+    print("1")
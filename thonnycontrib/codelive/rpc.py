@@ -0,0 +1,161 @@
+"""
+Requests that expect a reply, sent over a connection that is already open.
+
+A request is a message whose instr has a "reply" topic, and whoever answers it
+publishes the reply there. Each client has a single reply subscription,
+
+    codelive_rpc/<uuid of the client>/+
+
+and the last level of the reply topic of a request is its call id, which tells which
+request a reply answers. So a request costs one publish and its reply one message,
+however many are waiting at once, instead of a reply topic and a connection of its own.
+"""
+import itertools
+import json
+import threading
+import uuid
+
+from concurrent.futures import Future
+
+from thonnycontrib.codelive.user import UserEncoder
+
+REPLY_PREFIX = "codelive_rpc/"
+
+
+class Rpc:
+    """
+    Sends requests over client, a paho Client, and hands their replies back as
+    Futures. header is taken off the start of replies that have it.
+    """
+
+    def __init__(self, client, header=b""):
+        self.client = client
+        self._header = header
+        self._reply_topic = REPLY_PREFIX + uuid.uuid4().hex
+        self._ids = itertools.count(1)
+        # call id -> Future of a request that wasn't replied to yet
+        self._calls = dict()
+        self._lock = threading.Lock()
+        client.message_callback_add(self._reply_topic + "/+", self._on_reply)
+
+    def __len__(self):
+        return len(self._calls)
+
+    def subscribe(self):
+        """
+        Subscribes to the replies. It has to be done again after every reconnect
+        """
+        self.client.subscribe(self._reply_topic + "/+")
+
+    def call(self, topic, msg, timeout=None):
+        """
+        Publishes msg to topic with msg["instr"]["reply"] set, and returns a Future of
+        the payload of the reply. Without a reply within timeout seconds it fails with
+        TimeoutError.
+        """
+        call_id = next(self._ids)
+        future = Future()
+        with self._lock:
+            self._calls[call_id] = future
+
+        if timeout != None:
+            timer = threading.Timer(timeout, self._expire, (call_id,))
+            timer.daemon = True
+            timer.start()
+            future.add_done_callback(lambda _: timer.cancel())
+
+        msg["instr"]["reply"] = "%s/%d" % (self._reply_topic, call_id)
+        self.client.publish(topic, payload=json.dumps(msg, cls=UserEncoder))
+        return future
+
+    def request(self, topic, msg, timeout):
+        """
+        Like call, but waits for the reply and returns its payload, or None if there
+        was none within timeout seconds
+        """
+        try:
+            return self.call(topic, msg, timeout).result()
+        except TimeoutError:
+            return None
+
+    def _on_reply(self, client, data, msg):
+        try:
+            call_id = int(msg.topic.rsplit("/", 1)[1])
+        except ValueError:
+            return
+        # whichever of the reply and the timeout comes first takes the call
+        with self._lock:
+            future = self._calls.pop(call_id, None)
+        if future == None:
+            return
+
+        payload = msg.payload
+        if payload.startswith(self._header):
+            payload = payload[len(self._header) :]
+        future.set_result(payload)
+
+    def _expire(self, call_id):
+        with self._lock:
+            future = self._calls.pop(call_id, None)
+        if future != None:
+            future.set_exception(TimeoutError("No reply to call %d" % call_id))
+
+
+if __name__ == "__main__":
+    import types
+
+    class LoopbackClient:
+        """
+        Delivers what is published to the callbacks of the topics it matches, like a
+        broker would
+        """
+
+        def __init__(self):
+            self.callbacks = dict()
+            self.handlers = dict()
+            self.subscribed = []
+
+        def message_callback_add(self, sub, callback):
+            self.callbacks[sub] = callback
+
+        def subscribe(self, sub):
+            self.subscribed.append(sub)
+
+        def publish(self, topic, payload):
+            if topic in self.handlers:
+                self.handlers[topic](json.loads(payload))
+                return
+            for sub, callback in self.callbacks.items():
+                if sub.endswith("/+") and topic.rsplit("/", 1)[0] == sub[:-2]:
+                    msg = types.SimpleNamespace(topic=topic, payload=payload)
+                    callback(self, None, msg)
+
+    print("testing rpc... ", end=" ")
+    client = LoopbackClient()
+    rpc = Rpc(client, header=b"HDR:")
+    rpc.subscribe()
+    assert client.subscribed == [rpc._reply_topic + "/+"]
+
+    # a responder that answers with what it was asked, out of order
+    requests = []
+    client.handlers["host"] = requests.append
+    first = rpc.call("host", {"id": 1, "instr": {"type": "exist"}})
+    second = rpc.call("host", {"id": 1, "instr": {"type": "join"}}, timeout=5)
+    assert len(rpc) == 2 and requests[0]["instr"]["reply"] != requests[1]["instr"]["reply"]
+    client.publish(requests[1]["instr"]["reply"], b"HDR:joined")
+    client.publish(requests[0]["instr"]["reply"], b"yes")
+    assert first.result(0) == b"yes" and second.result(0) == b"joined"
+    assert len(rpc) == 0
+    print("0", end=" ")
+
+    # a late or repeated reply is dropped, and so are replies to nothing
+    client.publish(requests[0]["instr"]["reply"], b"again")
+    client.publish(rpc._reply_topic + "/x", b"")
+    assert first.result(0) == b"yes"
+
+    # nobody answers
+    assert rpc.request("nowhere", {"id": 1, "instr": {}}, timeout=0.05) == None
+    client.handlers["echo"] = lambda msg: client.publish(msg["instr"]["reply"], b"e")
+    assert rpc.request("echo", {"id": 1, "instr": {}}, timeout=5) == b"e"
+    assert len(rpc) == 0
+    print("1")
@@ -0,0 +1,240 @@
+"""
+Binary snapshots of a CRDT_DOC, used to hand a full replica to a joining peer.
+
+A snapshot is laid out as
+
+    MAGIC, version
+    text        varint byte length, then the text as one UTF-8 blob
+    authors     varint number of runs, then (author, run length) varint pairs
+    positions   varint byte length, then for every character in document order a
+                header and the digits it doesn't share with the position before it,
+                as varints. The header is shared * 8 + new, with the count of new
+                digits in a varint of its own when there are 7 or more of them
+    deleted     varint count, varint byte length, then the deleted identifiers in
+                sorted order, prefix-delta encoded like the positions
+
+Neighbouring characters mostly share all but their last digit and were mostly
+typed by the same person, so a character costs about two bytes plus its text.
+"""
+
+from itertools import chain, islice, repeat
+from operator import add
+
+from thonnycontrib.codelive.CRDT import CRDT_DOC
+
+MAGIC = b"CLSNAP"
+VERSION = 1
+
+
+def dumps(doc):
+    """
+    Returns the snapshot of doc as bytes
+    """
+    return encode(*capture(doc))
+
+
+def capture(doc):
+    """
+    Returns the parts of a snapshot of doc for encode(). Taking them is a few list
+    copies, so the encoding can be left to another thread while doc keeps changing.
+    """
+    return doc.text(), doc._copy_keys(), list(doc._deleted)
+
+
+def encode(text, keys, deleted):
+    """
+    Returns the snapshot of the document that the output of capture() was taken from
+    """
+    text = text.encode("utf-8")
+
+    # the authors are the last digit of every key, counted on the single pass over
+    # keys, which can be an iterator
+    runs = []
+
+    def positions():
+        for key in keys:
+            if runs and runs[-1][0] == key[-1]:
+                runs[-1][1] += 1
+            else:
+                runs.append([key[-1], 1])
+            yield key[:-1]
+
+    positions = _encode_varints(_prefix_deltas(positions()))
+    deleted = sorted(deleted)
+    deleted_bytes = _encode_varints(_prefix_deltas(deleted))
+
+    out = bytearray(MAGIC)
+    out += bytes([VERSION])
+    out += _encode_varints([len(text)]) + text
+    out += _encode_varints([len(runs)] + [i for run in runs for i in run])
+    out += _encode_varints([len(positions)]) + positions
+    out += _encode_varints([len(deleted), len(deleted_bytes)]) + deleted_bytes
+    return bytes(out)
+
+
+def loads(data, siteID=1, doc_class=CRDT_DOC, **kwargs):
+    """
+    Rebuilds a document of doc_class from a snapshot. The identifiers are decoded as
+    they are consumed, so the document is built in a single pass.
+    """
+    text, keys, deleted = iter_snapshot(data)
+    doc = doc_class(siteID=siteID, **kwargs)
+    doc._chars = doc._from_keys(text, keys)
+    doc._deleted = set(deleted)
+    return doc
+
+
+def iter_snapshot(data):
+    """
+    Splits a snapshot into (text, keys, deleted). keys is an iterator that decodes the
+    identifiers of the characters of text lazily, deleted is a list of identifiers.
+    """
+    data = memoryview(data)
+    if bytes(data[: len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a CRDT snapshot")
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError("Unsupported snapshot version %d" % data[len(MAGIC)])
+    at = len(MAGIC) + 1
+
+    size, at = _read_varint(data, at)
+    text = str(data[at : at + size], "utf-8")
+    at += size
+
+    run_count, at = _read_varint(data, at)
+    runs = []
+    for _ in range(2 * run_count):
+        value, at = _read_varint(data, at)
+        runs.append(value)
+    # as 1-tuples, so they can be appended to the positions in C
+    authors = chain.from_iterable(
+        map(repeat, [(author,) for author in runs[::2]], runs[1::2])
+    )
+
+    size, at = _read_varint(data, at)
+    positions = _read_keys(_decode_varints(data[at : at + size]))
+    at += size
+
+    count, at = _read_varint(data, at)
+    size, at = _read_varint(data, at)
+    deleted = list(islice(_read_keys(_decode_varints(data[at : at + size])), count))
+
+    keys = map(add, positions, authors)
+    return text, keys, deleted
+
+
+def _prefix_deltas(keys):
+    """
+    Yields the header and the new digits of every key, where shared is the number of
+    leading digits it has in common with the key before it
+    """
+    prev = ()
+    for key in keys:
+        shared = 0
+        limit = min(len(prev), len(key))
+        while shared < limit and prev[shared] == key[shared]:
+            shared += 1
+        new = len(key) - shared
+        if new < 7:
+            yield shared * 8 + new
+        else:
+            yield shared * 8 + 7
+            yield new
+        yield from key[shared:]
+        prev = key
+
+
+def _read_keys(ints):
+    it = iter(ints)
+    key = ()
+    for header in it:
+        new = header & 7
+        if new == 1:
+            # only the last digit changed, the usual case
+            key = key[: header >> 3] + (next(it),)
+        else:
+            if new == 7:
+                new = next(it)
+            key = key[: header >> 3] + tuple(islice(it, new))
+        yield key
+
+
+def _encode_varints(values):
+    values = list(values)
+    # small values are single bytes, which is the common case by far
+    if not values or max(values) < 0x80:
+        return bytes(values)
+
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def _decode_varints(data):
+    if not data or max(data) < 0x80:
+        return data.tolist()
+
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def _read_varint(data, at):
+    value = shift = 0
+    while True:
+        byte = data[at]
+        at += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, at
+        shift += 7
+
+
+if __name__ == "__main__":
+    from thonnycontrib.codelive.CRDT import CRDT_BLOCK_DOC, CRDT_PACKED_DOC
+
+    print("testing varints... ", end=" ")
+    values = [0, 1, 127, 128, 300, 2 ** 40]
+    assert _decode_varints(memoryview(_encode_varints(values))) == values
+    assert _encode_varints([1, 2]) == b"\x01\x02"
+    print("0")
+
+    print("testing snapshots... ", end=" ")
+    for doc_class in (CRDT_DOC, CRDT_BLOCK_DOC, CRDT_PACKED_DOC):
+        doc = doc_class.from_text("héllo\nwörld\n" * 50, siteID=2)
+        prev = doc.char_at(3)
+        for val in "abc":
+            prev = doc.insert(val, prev, doc.char_at(4))
+        doc.delete_by_id(doc.char_at(10)._key)
+
+        data = dumps(doc)
+        copy = loads(data, siteID=3, doc_class=doc_class)
+        assert copy.get_state() == doc.get_state()
+        assert copy._deleted == doc._deleted
+        assert copy.siteID == 3
+        assert data.startswith(MAGIC)
+    print("0", end=" ")
+
+    # a character costs a few bytes on top of its text
+    doc = CRDT_DOC.from_text("x" * 10000)
+    assert len(dumps(doc)) < 4 * 10000
+    keys = [(1,), (1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 2, 3, 4, 5, 6, 7, 8, 9, 10), (2,)]
+    assert list(_read_keys(_prefix_deltas(keys))) == keys
+    assert loads(dumps(CRDT_DOC())).text() == ""
+
+    # what capture takes doesn't change with the document
+    doc = CRDT_PACKED_DOC.from_text("abc")
+    parts = capture(doc)
+    doc.delete_by_id(doc.char_at(0)._key)
+    assert loads(encode(*parts)).text() == "abc"
+    print("1")
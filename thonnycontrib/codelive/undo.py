@@ -0,0 +1,200 @@
+"""
+Undo and redo of a user's own edits of a shared document, as operations.
+
+Tk's undo replays its own record of the widget's text, which also holds the edits of
+everyone else, and it bypasses insert and delete so nothing of it would be sent. Here
+an edit is kept as the identifiers it inserted or deleted:
+
+    ("I", keys, text)    text was inserted, keys are the identifiers it got
+    ("D", keys, text)    the characters keys, whose values were text, were deleted
+
+and undone with the inverse operation, which is sent like any other, so undoing
+costs the size of the change and leaves the other users' edits alone.
+"""
+
+# steps kept per document
+UNDO_LIMIT = 500
+
+
+class UndoStack:
+    """
+    The undo and redo steps of one document. A step is the list of edits made by one
+    user action (a paste that replaces the selection is a delete and an insert), or a
+    word typed or erased a character at a time.
+    """
+
+    def __init__(self, limit=UNDO_LIMIT):
+        self._limit = limit
+        self._undo = []
+        self._redo = []
+        # edits recorded until close() go in the same step
+        self._open = False
+        # (edit, offset) of the last edit recorded
+        self._last = None
+
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def record(self, edit, offset):
+        """
+        Adds a new edit by the user at offset in the text, which makes the steps undone
+        so far unredoable. Returns True if it started a new step, which the caller has
+        to close()
+        """
+        self._redo.clear()
+        last, self._last = self._last, (edit, offset)
+        if self._open or (self._undo and _continues(last, edit, offset)):
+            self._undo[-1].append(edit)
+            return False
+
+        self._push(self._undo, [edit])
+        self._open = True
+        return True
+
+    def close(self):
+        self._open = False
+
+    def pop_undo(self):
+        self.close()
+        return self._undo.pop() if self._undo else None
+
+    def pop_redo(self):
+        self.close()
+        return self._redo.pop() if self._redo else None
+
+    def push_undo(self, step):
+        self._push(self._undo, step)
+
+    def push_redo(self, step):
+        self._push(self._redo, step)
+
+    def remap(self, old_keys, new_keys):
+        """
+        Renames the characters old_keys to new_keys in every step. Undoing a delete
+        inserts its characters again with new identifiers, which the steps before and
+        after it have to refer to from then on.
+        """
+        renamed = {tuple(old): new for old, new in zip(old_keys, new_keys)}
+        for stack in (self._undo, self._redo):
+            for step in stack:
+                for i, (kind, keys, text) in enumerate(step):
+                    if any(tuple(key) in renamed for key in keys):
+                        keys = [renamed.get(tuple(key), key) for key in keys]
+                        step[i] = kind, keys, text
+
+    def _push(self, stack, step):
+        if step:
+            stack.append(step)
+            del stack[: -self._limit]
+
+
+def inverse(edit):
+    """
+    The kind of edit that undoes edit, with the same characters
+    """
+    kind, keys, text = edit
+    return ("D" if kind == "I" else "I"), keys, text
+
+
+def _continues(last, edit, offset):
+    # typing or erasing a word a character at a time is one step, like in Tk
+    if last == None:
+        return False
+    prev, prev_offset = last
+    if prev[0] != edit[0] or not len(prev[2]) == len(edit[2]) == 1:
+        return False
+    if prev[2].isspace() or edit[2].isspace():
+        return False
+    if edit[0] == "I":
+        return offset == prev_offset + 1
+    # backspace or delete
+    return offset in (prev_offset - 1, prev_offset)
+
+
+if __name__ == "__main__":
+    print("testing undo steps... ", end=" ")
+    stack = UndoStack(limit=3)
+    assert not stack.can_undo() and stack.pop_undo() == None
+
+    # a word typed a character at a time is a single step, the space starts another
+    for i, val in enumerate("ab "):
+        stack.record(("I", [(i + 1, 1)], val), i)
+        stack.close()
+    assert stack.pop_undo() == [("I", [(3, 1)], " ")]
+    assert stack.pop_undo() == [("I", [(1, 1)], "a"), ("I", [(2, 1)], "b")]
+
+    # but not when typing somewhere else
+    stack.record(("I", [(1, 1)], "a"), 0)
+    stack.close()
+    stack.record(("I", [(5, 1)], "b"), 7)
+    stack.close()
+    assert len(stack._undo) == 2
+    stack.pop_undo(), stack.pop_undo()
+    print("0", end=" ")
+
+    # edits before close() are one step, whatever they are
+    assert stack.record(("D", [(1, 1), (2, 1)], "ab"), 0)
+    assert not stack.record(("I", [(4, 1)], "xyz"), 0)
+    stack.close()
+    step = stack.pop_undo()
+    assert len(step) == 2
+    stack.push_redo([inverse(edit) for edit in reversed(step)])
+    assert stack.can_redo()
+    assert inverse(("I", [(4, 1)], "xyz")) == ("D", [(4, 1)], "xyz")
+
+    # a new edit drops what could be redone, and only limit steps are kept
+    for i in range(5):
+        stack.record(("I", [(i + 1, 1)], "%d " % i), i)
+        stack.close()
+    assert not stack.can_redo()
+    assert len(stack._undo) == 3
+    print("1", end=" ")
+
+    # type a word, delete it, undo the delete and then the typing, as
+    # Session._apply_inverse does it
+    from thonnycontrib.codelive.CRDT import CRDT_DOC
+
+    doc = CRDT_DOC(siteID=1)
+    stack = UndoStack()
+
+    def apply_inverse(step):
+        done = []
+        for edit in reversed(step):
+            kind, keys, text = inverse(edit)
+            if kind == "D":
+                present = [tuple(key) for key in keys if doc.has_id(key)]
+                doc.delete_batch(present)
+                done.append(("D", present, text))
+            else:
+                offset = doc.offset_of(keys[0])
+                prev = doc.char_at(offset - 1) if offset > 0 else None
+                chars = doc.insert_text(text, prev, doc.char_at(offset))
+                new_keys = [char._key for char in chars]
+                stack.remap(keys, new_keys)
+                done.append(("I", new_keys, text))
+        return [edit for edit in done if edit[1]]
+
+    chars = doc.insert_text("hello", None, None)
+    stack.record(("I", [char._key for char in chars], "hello"), 0)
+    stack.close()
+    doc.delete_batch([char._key for char in chars])
+    stack.record(("D", [char._key for char in chars], "hello"), 0)
+    stack.close()
+    assert doc.text() == ""
+
+    stack.push_redo(apply_inverse(stack.pop_undo()))
+    assert doc.text() == "hello"
+    redone = apply_inverse(stack.pop_undo())
+    assert doc.text() == "" and len(redone) == 1 and redone[0][0] == "D"
+    stack.push_redo(redone)
+
+    # and redo both
+    stack.push_undo(apply_inverse(stack.pop_redo()))
+    stack.push_undo(apply_inverse(stack.pop_redo()))
+    assert doc.text() == "" and not stack.can_redo()
+    stack.push_redo(apply_inverse(stack.pop_undo()))
+    assert doc.text() == "hello"
+    print("2")
@@ -1,8 +1,6 @@
 import json
-import uuid
 import random
 import paho.mqtt.client as mqtt_client
-import paho.mqtt.publish as mqtt_publish
 import paho.mqtt.subscribe as mqtt_subscribe
 import time
 import tkinter as tk
@@ -11,6 +9,7 @@ from thonny import get_workbench
 
 from thonnycontrib.codelive.user import UserDecoder, UserEncoder
 import thonnycontrib.codelive.mqtt_connection as mqttc
+import thonnycontrib.codelive.rpc as rpc
 
 
 def get_sender_id(json_msg):
@@ -45,15 +44,21 @@ class MqttUserManagement(mqtt_client.Client):
         self.delay = delay
         self.main_topic = topic
         self.users_topic = topic + "/" + "UserManagement"
-        self.reply_topic = None
+        # requests to other users, whose replies come back over this connection
+        self.rpc = rpc.Rpc(self, SINGLE_PUBLISH_HEADER)
         self.my_id_topic = self.users_topic + "/" + str(self.session.user_id)
 
     def Connect(self):
         mqtt_client.Client.connect(self, self.broker, self.port, 60)
-        mqtt_client.Client.subscribe(self, self.users_topic, qos=self.qos)
-        mqtt_client.Client.subscribe(self, self.my_id_topic, qos=self.qos)
         self.loop_start()
 
+    def on_connect(self, client, data, flags, rc):
+        # runs again after every reconnect, which drops the subscriptions
+        if rc == 0:
+            mqtt_client.Client.subscribe(self, self.users_topic, qos=self.qos)
+            mqtt_client.Client.subscribe(self, self.my_id_topic, qos=self.qos)
+            self.rpc.subscribe()
+
     def Disconnect(self):
         self.unsubscribe([self.users_topic, self.my_id_topic])
         self.loop_stop()
@@ -74,9 +79,7 @@ class MqttUserManagement(mqtt_client.Client):
             return
         
         print(json_msg)
-        if msg.topic == self.reply_topic:
-            self.handle_reply(json_msg)
-        elif msg.topic == self.my_id_topic:
+        if msg.topic == self.my_id_topic:
             self.handle_addressed(json_msg)
         elif msg.topic == self.users_topic:
             self.handle_general(json_msg)
@@ -106,26 +109,21 @@ class MqttUserManagement(mqtt_client.Client):
     def _handshake_helper(cls, name, topic, broker):
 
         my_id = random.randint(-1000, -1)
-        reply_url = str(uuid.uuid4())
 
         greeting = {
             "id": my_id,
             "instr": {"type": "join",
                       "name": name,
-                      "reply": reply_url,
                       "time": time.time()},
         }
 
-        mqttc.MqttConnection.single_publish(
-            topic, payload=json.dumps(greeting), hostname=broker
-        )
-        payload = mqttc.MqttConnection.single_subscribe(
-            topic + "/" + reply_url, hostname=broker, timeout=HANDSHAKE_TIMEOUT_SEC
-        )
+        payload = mqttc.get_rpc(broker).request(topic, greeting, HANDSHAKE_TIMEOUT_SEC)
+        if payload == None:
+            return None
         response = json.loads(payload, cls=UserDecoder)
         return response
 
-    def respond_to_handshake(self, sender_id, reply_url, name):
+    def respond_to_handshake(self, sender_id, reply_topic, name):
         assigned_id = self.session.get_new_user_id()
 
         def get_unique_name(_name):
@@ -144,12 +142,24 @@ class MqttUserManagement(mqtt_client.Client):
             "users": self.session.get_active_users(False),
         }
         mqttc.MqttConnection.single_publish(
-            self.users_topic + "/" + reply_url,
+            reply_topic,
             payload=json.dumps(message, cls=UserEncoder),
             hostname=self.broker,
         )
 
-    def handle_reply(self, json_msg):
+    def handle_reply(self, reply):
+        # runs on the network thread once the other user answered a request, or on a
+        # timer thread once HANDOFF_TIMEOUT_SEC passed without an answer
+        try:
+            json_msg = json.loads(reply.result(), cls=UserDecoder)
+        except TimeoutError:
+            tk.messagebox.showinfo(
+                parent=get_workbench(),
+                title="Control Request",
+                message="Control Request got no response",
+            )
+            return
+
         message = ""
         instr = get_instr(json_msg)
         print(json_msg)
@@ -166,8 +176,6 @@ class MqttUserManagement(mqtt_client.Client):
             title="Control Request",
             message="Control Request " + message,
         )
-        mqtt_client.Client.unsubscribe(self, self.reply_topic)
-        self.reply_topic = None
 
     def handle_addressed(self, json_msg):
         approve = False
@@ -177,6 +185,7 @@ class MqttUserManagement(mqtt_client.Client):
             user = instr["user"]
             self.session.add_user_host(user)
 
+        asked = time.monotonic()
         if instr["type"] == "request_control":
             approve = tk.messagebox.askokcancel(
                 parent=get_workbench(),
@@ -193,6 +202,10 @@ class MqttUserManagement(mqtt_client.Client):
             )  # add a timeout on this?
             self.respond_to_give(json_msg, approve)
 
+        # the requester stopped waiting for the answer and stays where it was
+        if time.monotonic() - asked > HANDOFF_TIMEOUT_SEC:
+            approve = False
+
         if approve:
             self.session.change_host(
                 self.session.user_id
@@ -212,21 +225,17 @@ class MqttUserManagement(mqtt_client.Client):
     def request_give(self, targetID):
         if targetID not in self.session._users or targetID == self.session.user_id:
             return 3
-        if self.reply_topic:  # cleanup
-            mqtt_client.Client.unsubscribe(self, self.reply_topic)
-        self.reply_topic = self.users_topic + "/" + str(uuid.uuid4())
         request = {
             "id": self.session.user_id,
             "instr": {"type": "request_give",
                       "name": self.session.username,
-                      "reply": self.reply_topic,
                       "time": time.time()
                     }
         }
-        mqtt_client.Client.subscribe(self, self.reply_topic, qos=self.qos)
-        mqttc.MqttConnection.single_publish(
-            self.users_topic + "/" + str(targetID), json.dumps(request), self.broker
+        reply = self.rpc.call(
+            self.users_topic + "/" + str(targetID), request, HANDOFF_TIMEOUT_SEC
         )
+        reply.add_done_callback(self.handle_reply)
 
     def respond_to_give(self, json_msg, approved):
         response = {
@@ -242,23 +251,19 @@ class MqttUserManagement(mqtt_client.Client):
         host_id, host_name = self.session.get_driver()
         if host_id in {-1, self.session.user_id}:
             return 3
-        if self.reply_topic:  # cleanup
-            mqtt_client.Client.unsubscribe(self, self.reply_topic)
-        self.reply_topic = self.users_topic + "/" + str(uuid.uuid4())
 
         request = {
             "id": self.session.user_id,
             "instr": {"name": self.session.username, 
                       "type": "request_control",
-                      "reply": self.reply_topic,
                       "time": time.time()
                     }
         }
 
-        mqtt_client.Client.subscribe(self, self.reply_topic, qos=self.qos)
-        mqttc.MqttConnection.single_publish(
-            self.users_topic + "/" + str(host_id), json.dumps(request), self.broker
+        reply = self.rpc.call(
+            self.users_topic + "/" + str(host_id), request, HANDOFF_TIMEOUT_SEC
         )
+        reply.add_done_callback(self.handle_reply)
 
     def respond_to_request(self, json_msg, approved):
         response = {
@@ -266,8 +271,8 @@ class MqttUserManagement(mqtt_client.Client):
             "instr": {"type": "request_control", "approved": approved}
         }
         instr = get_instr(json_msg)
-        mqtt_publish.single(
-            instr["reply"], payload=json.dumps(response), hostname=self.broker
+        mqttc.MqttConnection.single_publish(
+            instr["reply"], json.dumps(response), self.broker
         )
 
     def announce_leave(self):
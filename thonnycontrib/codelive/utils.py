@@ -11,8 +11,6 @@ from tkinter import ttk
 from thonny import get_workbench
 from thonny.editors import Editor
 
-ALL_REGEX = re.compile("[a-zA-Z0-9 ./<>?;:\"'`!@#$%^&*()\[\]{}_+=|(\\)-,~]")
-
 MIN_FREE_ID = 0
 FREE_IDS = []
 
@@ -35,118 +33,39 @@ def get_move_instr(doc_id, pos, user_id, debug=False):
     return instr
 
 
-def get_sync_instr(text, doc_id, user_id, cursor_pos, debug=False):
-    if debug:
-        print("Getting Sync Instr")
-
+def get_insert_instr(doc_id, keys, text, user_id, cursor_pos, debug=False):
+    """
+    keys are the CRDT identifiers of the characters of text, in document order
+    """
     instr = dict()
 
-    instr["type"] = "S"
+    instr["type"] = "I"
     if debug:
         instr["num"] = random.randint(0, 100000)
+    instr["keys"] = [list(key) for key in keys]
+    instr["text"] = text
     instr["user"] = user_id
     instr["user_pos"] = cursor_pos
     instr["doc"] = doc_id
-    instr["text"] = text.get("0.0", tk.END)
-
-    # remove needles "\n" at the end of file
-    if len(instr["text"]) >= 1:
-        instr["text"] = instr["text"][:-1]
 
     if debug:
         print(instr)
     return instr
 
 
-def get_direct_instr(event, editor_id, user_id, cursor_pos, debug=False):
-    if debug:
-        print("Getting Direct Instr")
-
-    instr = dict()
-    text = event.widget
-
-    if ALL_REGEX.match(event.char):
-        instr["type"] = "I"
-        if debug:
-            instr["num"] = random.randint(0, 100000)
-        instr["pos"] = text.index(tk.INSERT)
-
-        if user_id == -1:
-            instr["doc"] = editor_id
-            instr["text"] = event.char
-
-    elif event.keysym == "BackSpace":
-        pos = text.index(tk.INSERT)
-
-        try:
-            col = int(pos[pos.find(".") + 1 :])
-            pos = pos[: pos.find(".") + 1] + str(col - 1)
-        except:
-            pass
-
-        instr["type"] = "D"
-        if debug:
-            instr["num"] = random.randint(0, 100000)
-        instr["start"] = pos
-
-    else:
-        return None
-
-    if user_id != -1 and len(instr) != 0:
-        instr["user"] = user_id
-        instr["user_pos"] = cursor_pos
-        instr["doc"] = editor_id
-        instr["text"] = event.char
-
-    if debug:
-        print(instr)
-    return instr
-
-
-def get_latent_instr(event, editor_id, is_insert, user_id, debug=False):
-    if debug:
-        print("Getting latent instr")
-    instr = dict()
-
-    if is_insert:
-        instr["type"] = "I"
-        if debug:
-            instr["num"] = random.randint(0, 100000)
-        instr["pos"] = event.text_widget.index(event.index)
-
-        if user_id != -1:
-            instr["user"] = user_id
-            instr["user_pos"] = event.cursor_after_change
-            instr["doc"] = editor_id
-            instr["text"] = event.text
-    else:
-        instr["type"] = "D"
-        if debug:
-            instr["num"] = random.randint(0, 100000)
-        instr["start"] = event.text_widget.index(event.index1)
-
-        if event.index2 != None:
-            instr["end"] = event.text_widget.index(event.index2)
-
-        if user_id != -1 and instr != None:
-            instr["user"] = user_id
-            instr["user_pos"] = event.cursor_after_change
-            instr["doc"] = editor_id
-    return instr
-
-
-def del_selection_instr(start, end, doc_id, user_id, debug=False):
+def get_delete_instr(doc_id, keys, user_id, cursor_pos, debug=False):
     instr = dict()
 
     instr["type"] = "D"
     if debug:
         instr["num"] = random.randint(0, 100000)
-    instr["start"] = start
-    instr["end"] = end
+    instr["keys"] = [list(key) for key in keys]
     instr["user"] = user_id
-    instr["user_pos"] = start
+    instr["user_pos"] = cursor_pos
     instr["doc"] = doc_id
 
+    if debug:
+        print(instr)
     return instr
 
 
@@ -177,19 +96,26 @@ def receive_json(sock):
 
 
 def publish_delete(broadcast_widget, source, cursor_after_change, index1, index2=None):
+    """
+    index1 and index2 must be resolved before the delete, what they named may be gone
+    after it
+    """
     broadcast_widget.event_generate(
         "LocalDelete",
-        index1=source.index(index1),
-        index2=source.index(index2) if index2 else None,
+        index1=index1,
+        index2=index2,
         text_widget=source,
         cursor_after_change=cursor_after_change,
     )
 
 
 def publish_insert(broadcast_widget, source, cursor_after_change, index, text):
+    """
+    index must be resolved before the insert, like the indices of publish_delete
+    """
     broadcast_widget.event_generate(
         "LocalInsert",
-        index=source.index(index),
+        index=index,
         text=text,
         text_widget=source,
         cursor_after_change=cursor_after_change,
@@ -217,7 +143,8 @@ def intiialize_documents(doc_list):
     editors = dict()
     for i in doc_list:
         doc = doc_list[i]
-        editor = str_to_editor(doc["title"], doc["content"])
+        # the text comes with the snapshot of the document, Session fills it in
+        editor = str_to_editor(doc["title"], doc.get("content", ""))
         editors[editor] = i
 
     return editors
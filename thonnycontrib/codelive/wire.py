@@ -0,0 +1,263 @@
+"""
+The encoding of the messages MqttConnection publishes to a session. The ones sent
+most, edits and cursor moves, are binary so that a keystroke is a few dozen bytes and
+parsing it doesn't go through JSON; every other message is the JSON it always was.
+
+A message is MAGIC, version, the varint tag of its type and the sender id (zigzag,
+ids can be negative), then a body the codec of the type encodes:
+
+    0  any   the JSON of the whole message, with UserEncoder
+    1  "I"   the byte length of the varints that follow: user, doc, line and column
+             of user_pos, site, seq, count and (site, seq) pairs of deps, count of
+             keys and the keys prefix-delta encoded like in a snapshot; then the
+             text in UTF-8
+    2  "D"   the same without the text
+    3  "M"   varint user, doc, line and column of user_pos
+    4  "V"   varint user, count of documents, and per document its id, a count and
+             the (site, seq) pairs of its version
+
+A message goes as JSON when its type has no codec, or when the codec can't take it:
+fields it doesn't know (a debug "num"), a unique_code or id_assigned, a user_pos that
+isn't a line.column index. Tags are never reused for another type.
+
+MAGIC is a byte that never starts UTF-8 text, so loads tells these messages from the
+JSON that single_publish and peers from before this encoding send.
+"""
+import json
+
+from thonnycontrib.codelive.snapshot import (
+    _decode_varints,
+    _encode_varints,
+    _prefix_deltas,
+    _read_keys,
+    _read_varint,
+)
+from thonnycontrib.codelive.user import UserDecoder, UserEncoder
+
+MAGIC = b"\xc1"
+VERSION = 1
+JSON_TAG = 0
+
+
+def dumps(msg):
+    """
+    Returns the bytes of msg, a dict with the "id", "instr", "unique_code" and
+    "id_assigned" of MqttConnection.publish
+    """
+    instr = msg["instr"]
+    codec = CODECS.get(instr.get("type")) if isinstance(instr, dict) else None
+    if (
+        codec != None
+        and msg.get("unique_code") == None
+        and msg.get("id_assigned") == None
+        and instr.keys() <= codec[1]
+    ):
+        tag, _, encode, _ = codec
+        try:
+            body = encode(instr)
+        except (KeyError, TypeError, ValueError):
+            # not something the codec can take, it goes as JSON
+            pass
+        else:
+            header = _encode_varints([tag, _zigzag(msg["id"])])
+            return MAGIC + bytes([VERSION]) + header + body
+
+    body = json.dumps(msg, cls=UserEncoder).encode("utf-8")
+    return MAGIC + bytes([VERSION]) + _encode_varints([JSON_TAG]) + body
+
+
+def loads(data):
+    """
+    Returns the message encoded in data by dumps, or in JSON like before it
+    """
+    if not data.startswith(MAGIC):
+        return json.loads(data, cls=UserDecoder)
+    if data[1] != VERSION:
+        raise ValueError("Unsupported wire version %d" % data[1])
+
+    data = memoryview(data)
+    tag, at = _read_varint(data, 2)
+    if tag == JSON_TAG:
+        return json.loads(str(data[at:], "utf-8"), cls=UserDecoder)
+    decode = _DECODERS.get(tag)
+    if decode == None:
+        raise ValueError("Unknown message tag %d" % tag)
+
+    sender_id, at = _read_varint(data, at)
+    return {
+        "id": _unzigzag(sender_id),
+        "instr": decode(data, at),
+        "unique_code": None,
+        "id_assigned": None,
+    }
+
+
+def _encode_edit(instr):
+    line, col = _split_index(instr["user_pos"])
+    deps = {int(site): seq for site, seq in instr["deps"].items()}
+    ints = [instr["user"], instr["doc"], line, col, instr["site"], instr["seq"]]
+    ints += [len(deps)] + [i for site in sorted(deps) for i in (site, deps[site])]
+    ints += [len(instr["keys"])]
+    ints += _prefix_deltas(tuple(key) for key in instr["keys"])
+    ints = _encode_varints(ints)
+    out = _encode_varints([len(ints)]) + ints
+    if instr["type"] == "I":
+        out += instr["text"].encode("utf-8")
+    return out
+
+
+def _decode_edit(kind, body, at):
+    # all the numbers are read in one go, which is most of the work
+    size, at = _read_varint(body, at)
+    ints = _decode_varints(body[at : at + size])
+    user, doc, line, col, site, seq, count = ints[:7]
+    end = 7 + 2 * count
+    deps = dict(zip(ints[7:end:2], ints[8:end:2]))
+    count = ints[end]
+    keys = _read_keys(ints[end + 1 :])
+    instr = {
+        "type": kind,
+        "keys": [list(key) for key, _ in zip(keys, range(count))],
+        "user": user,
+        "user_pos": "%d.%d" % (line, col),
+        "doc": doc,
+        "site": site,
+        "seq": seq,
+        "deps": deps,
+    }
+    if kind == "I":
+        instr["text"] = str(body[at + size :], "utf-8")
+    return instr
+
+
+def _decode_insert(body, at):
+    return _decode_edit("I", body, at)
+
+
+def _decode_delete(body, at):
+    return _decode_edit("D", body, at)
+
+
+def _encode_move(instr):
+    line, col = _split_index(instr["user_pos"])
+    return _encode_varints([instr["user"], instr["doc"], line, col])
+
+
+def _decode_move(body, at):
+    user, at = _read_varint(body, at)
+    doc, at = _read_varint(body, at)
+    line, at = _read_varint(body, at)
+    col, at = _read_varint(body, at)
+    return {"type": "M", "user": user, "user_pos": "%d.%d" % (line, col), "doc": doc}
+
+
+def _encode_versions(instr):
+    versions = instr["versions"]
+    values = [instr["user"], len(versions)]
+    for doc_id, version in versions.items():
+        values += [int(doc_id), len(version)]
+        values += [i for site in sorted(version) for i in (int(site), version[site])]
+    return _encode_varints(values)
+
+
+def _decode_versions(body, at):
+    user, at = _read_varint(body, at)
+    count, at = _read_varint(body, at)
+    versions = dict()
+    for _ in range(count):
+        doc_id, at = _read_varint(body, at)
+        pairs, at = _read_varint(body, at)
+        version = versions[doc_id] = dict()
+        for _ in range(pairs):
+            site, at = _read_varint(body, at)
+            version[site], at = _read_varint(body, at)
+    return {"type": "V", "user": user, "versions": versions}
+
+
+_EDIT_FIELDS = frozenset(
+    ("type", "keys", "user", "user_pos", "doc", "site", "seq", "deps")
+)
+
+# type -> its tag, the instr fields its codec takes, and the encode and decode of
+# the codec
+CODECS = {
+    "I": (1, _EDIT_FIELDS | {"text"}, _encode_edit, _decode_insert),
+    "D": (2, _EDIT_FIELDS, _encode_edit, _decode_delete),
+    "M": (3, frozenset(("type", "user", "user_pos", "doc")), _encode_move,
+          _decode_move),
+    "V": (4, frozenset(("type", "user", "versions")), _encode_versions,
+          _decode_versions),
+}
+_DECODERS = {tag: decode for tag, _, _, decode in CODECS.values()}
+
+
+def _split_index(index):
+    # a Tk text index "line.column"
+    line, col = index.split(".")
+    if not (line.isdigit() and col.isdigit()):
+        raise ValueError("Not a line.column index: %r" % index)
+    return int(line), int(col)
+
+
+def _zigzag(value):
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+if __name__ == "__main__":
+    from thonnycontrib.codelive.user import User
+
+    def envelope(instr, sender_id=2, **kwargs):
+        msg = {"id": sender_id, "instr": instr}
+        msg.update({"unique_code": None, "id_assigned": None}, **kwargs)
+        return msg
+
+    print("testing wire... ", end=" ")
+    # a keystroke, as Session._publish_op sends it
+    insert = {"type": "I", "keys": [[1 << 20, 3]], "text": "a", "user": 2,
+              "user_pos": "12.7", "doc": 0, "site": 3, "seq": 41, "deps": {}}
+    data = dumps(envelope(insert))
+    assert data[0:1] == MAGIC and data[2] == CODECS["I"][0]
+    assert loads(data) == envelope(insert)
+    assert len(data) < 30 < len(json.dumps(envelope(insert)))
+
+    delete = {"type": "D", "keys": [[5, 1], [5, 2, 3], [900, 1]], "user": 2,
+              "user_pos": "1.0", "doc": 1, "site": 3, "seq": 300, "deps": {1: 7, 2: 1}}
+    assert loads(dumps(envelope(delete))) == envelope(delete)
+    text = {"type": "I", "keys": [[1, 3], [2, 3]], "text": "ü\n", "user": 0,
+            "user_pos": "2.0", "doc": 0, "site": 1, "seq": 1, "deps": {}}
+    assert loads(dumps(envelope(text, -1))) == envelope(text, -1)
+    print("0", end=" ")
+
+    # cursor moves and catch up requests
+    move = {"type": "M", "user": 2, "user_pos": "3.14", "doc": 1}
+    assert loads(dumps(envelope(move))) == envelope(move)
+    versions = {"type": "V", "user": 4, "versions": {0: {1: 12, 3: 200}, 2: {}}}
+    assert loads(dumps(envelope(versions))) == envelope(versions)
+    print("1", end=" ")
+
+    # what a codec can't take goes as JSON, and JSON from older peers still reads
+    user = User(5, "ann", 0, color="blue")
+    others = [
+        envelope({"type": "new_join", "user": user}),
+        envelope(dict(move, num=12)),
+        envelope(dict(move, user_pos="end")),
+        envelope(move, id_assigned=4),
+        envelope({"type": "C", "doc": 0, "ops": [delete]}),
+        envelope(None),
+    ]
+    as_json = lambda msg: json.dumps(msg, cls=UserEncoder)
+    for msg in others:
+        data = dumps(msg)
+        assert data[2] == JSON_TAG
+        assert as_json(loads(data)) == as_json(msg)
+        assert as_json(loads(as_json(msg).encode("utf-8"))) == as_json(msg)
+    try:
+        loads(MAGIC + bytes([VERSION + 1]) + dumps(envelope(move))[2:])
+        assert False
+    except ValueError:
+        pass
+    print("2")